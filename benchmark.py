@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""Benchmarks for MongoEngine. A MongoDB server must be running on localhost;
+the benchmarks use (and drop) the ``mongoengine_benchmark`` database.
+
+Run every benchmark with::
+
+    python benchmark.py
+
+or name the benchmarks to run::
+
+    python benchmark.py aggregation --documents=100000
+"""
+
+import optparse
+import time
+
+from mongoengine import *
+from mongoengine.connection import _get_db
+
+
+DB_NAME = 'mongoengine_benchmark'
+
+benchmarks = []
+
+
+def benchmark(func):
+    benchmarks.append(func)
+    return func
+
+
+def timed(label, func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    elapsed = time.time() - start
+    print '    %-40s %8.3fs' % (label, elapsed)
+    return result
+
+
+def insert_documents(collection, count, make_doc, batch_size=1000):
+    """Insert ``count`` documents built by ``make_doc(i)`` in batches.
+    """
+    batch = []
+    for i in xrange(count):
+        batch.append(make_doc(i))
+        if len(batch) == batch_size:
+            collection.insert(batch)
+            batch = []
+    if batch:
+        collection.insert(batch)
+
+
+@benchmark
+def aggregation(options):
+    """QuerySet.sum, average and item_frequencies, compared with the
+    Javascript (db.eval) implementations they replaced.
+    """
+    class Post(Document):
+        hits = IntField()
+        tags = ListField(StringField())
+
+    Post.drop_collection()
+    tags = ['music', 'film', 'print', 'photography', 'art', 'poetry']
+    insert_documents(Post.objects._collection, options.documents,
+                     lambda i: {'_cls': 'Post', '_types': ['Post'],
+                                'hits': i % 100,
+                                'tags': tags[i % 3:i % 3 + 1 + i % 4]})
+
+    sum_js = """
+        function(sumField) {
+            var total = 0.0;
+            db[collection].find(query).forEach(function(doc) {
+                total += (doc[sumField] || 0.0);
+            });
+            return total;
+        }
+    """
+    freq_js = """
+        function(field) {
+            var frequencies = {};
+            db[collection].find(query).forEach(function(doc) {
+                if (doc[field].constructor == Array) {
+                    doc[field].forEach(function(item) {
+                        frequencies[item] = 1.0 + (frequencies[item] || 0);
+                    });
+                } else {
+                    var item = doc[field];
+                    frequencies[item] = 1.0 + (frequencies[item] || 0);
+                }
+            });
+            return frequencies;
+        }
+    """
+
+    timed('sum (db.eval)', Post.objects.exec_js, sum_js, 'hits')
+    timed('sum', Post.objects.sum, 'hits')
+    timed('average', Post.objects.average, 'hits')
+    timed('item_frequencies (db.eval)', Post.objects.exec_js, freq_js,
+          'tags')
+    timed('item_frequencies', Post.objects.item_frequencies, 'tags')
+    timed('item_frequencies, normalized', Post.objects.item_frequencies,
+          'tags', normalize=True)
+
+    Post.drop_collection()
+
+
+@benchmark
+def gridfs_transfer(options):
+    """Storing and fetching a file with FileField, serially and with
+    parallel_put and parallel_download on a growing number of threads.
+    """
+    import os
+    import tempfile
+
+    class Video(Document):
+        data = FileField()
+
+    Video.drop_collection()
+    content = os.urandom(options.megabytes * 1024 * 1024)
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    video = Video()
+    timed('put', video.data.put, content)
+    timed('read', video.data.read)
+    video.data.delete()
+
+    for workers in (1, 2, 4, 8):
+        timed('parallel_put, %d workers' % workers, video.data.parallel_put,
+              content, workers=workers)
+        timed('parallel_download, %d workers' % workers,
+              video.data.parallel_download, path, workers=workers)
+        video.data.delete()
+
+    os.remove(path)
+    Video.drop_collection()
+
+
+@benchmark
+def compression(options):
+    """The bytes stored (and sent over the wire) for JSON strings and binary
+    values with and without compression, and the cost of decoding them.
+    """
+    import json
+    import os
+
+    def make_fields(compress):
+        return {
+            'body': StringField(compress=compress),
+            'data': BinaryField(compress=compress),
+        }
+
+    body = json.dumps([{'id': i, 'name': 'item %d' % i, 'tags': ['a', 'b']}
+                       for i in xrange(100)])
+    # Half random, half repetitive binary data
+    data = os.urandom(2048) + 'x' * 2048
+
+    for compress in (False, 'zlib', 'bz2'):
+        Report = type('Report', (Document,), make_fields(compress))
+        Report.drop_collection()
+        count = options.documents // 100
+        docs = [Report(body=body, data=data) for i in xrange(count)]
+        timed('%s: save %d documents' % (compress or 'raw', count),
+              lambda: [doc.save() for doc in docs])
+        collection = Report.objects._collection
+        stats = collection.database.command('collstats', collection.name)
+        size = stats['size']
+        print '    %-40s %8.1fMB' % ('%s: bytes stored' % (compress or 'raw'),
+                                     size / 1024.0 / 1024.0)
+        timed('%s: load' % (compress or 'raw'), lambda: list(Report.objects))
+        timed('%s: load and decode' % (compress or 'raw'),
+              lambda: [(doc.body, doc.data) for doc in Report.objects])
+        Report.drop_collection()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('--documents', type='int', default=1000000,
+                      help='number of documents to benchmark with')
+    parser.add_option('--megabytes', type='int', default=64,
+                      help='size of the files to benchmark with')
+    options, names = parser.parse_args()
+
+    connect(DB_NAME)
+    for func in benchmarks:
+        if names and func.__name__ not in names:
+            continue
+        print '%s (%d documents)' % (func.__name__, options.documents)
+        func(options)
+    _get_db().connection.drop_database(DB_NAME)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,438 @@
+import copy
+import re
+import threading
+
+__all__ = ['start_recording', 'stop_recording', 'clear_query_shapes',
+           'get_query_shapes', 'advise', 'set_strict_indexes', 'QueryShape',
+           'IndexAdvice']
+
+
+RE_TYPE = type(re.compile(''))
+
+RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte')
+EQUALITY_OPERATORS = ('$in',)
+
+# A plan that examines more than this many documents for each one it returns
+# is considered to need a better index
+SCAN_RATIO = 10
+
+_recording = False
+_shapes = {}
+_shapes_lock = threading.Lock()
+
+_strict_indexes = None
+_strict_indexes_allow = set()
+# Whether each query shape checked by strict index mode scans its collection
+_scan_verdicts = {}
+
+
+class QueryShape(object):
+    """The shape of a query: the fields it filters on (and how) and the keys
+    it sorts by, without the values being queried for. Queries of the same
+    shape benefit from the same indexes.
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, document, fields, ordering):
+        self.document = document
+        # A tuple of (database field, kind) pairs, where the kind is
+        # 'equality', 'range' or 'other'
+        self.fields = fields
+        self.ordering = ordering
+        self.count = 0
+        # The most recent query of this shape, used to explain it
+        self.query = None
+
+    def __repr__(self):
+        fields = ', '.join('%s: %s' % (field, kind)
+                           for field, kind in self.fields)
+        ordering = ', '.join('%s%s' % (direction < 0 and '-' or '+', key)
+                             for key, direction in self.ordering)
+        return '<QueryShape: %s {%s} sort [%s] x %d>' % (
+            self.document.__name__, fields, ordering, self.count)
+
+
+class IndexAdvice(object):
+    """The result of :func:`~mongoengine.advisor.advise`. Indexes are given
+    in the syntax used by the ``indexes`` :attr:`meta` option, keyed by
+    document class.
+
+    .. attribute:: shapes
+
+        The query shapes that were explained, most frequent first.
+
+    .. attribute:: plans
+
+        The explain plan of each of the explained query shapes.
+
+    .. attribute:: suggestions
+
+        Indexes that would serve the explained queries better than the
+        existing ones.
+
+    .. attribute:: unused
+
+        Declared indexes (including those created for ``unique`` fields)
+        that none of the explained queries used.
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self):
+        self.shapes = []
+        self.plans = {}
+        self.suggestions = {}
+        self.unused = {}
+
+    def __str__(self):
+        lines = ['Query shapes:']
+        for shape in self.shapes:
+            indexes = _get_plan_indexes(self.plans[shape]) or ['no index']
+            lines.append('    %r: %s' % (shape, ', '.join(indexes)))
+        lines.append('Suggested indexes:')
+        for document, indexes in _by_name(self.suggestions):
+            for index in indexes:
+                lines.append('    %s: %r' % (document.__name__, index))
+        lines.append('Unused indexes:')
+        for document, indexes in _by_name(self.unused):
+            for index in indexes:
+                lines.append('    %s: %r' % (document.__name__, index))
+        return '\n'.join(lines)
+
+
+def _by_name(indexes):
+    """Return the items of a dictionary keyed by document class, sorted by
+    the classes' names.
+    """
+    return sorted(indexes.items(), key=lambda item: item[0].__name__)
+
+
+def start_recording():
+    """Start recording the shapes of the queries run by querysets.
+
+    .. versionadded:: 0.5
+    """
+    global _recording
+    _recording = True
+
+
+def stop_recording():
+    """Stop recording the shapes of the queries run by querysets. The shapes
+    recorded so far are kept.
+
+    .. versionadded:: 0.5
+    """
+    global _recording
+    _recording = False
+
+
+def clear_query_shapes():
+    """Forget the query shapes recorded so far.
+
+    .. versionadded:: 0.5
+    """
+    _shapes_lock.acquire()
+    try:
+        _shapes.clear()
+    finally:
+        _shapes_lock.release()
+
+
+def get_query_shapes():
+    """Return the recorded query shapes, most frequent first.
+
+    .. versionadded:: 0.5
+    """
+    shapes = _shapes.values()
+    shapes.sort(key=lambda shape: shape.count, reverse=True)
+    return shapes
+
+
+def record_query(document, query, ordering=None):
+    """Record the shape of a query run by a queryset, if recording.
+    """
+    if not _recording:
+        return
+    ordering = tuple(ordering or ())
+    fields = _get_query_fields(query)
+    key = (document, fields, ordering)
+
+    _shapes_lock.acquire()
+    try:
+        shape = _shapes.get(key)
+        if shape is None:
+            shape = _shapes[key] = QueryShape(document, fields, ordering)
+        shape.count += 1
+        shape.query = copy.deepcopy(query)
+    finally:
+        _shapes_lock.release()
+
+
+def set_strict_indexes(mode, allow=None):
+    """Check every new query shape with ``explain()``, and refuse (``mode``
+    ``'raise'``) or warn about (``'warn'``) queries that scan a whole
+    collection rather than using an index. Pass ``None`` to turn the check
+    off. The mode may also be set for a single document with the
+    ``strict_indexes`` :attr:`meta` option, which takes precedence.
+
+    :param mode: ``'raise'``, ``'warn'`` or ``None``
+    :param allow: the names of collections that may be scanned, such as
+        collections that are known to be small
+
+    .. versionadded:: 0.5
+    """
+    global _strict_indexes, _strict_indexes_allow
+    if mode not in (None, False, 'raise', 'warn'):
+        raise ValueError('Strict index mode must be "raise", "warn" or None')
+    _strict_indexes = mode or None
+    _strict_indexes_allow = set(allow or ())
+    _scan_verdicts.clear()
+
+
+def get_strict_indexes(collection):
+    """Return the global strict index mode for a collection.
+    """
+    if collection in _strict_indexes_allow:
+        return None
+    return _strict_indexes
+
+
+def get_scan_verdict(document, query, ordering, explain):
+    """Return whether a query scans its whole collection, calling
+    ``explain`` for its plan the first time a query of its shape is seen.
+    """
+    key = (document, _get_query_fields(query), tuple(ordering or ()))
+    verdict = _scan_verdicts.get(key)
+    if verdict is None:
+        verdict = _scan_verdicts[key] = _is_full_scan(explain())
+    return verdict
+
+
+def _get_query_fields(query):
+    """Strip the values from a query, returning a sorted tuple of the fields
+    it uses and the kind of condition on each.
+    """
+    fields = []
+    for key, value in query.items():
+        if key in ('$or', '$and', '$nor') and isinstance(value, list):
+            kind = tuple(_get_query_fields(clause) for clause in value)
+        elif key.startswith('$'):
+            kind = 'other'
+        elif isinstance(value, dict) and value and \
+             all(op.startswith('$') for op in value):
+            if [op for op in value if op in RANGE_OPERATORS]:
+                kind = 'range'
+            elif not [op for op in value if op not in EQUALITY_OPERATORS]:
+                kind = 'equality'
+            else:
+                kind = 'other'
+        elif isinstance(value, RE_TYPE):
+            kind = 'range'
+        else:
+            kind = 'equality'
+        fields.append((key, kind))
+    return tuple(sorted(fields))
+
+
+def _index_name(index):
+    """Return the name MongoDB gives an index, given its PyMongo spec.
+    """
+    return '_'.join('%s_%s' % (key, direction) for key, direction in index)
+
+
+def _get_plan_indexes(plan):
+    """Return the names of the indexes used by an explain plan, whether it is
+    in the format of older servers (a ``BtreeCursor`` cursor) or newer ones
+    (stages with an ``indexName``).
+    """
+    names = []
+    if isinstance(plan, dict):
+        cursor = plan.get('cursor')
+        if isinstance(cursor, basestring) and \
+           cursor.startswith('BtreeCursor '):
+            names.append(cursor.split()[1])
+        if isinstance(plan.get('indexName'), basestring):
+            names.append(plan['indexName'])
+        # Only look at the plan that was chosen
+        values = [value for key, value in plan.items()
+                  if key not in ('allPlans', 'oldPlan', 'rejectedPlans')]
+    elif isinstance(plan, list):
+        values = plan
+    else:
+        return names
+
+    for value in values:
+        for name in _get_plan_indexes(value):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def _is_full_scan(plan):
+    """Return whether an explain plan scans the whole collection, in the
+    format of older servers (a ``BasicCursor``) or newer ones (a
+    ``COLLSCAN`` stage).
+    """
+    if isinstance(plan, dict):
+        if plan.get('cursor') == 'BasicCursor' or \
+           plan.get('stage') == 'COLLSCAN':
+            return True
+        values = [value for key, value in plan.items()
+                  if key not in ('allPlans', 'oldPlan', 'rejectedPlans')]
+    elif isinstance(plan, list):
+        values = plan
+    else:
+        return False
+    return bool([value for value in values if _is_full_scan(value)])
+
+
+def _get_plan_ratio(plan):
+    """Return the number of documents a plan examined for each one returned.
+    """
+    stats = plan.get('executionStats', plan)
+    scanned = stats.get('totalDocsExamined', stats.get('nscanned', 0))
+    returned = stats.get('nReturned', stats.get('n', 0))
+    return float(scanned) / max(returned, 1)
+
+
+def _get_attribute_path(document, db_path):
+    """Translate a database field path to the attribute names used in
+    MongoEngine index specs, leaving parts that can't be resolved as they
+    are.
+    """
+    parts = []
+    fields = document._fields
+    for part in db_path.split('.'):
+        field = None
+        for name, candidate in (fields or {}).items():
+            if candidate.db_field == part:
+                field = candidate
+                part = name
+                break
+        parts.append(part)
+
+        # Move on to the fields of embedded documents (in lists)
+        fields = None
+        while field is not None and hasattr(field, 'field'):
+            field = field.field
+        if field is not None and hasattr(field, 'document_type'):
+            try:
+                fields = field.document_type._fields
+            except AttributeError:
+                fields = None
+    return '.'.join(parts)
+
+
+def _to_meta_spec(document, index):
+    """Convert a PyMongo index spec to the ``indexes`` meta option's syntax,
+    leaving out the ``_types`` prefix that is added automatically.
+    """
+    spec = []
+    for key, direction in index:
+        if key == '_types':
+            continue
+        key = _get_attribute_path(document, key)
+        if direction < 0:
+            key = '-' + key
+        spec.append(key)
+    if len(spec) == 1:
+        return spec[0]
+    return tuple(spec)
+
+
+def _suggest_index(shape):
+    """Suggest a PyMongo index spec for a query shape: fields queried for
+    equality first, then the sort keys, then fields queried by range.
+    """
+    index = []
+    fields = [(field, kind) for field, kind in shape.fields
+              if not field.startswith('$') and field != '_types']
+    for field, kind in fields:
+        if kind == 'equality':
+            index.append((field, 1))
+    for key, direction in shape.ordering:
+        if key not in [k for k, d in index]:
+            index.append((key, direction))
+    for field, kind in fields:
+        if kind == 'range' and field not in [k for k, d in index]:
+            index.append((field, 1))
+
+    # Queries by id are served by the _id index
+    if not index or index[0][0] == '_id':
+        return None
+    return index
+
+
+def _explain(shape):
+    """Explain a query shape, using the most recent query of the shape.
+    """
+    from queryset import Q
+
+    queryset = shape.document.objects(Q(__raw__=shape.query))
+    queryset._ordering = list(shape.ordering)
+    return queryset.explain()
+
+
+def advise(top=10):
+    """Explain the most frequent query shapes recorded, and compare the
+    indexes they use with those declared on their documents. Returns an
+    :class:`~mongoengine.advisor.IndexAdvice` with the compound indexes that
+    would serve the queries (putting fields queried for equality first, then
+    sort keys, then fields queried by range), and the declared indexes that
+    none of the queries used. ::
+
+        advisor.start_recording()
+        # ... run the application for a while ...
+        print advisor.advise()
+
+    Recording is paused while the queries are explained.
+
+    :param top: the number of query shapes to explain
+
+    .. versionadded:: 0.5
+    """
+    global _recording
+    advice = IndexAdvice()
+    advice.shapes = get_query_shapes()[:top]
+    used = {}
+
+    recording = _recording
+    _recording = False
+    try:
+        for shape in advice.shapes:
+            advice.plans[shape] = _explain(shape)
+    finally:
+        _recording = recording
+
+    for shape in advice.shapes:
+        document = shape.document
+        plan = advice.plans[shape]
+        names = _get_plan_indexes(plan)
+        used.setdefault(document, set()).update(names)
+        if names and _get_plan_ratio(plan) <= SCAN_RATIO:
+            continue
+
+        index = _suggest_index(shape)
+        if index is None:
+            continue
+        declared = document._meta['indexes'] + \
+                   document._meta['unique_indexes']
+        keys = [key for key, direction in index]
+        if [i for i in declared
+            if [k for k, d in i if k != '_types'][:len(keys)] == keys]:
+            # An index that would do is declared, but wasn't used
+            continue
+        spec = _to_meta_spec(document, index)
+        suggestions = advice.suggestions.setdefault(document, [])
+        if spec not in suggestions:
+            suggestions.append(spec)
+
+    for document, names in used.items():
+        declared = document._meta['indexes'] + \
+                   document._meta['unique_indexes']
+        unused = [_to_meta_spec(document, index) for index in declared
+                  if _index_name(index) not in names]
+        if unused:
+            advice.unused[document] = unused
+    return advice
@@ -63,6 +63,7 @@ class BaseField(object):
         """Descriptor for assigning a value to a field in a document.
         """
         instance._data[self.name] = value
+        instance._changed_fields.add(self.name)
 
     def to_python(self, value):
         """Convert a MongoDB-compatible type to a Python type.
@@ -258,6 +259,9 @@ class TopLevelDocumentMetaclass(DocumentMetaclass):
             'index_drop_dups': False,
             'index_opts': {},
             'queryset_class': QuerySet,
+            'cache_results': False,
+            'stored_js': False,
+            'strict_indexes': None,
         }
         meta.update(base_meta)
 
@@ -330,6 +334,10 @@ class BaseDocument(object):
 
     def __init__(self, **values):
         self._data = {}
+        # The fields loaded from the database, if not all of them were (see
+        # QuerySet.only), and the fields assigned to since
+        self._loaded_fields = None
+        self._changed_fields = set()
         # Assign default values to instance
         for attr_name in self._fields.keys():
             # Use default value if present
@@ -346,9 +354,11 @@ class BaseDocument(object):
         """Ensure that all fields' values are valid and that required fields
         are present.
         """
-        # Get a list of tuples of field names and their current values
+        # Get a list of tuples of field names and their current values,
+        # leaving out fields that weren't fully loaded from the database
         fields = [(field, getattr(self, name)) 
-                  for name, field in self._fields.items()]
+                  for name, field in self._fields.items()
+                  if self._is_field_loaded(name)]
 
         # Ensure that each field is matched to a valid value
         for field, value in fields:
@@ -361,6 +371,14 @@ class BaseDocument(object):
             elif field.required:
                 raise ValidationError('Field "%s" is required' % field.name)
 
+    def _is_field_loaded(self, name):
+        """Return whether a field was fully loaded from the database, or has
+        been assigned to since.
+        """
+        if self._loaded_fields is None or name in self._changed_fields:
+            return True
+        return self._loaded_fields.get(name) is True
+
     @classmethod
     def _get_subclasses(cls):
         """Return a dictionary of all subclasses (found recursively).
@@ -481,6 +499,7 @@ class BaseDocument(object):
 
         obj = cls(**data)
         obj._present_fields = present_fields
+        obj._changed_fields = set()
         return obj
 
     def __eq__(self, other):
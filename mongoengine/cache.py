@@ -0,0 +1,277 @@
+import copy
+import hashlib
+import random
+import re
+import threading
+import time
+
+__all__ = ['BaseCache', 'LocalCache', 'set_result_cache', 'get_result_cache']
+
+
+RE_TYPE = type(re.compile(''))
+
+# The collections this process has seen versions of
+_known_collections = set()
+_known_collections_lock = threading.Lock()
+
+
+def _version_key(collection):
+    return make_key('version', collection)
+
+
+def _new_version():
+    # Versions start at a random number rather than 0, so a version that was
+    # evicted or expired from the cache never comes back to a value that
+    # results were cached under before
+    return random.getrandbits(48)
+
+
+def _remember_collection(collection):
+    _known_collections_lock.acquire()
+    try:
+        _known_collections.add(collection)
+    finally:
+        _known_collections_lock.release()
+
+
+def get_collection_version(collection):
+    """Return the current version of a collection, given its full name. The
+    version is increased every time the collection is written to, and forms
+    part of every result cache key, so results cached before a write are never
+    served after it. Versions are kept in the result cache backend, so
+    processes that share a backend see each other's writes.
+    """
+    _remember_collection(collection)
+    backend = get_result_cache()
+    key = _version_key(collection)
+    version = backend.get(key)
+    if version is None:
+        version = _new_version()
+        backend.set(key, version)
+    return version
+
+
+def get_collection_versions():
+    """Return a snapshot of the versions of every collection this process has
+    written to or cached results for, as a dict of full collection names to
+    versions.
+    """
+    _known_collections_lock.acquire()
+    try:
+        collections = list(_known_collections)
+    finally:
+        _known_collections_lock.release()
+    return dict((collection, get_collection_version(collection))
+                for collection in collections)
+
+
+def bump_collection_version(collection):
+    """Increase the version of a collection, given its full name, making all
+    results cached for it unreachable.
+    """
+    _remember_collection(collection)
+    backend = get_result_cache()
+    key = _version_key(collection)
+    if backend.incr(key) is None:
+        backend.set(key, _new_version())
+
+
+def _freeze(value):
+    """Convert a value into a form whose :func:`repr` is stable, so equal
+    queries produce equal keys.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, RE_TYPE):
+        return ('re', value.pattern, value.flags)
+    return value
+
+
+def make_key(*parts):
+    """Build a cache key from the given parts. Keys are short and only contain
+    safe characters, so they may be used with external caches such as
+    memcached.
+    """
+    digest = hashlib.sha1(repr(_freeze(parts))).hexdigest()
+    return 'mongoengine:%s' % digest
+
+
+class BaseCache(object):
+    """The interface of a result cache backend. Subclass this to store results
+    in an external cache - values are lists of PyMongo SON objects, which may
+    be pickled. The versions of collections are stored in the backend too, as
+    integers, so a backend shared between processes must implement
+    :meth:`incr` atomically (e.g. with memcached's ``incr``).
+
+    .. versionadded:: 0.5
+    """
+
+    def get(self, key):
+        """Return the value stored for ``key``, or ``None`` if there is no
+        such value (or it has expired).
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, timeout=None):
+        """Store a value for ``key``, optionally expiring after ``timeout``
+        seconds.
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """Remove the value stored for ``key``, if any.
+        """
+        raise NotImplementedError
+
+    def incr(self, key, delta=1):
+        """Increase the integer stored for ``key`` by ``delta``, returning the
+        new value, or ``None`` if there is no value for ``key``. This default
+        implementation isn't atomic, so is only safe for in-process caches.
+        """
+        value = self.get(key)
+        if value is None:
+            return None
+        value += delta
+        self.set(key, value)
+        return value
+
+    def clear(self):
+        """Remove every value from the cache.
+        """
+        raise NotImplementedError
+
+
+class LocalCache(BaseCache):
+    """An in-process, thread-safe cache that evicts the least recently used
+    entry once ``max_entries`` values are stored. Values are copied on the way
+    in and out, so cached results can't be modified through the documents
+    that are built from them.
+
+    :param max_entries: the maximum number of values to store
+    :param timeout: the default number of seconds before values expire;
+        ``None`` for no expiry
+
+    .. versionadded:: 0.5
+    """
+
+    def __init__(self, max_entries=1000, timeout=300):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        # Entries are [previous, next, key, value, expiry time] lists, linked
+        # in order of use from the root (most recent first)
+        self._entries = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def _unlink(self, entry):
+        previous, next = entry[0], entry[1]
+        previous[1] = next
+        next[0] = previous
+
+    def _link_first(self, entry):
+        root = self._root
+        first = root[1]
+        entry[0], entry[1] = root, first
+        first[0] = entry
+        root[1] = entry
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[4] is not None and entry[4] < time.time():
+                self._unlink(entry)
+                del self._entries[key]
+                return None
+            self._unlink(entry)
+            self._link_first(entry)
+            value = entry[3]
+        finally:
+            self._lock.release()
+        return copy.deepcopy(value)
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+        value = copy.deepcopy(value)
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._unlink(entry)
+            entry = [None, None, key, value, expires]
+            self._entries[key] = entry
+            self._link_first(entry)
+
+            # Evict the least recently used entries
+            while len(self._entries) > self.max_entries:
+                last = self._root[0]
+                self._unlink(last)
+                del self._entries[last[2]]
+        finally:
+            self._lock.release()
+
+    def incr(self, key, delta=1):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None or (entry[4] is not None and
+                                 entry[4] < time.time()):
+                return None
+            entry[3] += delta
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unlink(entry)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_result_cache = LocalCache()
+
+
+def set_result_cache(backend):
+    """Set the backend used to cache query results, an instance of a
+    :class:`~mongoengine.cache.BaseCache` subclass. By default results are
+    cached in-process by a :class:`~mongoengine.cache.LocalCache`.
+
+    .. versionadded:: 0.5
+    """
+    global _result_cache
+    _result_cache = backend
+
+
+def get_result_cache():
+    """Return the backend used to cache query results.
+
+    .. versionadded:: 0.5
+    """
+    return _result_cache
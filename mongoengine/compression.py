@@ -0,0 +1,134 @@
+import bz2
+import zlib
+
+import pymongo.binary
+
+__all__ = ['BaseCodec', 'ZlibCodec', 'BZ2Codec', 'register_codec',
+           'get_codec']
+
+
+# The (user defined) BSON binary subtype that marks compressed values
+COMPRESSED_SUBTYPE = 0x80
+
+# Values smaller than this many bytes are stored uncompressed by default
+COMPRESS_THRESHOLD = 1024
+
+
+class BaseCodec(object):
+    """The interface of a compression codec. Subclass this, give the codec a
+    unique :attr:`name` and register an instance with
+    :func:`~mongoengine.compression.register_codec` to compress fields with
+    it. The name is stored with every compressed value, so values remain
+    readable after a field switches to a different codec.
+
+    .. versionadded:: 0.5
+    """
+
+    name = None
+
+    def compress(self, data):
+        """Return ``data`` (a :class:`str`) compressed.
+        """
+        raise NotImplementedError
+
+    def decompress(self, data):
+        """Return the original data, given the compressed ``data``.
+        """
+        raise NotImplementedError
+
+
+class ZlibCodec(BaseCodec):
+    """Compresses values with :mod:`zlib`, the default codec.
+
+    .. versionadded:: 0.5
+    """
+
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class BZ2Codec(BaseCodec):
+    """Compresses values with :mod:`bz2`, which is slower than zlib but
+    usually produces smaller values.
+
+    .. versionadded:: 0.5
+    """
+
+    name = 'bz2'
+
+    def __init__(self, level=9):
+        self.level = level
+
+    def compress(self, data):
+        return bz2.compress(data, self.level)
+
+    def decompress(self, data):
+        return bz2.decompress(data)
+
+
+_codecs = {}
+
+
+def register_codec(codec):
+    """Register a codec instance under its name, replacing any codec that
+    was registered with the same name.
+
+    .. versionadded:: 0.5
+    """
+    if not codec.name or '\0' in codec.name:
+        raise ValueError('Codecs must have a name, without null characters')
+    _codecs[codec.name] = codec
+
+
+def get_codec(codec):
+    """Return the codec to compress a field with, given the field's
+    ``compress`` option: ``True`` for zlib, the name of a registered codec, a
+    codec instance, or a false value for no compression (``None``).
+
+    .. versionadded:: 0.5
+    """
+    if not codec:
+        return None
+    if codec is True:
+        codec = ZlibCodec.name
+    if isinstance(codec, basestring):
+        try:
+            return _codecs[codec]
+        except KeyError:
+            raise ValueError('No compression codec named "%s"' % codec)
+    return codec
+
+
+def compress_value(data, codec):
+    """Compress ``data`` into a BSON binary value, which records the codec
+    used.
+    """
+    data = '%s\0%s' % (codec.name, codec.compress(data))
+    return pymongo.binary.Binary(data, COMPRESSED_SUBTYPE)
+
+
+def is_compressed(value):
+    """Return whether a value loaded from the database was compressed.
+    """
+    return (isinstance(value, pymongo.binary.Binary) and
+            value.subtype == COMPRESSED_SUBTYPE)
+
+
+def decompress_value(value):
+    """Return the data in a compressed value, with whichever codec
+    compressed it.
+    """
+    name, data = str(value).split('\0', 1)
+    return get_codec(name).decompress(data)
+
+
+register_codec(ZlibCodec())
+register_codec(BZ2Codec())
@@ -1,7 +1,7 @@
 from pymongo import Connection
 import multiprocessing
 
-__all__ = ['ConnectionError', 'connect']
+__all__ = ['ConnectionError', 'connect', 'register_backend']
 
 
 _connection_defaults = {
@@ -15,6 +15,8 @@ _db_name = None
 _db_username = None
 _db_password = None
 _db = {}
+_backend = None
+_backends = {}
 
 
 class ConnectionError(Exception):
@@ -35,6 +37,11 @@ def _get_connection(reconnect=False):
 def _get_db(reconnect=False):
     global _db, _connection
     identity = get_identity()
+    if _backend is not None:
+        if _db.get(identity) is None or reconnect:
+            _db[identity] = _backends[_backend](_db_name)
+        return _db[identity]
+
     # Connect if not already connected
     if _connection.get(identity) is None or reconnect:
         _connection[identity] = _get_connection(reconnect=reconnect)
@@ -56,16 +63,42 @@ def get_identity():
     identity = 0 if not identity else identity[0]
     return identity
     
-def connect(db, username=None, password=None, **kwargs):
+def register_backend(name, get_database):
+    """Register a storage backend, to be selected with
+    ``connect(db, backend=name)``. ``get_database`` is called with the
+    database's name and returns an object with the interface of a PyMongo
+    database.
+
+    .. versionadded:: 0.5
+    """
+    _backends[name] = get_database
+
+def _get_memory_database(name):
+    from memory import get_database
+    return get_database(name)
+
+register_backend('memory', _get_memory_database)
+    
+def connect(db, username=None, password=None, backend=None, **kwargs):
     """Connect to the database specified by the 'db' argument. Connection 
     settings may be provided here as well if the database is not running on
     the default port on localhost. If authentication is needed, provide
     username and password arguments as well.
+
+    Set ``backend`` to the name of a registered storage backend to use it
+    instead of a MongoDB server, e.g. ``'memory'`` for the in-memory
+    backend in :mod:`mongoengine.memory`.
+
+    .. versionchanged:: 0.5 - added the ``backend`` argument
     """
     global _connection_settings, _db_name, _db_username, _db_password, _db
+    global _backend
+    if backend is not None and backend not in _backends:
+        raise ConnectionError('No storage backend named "%s"' % backend)
     _connection_settings = dict(_connection_defaults, **kwargs)
     _db_name = db
     _db_username = username
     _db_password = password
+    _backend = backend
     return _get_db(reconnect=True)
 
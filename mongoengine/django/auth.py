@@ -1,4 +1,5 @@
 from mongoengine import *
+from mongoengine.cache import LocalCache
 
 from django.utils.hashcompat import md5_constructor, sha_constructor
 from django.utils.encoding import smart_str
@@ -21,7 +22,7 @@ class User(Document):
     """A User document that aims to mirror most of the API specified by Django
     at http://docs.djangoproject.com/en/dev/topics/auth/#users
     """
-    username = StringField(max_length=30, required=True)
+    username = StringField(max_length=30, required=True, unique=True)
     first_name = StringField(max_length=30)
     last_name = StringField(max_length=30)
     email = StringField()
@@ -35,6 +36,19 @@ class User(Document):
     def __unicode__(self):
         return self.username
 
+    def save(self, *args, **kwargs):
+        super(User, self).save(*args, **kwargs)
+        MongoEngineBackend.invalidate(self.pk)
+
+    def delete(self, *args, **kwargs):
+        super(User, self).delete(*args, **kwargs)
+        MongoEngineBackend.invalidate(self.pk)
+
+    def modify(self, **update):
+        result = super(User, self).modify(**update)
+        MongoEngineBackend.invalidate(self.pk)
+        return result
+
     def get_full_name(self):
         """Returns the users first and last names, separated by a space.
         """
@@ -97,8 +111,32 @@ class User(Document):
 
 class MongoEngineBackend(object):
     """Authenticate using MongoEngine and mongoengine.django.auth.User.
+
+    Users loaded by :meth:`get_user` (on every authenticated request) are
+    cached for :attr:`cache_timeout` seconds, and dropped from the cache
+    when they are saved or deleted. The cache is in-process by default; set
+    :attr:`cache` to a :class:`~mongoengine.cache.BaseCache` that stores
+    values in a shared cache when several processes serve requests, so that
+    changes made by one process are seen by the others at once.
+
+    .. versionchanged:: 0.5 - users are cached by :meth:`get_user`
     """
 
+    cache = LocalCache(max_entries=1000, timeout=None)
+    cache_timeout = 300
+
+    @classmethod
+    def _cache_key(cls, user_id):
+        return 'mongoengine:user:%s' % user_id
+
+    @classmethod
+    def invalidate(cls, user_id):
+        """Drop a user from the cache, e.g. after changing them with an
+        update query, which the cache can't see.
+        """
+        if user_id is not None:
+            cls.cache.delete(cls._cache_key(user_id))
+
     def authenticate(self, username=None, password=None):
         user = User.objects(username=username).first()
         if user:
@@ -107,7 +145,16 @@ class MongoEngineBackend(object):
         return None
 
     def get_user(self, user_id):
-        return User.objects.with_id(user_id)
+        key = self._cache_key(user_id)
+        son = self.cache.get(key)
+        if son is not None:
+            return User._from_son(son)
+        user = User.objects.with_id(user_id)
+        if user is not None:
+            # The SON is cached rather than the document, so any cache
+            # backend can store it
+            self.cache.set(key, user.to_mongo(), self.cache_timeout)
+        return user
 
 
 def get_user(userid):
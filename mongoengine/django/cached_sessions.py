@@ -0,0 +1,5 @@
+"""A session backend that caches sessions in front of MongoDB. Enable it with
+``SESSION_ENGINE = 'mongoengine.django.cached_sessions'``.
+"""
+
+from mongoengine.django.sessions import CachedSessionStore as SessionStore
@@ -5,6 +5,7 @@ from django.utils.encoding import force_unicode
 from mongoengine.document import Document
 from mongoengine import fields
 from mongoengine.queryset import OperationError
+from mongoengine.cache import LocalCache
 
 from datetime import datetime
 
@@ -14,7 +15,28 @@ class MongoSession(Document):
     session_data = fields.StringField()
     expire_date = fields.DateTimeField()
     
-    meta = {'collection': 'django_session', 'allow_inheritance': False}
+    meta = {'collection': 'django_session', 'allow_inheritance': False,
+            'indexes': ['expire_date']}
+
+    @classmethod
+    def clear_expired(cls, batch_size=1000):
+        """Delete the sessions that have expired, ``batch_size`` at a time,
+        so that a large purge doesn't hold the database's lock for long.
+        Expired sessions are found through the index on ``expire_date``.
+        Returns the number of sessions deleted.
+        """
+        now = datetime.now()
+        deleted = 0
+        previous_keys = None
+        while True:
+            expired = cls.objects(expire_date__lt=now).only('session_key')
+            keys = [s.pk for s in expired.limit(batch_size)]
+            # Stop if a batch wasn't deleted, rather than finding it forever
+            if not keys or keys == previous_keys:
+                return deleted
+            cls.objects(session_key__in=keys).delete(safe=True)
+            deleted += len(keys)
+            previous_keys = keys
 
 
 class SessionStore(SessionBase):
@@ -25,13 +47,15 @@ class SessionStore(SessionBase):
         try:
             s = MongoSession.objects(session_key=self.session_key,
                                      expire_date__gt=datetime.now())[0]
+            self._session_saved(s)
             return self.decode(force_unicode(s.session_data))
         except (IndexError, SuspiciousOperation):
             self.create()
             return {}
 
     def exists(self, session_key):
-        return bool(MongoSession.objects(session_key=session_key).first())
+        sessions = MongoSession.objects(session_key=session_key)
+        return bool(sessions.only('session_key').first())
 
     def create(self):
         while True:
@@ -54,6 +78,13 @@ class SessionStore(SessionBase):
             if must_create:
                 raise CreateError
             raise
+        self._session_saved(s)
+
+    def _session_saved(self, session):
+        """Called with the session's document whenever it has been loaded
+        from or saved to the database.
+        """
+        pass
 
     def delete(self, session_key=None):
         if session_key is None:
@@ -61,3 +92,64 @@ class SessionStore(SessionBase):
                 return
             session_key = self.session_key
         MongoSession.objects(session_key=session_key).delete()
+
+    @classmethod
+    def clear_expired(cls):
+        """Delete expired sessions, as Django's ``clearsessions`` management
+        command expects of a session backend.
+        """
+        MongoSession.clear_expired()
+
+
+class CachedSessionStore(SessionStore):
+    """A session store that serves sessions from a cache, and writes them
+    through to MongoDB - so only sessions that aren't cached are loaded from
+    the database. Sessions are cached in-process by default; set
+    :attr:`cache` to a :class:`~mongoengine.cache.BaseCache` that stores
+    values in a shared cache (e.g. memcached) when several processes serve
+    the same sessions, or they may see each other's changes up to
+    :attr:`cache_timeout` seconds late.
+
+    .. versionadded:: 0.5
+    """
+
+    cache = LocalCache(max_entries=10000, timeout=None)
+    cache_timeout = 60
+
+    def _cache_key(self, session_key):
+        return 'mongoengine:session:%s' % session_key
+
+    def load(self):
+        cached = self.cache.get(self._cache_key(self.session_key))
+        if cached is None or cached['expire_date'] <= datetime.now():
+            return super(CachedSessionStore, self).load()
+        try:
+            return self.decode(force_unicode(cached['session_data']))
+        except SuspiciousOperation:
+            self.create()
+            return {}
+
+    def exists(self, session_key):
+        if self.cache.get(self._cache_key(session_key)) is not None:
+            return True
+        return super(CachedSessionStore, self).exists(session_key)
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            session_key = self.session_key
+        super(CachedSessionStore, self).delete(session_key)
+        if session_key is not None:
+            self.cache.delete(self._cache_key(session_key))
+
+    def _session_saved(self, session):
+        # Keep the session until it expires, or for cache_timeout seconds
+        expires_in = session.expire_date - datetime.now()
+        timeout = expires_in.days * 86400 + expires_in.seconds
+        if timeout <= 0:
+            return
+        cached = {
+            'session_data': session.session_data,
+            'expire_date': session.expire_date,
+        }
+        self.cache.set(self._cache_key(session.session_key), cached,
+                       min(timeout, self.cache_timeout))
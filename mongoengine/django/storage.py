@@ -9,9 +9,13 @@ from django.core.exceptions import ImproperlyConfigured
 
 
 class FileDocument(Document):
-    """A document used to store a single file in GridFS.
+    """A document used to store a single file in GridFS. The file's name is
+    stored on the document, and indexed, so files may be found by name with a
+    single query.
     """
+    filename = StringField()
     file = FileField()
+    meta = {'indexes': ['filename']}
 
 
 class GridFSStorage(Storage):
@@ -25,35 +29,34 @@ class GridFSStorage(Storage):
         self.base_url = base_url
         self.document = FileDocument
         self.field = 'file'
+        self.name_field = 'filename'
 
     def delete(self, name):
         """Deletes the specified file from the storage system.
         """
-        if self.exists(name):
-            doc = self.document.objects.first()
+        doc = self._get_doc_with_name(name)
+        if doc:
             field = getattr(doc, self.field)
-            self._get_doc_with_name(name).delete()  # Delete the FileField
-            field.delete()                          # Delete the FileDocument
+            field.delete()  # Delete the FileField
+            doc.delete()    # Delete the FileDocument
 
     def exists(self, name):
         """Returns True if a file referened by the given name already exists in the
         storage system, or False if the name is available for a new file.
         """
         doc = self._get_doc_with_name(name)
-        if doc:
-            field = getattr(doc, self.field)
-            return bool(field.name)
-        else:
-            return False
+        # The name is stored on the document, so the file's GridFS metadata
+        # needn't be fetched
+        return doc is not None and getattr(doc, self.field).grid_id is not None
 
     def listdir(self, path=None):
         """Lists the contents of the specified path, returning a 2-tuple of lists;
         the first item being directories, the second item being files.
         """
-        def name(doc):
-            return getattr(doc, self.field).name
-        docs = self.document.objects
-        return [], [name(d) for d in docs if name(d)]
+        docs = self.document.objects.only(self.name_field)
+        names = [getattr(d, self.name_field) for d in docs]
+        names += [name for doc, name in self._iter_unnamed_docs()]
+        return [], [name for name in names if name]
 
     def size(self, name):
         """Returns the total size, in bytes, of the file specified by name.
@@ -72,15 +75,43 @@ class GridFSStorage(Storage):
             raise ValueError("This file is not accessible via a URL.")
         return urlparse.urljoin(self.base_url, name).replace('\\', '/')
 
+    def backfill_names(self):
+        """Set the name field of the documents saved before it was added
+        from their files' GridFS names, so they are found with a single query.
+        Returns the number of documents updated.
+        """
+        count = 0
+        for doc, name in self._iter_unnamed_docs():
+            self._set_doc_name(doc, name)
+            count += 1
+        return count
+
+    def _iter_unnamed_docs(self):
+        """Yield the documents saved without the name field, and their files'
+        GridFS names, which have to be fetched one by one.
+        """
+        for doc in self.document.objects(**{self.name_field: None}):
+            name = getattr(doc, self.field).name
+            if name:
+                yield doc, name
+
+    def _set_doc_name(self, doc, name):
+        setattr(doc, self.name_field, name)
+        queryset = self.document.objects(pk=doc.pk)
+        queryset.update_one(**{'set__%s' % self.name_field: name})
+
     def _get_doc_with_name(self, name):
-        """Find the documents in the store with the given name
+        """Find the document in the store with the given name
         """
-        docs = self.document.objects
-        doc = [d for d in docs if getattr(d, self.field).name == name]
-        if doc:
-            return doc[0]
-        else:
-            return None
+        doc = self.document.objects(**{self.name_field: name}).first()
+        if doc is None:
+            # Documents saved before the name field was added are matched by
+            # their files' names, and given the field when found
+            for unnamed_doc, doc_name in self._iter_unnamed_docs():
+                if doc_name == name:
+                    self._set_doc_name(unnamed_doc, name)
+                    return unnamed_doc
+        return doc
 
     def _open(self, name, mode='rb'):
         doc = self._get_doc_with_name(name)
@@ -94,18 +125,25 @@ class GridFSStorage(Storage):
         available for new content to be written to.
         """
         file_root, file_ext = os.path.splitext(name)
+        # Fetch every name that starts with the file's root with one (indexed)
+        # query, rather than checking each candidate name in turn
+        query = {'%s__startswith' % self.name_field: file_root}
+        docs = self.document.objects(**query).only(self.name_field)
+        taken = set(getattr(d, self.name_field) for d in docs)
+        taken.update(name for doc, name in self._iter_unnamed_docs())
+
         # If the filename already exists, add an underscore and a number (before
         # the file extension, if one exists) to the filename until the generated
         # filename doesn't exist.
         count = itertools.count(1)
-        while self.exists(name):
+        while name in taken:
             # file_ext includes the dot.
             name = os.path.join("%s_%s%s" % (file_root, count.next(), file_ext))
 
         return name
 
     def _save(self, name, content):
-        doc = self.document()
+        doc = self.document(**{self.name_field: name})
         getattr(doc, self.field).put(content, filename=name)
         doc.save()
 
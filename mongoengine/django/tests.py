@@ -3,19 +3,53 @@ from django.test import TestCase
 from django.conf import settings
 
 from mongoengine import connect
+from mongoengine.cache import get_collection_versions
 
 class MongoTestCase(TestCase):
     """
     TestCase class that clear the collection between the tests
+
+    By default every collection is dropped after each test. With
+    ``clear_written_collections = True``, only the collections that the test
+    wrote to through MongoEngine are emptied, which keeps their indexes and
+    is much faster. Collections written to directly through PyMongo are not
+    noticed in that mode.
+
+    Set ``backend = 'memory'`` to run the tests against the in-memory backend
+    (:mod:`mongoengine.memory`) rather than a MongoDB server.
     """
     db_name = 'test_%s' % settings.MONGO_DATABASE_NAME
+    clear_written_collections = False
+    backend = None
+
     def __init__(self, methodName='runtest'):
-        self.db = connect(self.db_name)
+        self.db = connect(self.db_name, backend=self.backend)
         super(MongoTestCase, self).__init__(methodName)
 
+    def _pre_setup(self):
+        super(MongoTestCase, self)._pre_setup()
+        self._collection_versions = get_collection_versions()
+
     def _post_teardown(self):
         super(MongoTestCase, self)._post_teardown()
+        if self.clear_written_collections:
+            self._clear_written_collections()
+            return
         for collection in self.db.collection_names():
             if collection == 'system.indexes':
                 continue
             self.db.drop_collection(collection)
+
+    def _clear_written_collections(self):
+        """Remove every document from the collections whose versions have
+        changed since the test started.
+        """
+        prefix = '%s.' % self.db.name
+        for name, version in get_collection_versions().items():
+            if not name.startswith(prefix):
+                continue
+            if version == self._collection_versions.get(name, 0):
+                continue
+            collection = name[len(prefix):]
+            if not collection.startswith('system.'):
+                self.db[collection].remove({})
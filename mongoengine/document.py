@@ -1,13 +1,28 @@
 from base import (DocumentMetaclass, TopLevelDocumentMetaclass, BaseDocument,
-                  ValidationError)
-from queryset import OperationError
+                  ObjectIdField, ValidationError, get_document)
+from queryset import (QuerySet, OperationError, InvalidQueryError,
+                      _decompress_son_value)
 from connection import _get_db
+from cache import bump_collection_version
 
+import collections
+import csv
+import datetime
+import itertools
+import json
+import multiprocessing
+import time
 import pymongo
+import pymongo.json_util
+import pymongo.objectid
 
 
 __all__ = ['Document', 'EmbeddedDocument', 'ValidationError', 'OperationError']
 
+# The number of seconds to wait for a worker process to validate a chunk of
+# the documents being imported
+IMPORT_CHUNK_TIMEOUT = 600
+
 
 class EmbeddedDocument(BaseDocument):
     """A :class:`~mongoengine.Document` that isn't stored in its own
@@ -64,17 +79,37 @@ class Document(BaseDocument):
         If ``safe=True`` and the operation is unsuccessful, an 
         :class:`~mongoengine.OperationError` will be raised.
 
+        If the document was loaded with only some of its fields (see
+        :meth:`~mongoengine.queryset.QuerySet.only`), only the fields that
+        were loaded, or that have been assigned to since (including the
+        fields of embedded documents), are written. Lists that were sliced
+        or only partly loaded are only written when assigned to, so changes
+        made to them in place are not saved.
+
         :param safe: check if the operation succeeded before returning
         :param force_insert: only try to create a new document, don't allow 
             updates of existing documents
         :param validate: validates the document; set to ``False`` to skip.
+
+        .. versionchanged:: 0.5 - Partially loaded documents are updated
+            rather than overwritten
         """
         if validate:
             self.validate()
         doc = self.to_mongo()
+        collection = self.__class__.objects._collection
+        id_field = self._meta['id_field']
+        partial = self._loaded_fields is not None and not force_insert
+        if partial and '_id' not in doc:
+            raise OperationError('Cannot save a partially loaded document '
+                                 'without its id')
         try:
-            collection = self.__class__.objects._collection
-            if force_insert:
+            if partial:
+                object_id = doc['_id']
+                update = self._get_partial_update(doc)
+                if update:
+                    collection.update({'_id': object_id}, update, safe=safe)
+            elif force_insert:
                 object_id = collection.insert(doc, safe=safe)
             else:
                 object_id = collection.save(doc, safe=safe)
@@ -83,9 +118,63 @@ class Document(BaseDocument):
             if u'duplicate key' in unicode(err):
                 message = u'Tried to save duplicate unique keys (%s)'
             raise OperationError(message % unicode(err))
-        id_field = self._meta['id_field']
+        finally:
+            bump_collection_version(collection.full_name)
         self[id_field] = self._fields[id_field].to_python(object_id)
 
+        if partial:
+            for name in self._changed_fields:
+                self._loaded_fields[name] = True
+        self._changed_fields = set()
+
+    def _get_partial_update(self, doc):
+        """Build the update that saves a partially loaded document, given the
+        document as a PyMongo SON: the fields that were fully loaded or have
+        been assigned to are set (or unset, if they have no value), as are
+        the parts of embedded documents that were loaded or assigned to.
+        Parts of lists are never written, so sliced lists are left as they
+        are.
+        """
+        set_fields = {}
+        unset_fields = {}
+        for name, field in self._fields.items():
+            if name == self._meta['id_field']:
+                continue
+            paths = [field.db_field]
+            if not self._is_field_loaded(name):
+                paths = ['%s.%s' % (field.db_field, subpath)
+                         for subpath in self._loaded_fields.get(name, [])]
+                paths += _get_changed_paths(self._data.get(name),
+                                            field.db_field)
+                # Leave out paths inside others, which MongoDB won't set
+                # in the same update
+                paths = [path for path in set(paths)
+                         if not [other for other in paths
+                                 if path.startswith(other + '.')]]
+
+            for path in paths:
+                value = doc
+                for part in path.split('.'):
+                    if isinstance(value, list):
+                        # A field inside a list can't be set on its own
+                        break
+                    if isinstance(value, dict):
+                        value = value.get(part)
+                    else:
+                        value = None
+                else:
+                    if value is None:
+                        unset_fields[path] = 1
+                    else:
+                        set_fields[path] = value
+
+        update = {}
+        if set_fields:
+            update['$set'] = set_fields
+        if unset_fields:
+            update['$unset'] = unset_fields
+        return update
+
     def delete(self, safe=False):
         """Delete the :class:`~mongoengine.Document` from the database. This
         will only take effect if the document has been previously saved.
@@ -100,6 +189,29 @@ class Document(BaseDocument):
             message = u'Could not delete document (%s)' % err.message
             raise OperationError(message)
 
+    def modify(self, **update):
+        """Atomically update this :class:`~mongoengine.Document` in the
+        database and refresh its fields with the result, in a single round
+        trip. Returns ``False`` if the document no longer exists. ::
+
+            counter.modify(inc__value=1)
+
+        :param update: Django-style update keyword arguments
+
+        .. versionadded:: 0.5
+        """
+        id_field = self._meta['id_field']
+        object_id = self._fields[id_field].to_mongo(self[id_field])
+        queryset = self.__class__.objects(**{id_field: object_id})
+        obj = queryset.modify(new=True, **update)
+        if obj is None:
+            return False
+        for field in self._fields:
+            setattr(self, field, obj[field])
+        self._loaded_fields = None
+        self._changed_fields = set()
+        return True
+
     def reload(self):
         """Reloads all attributes from the database.
 
@@ -109,6 +221,8 @@ class Document(BaseDocument):
         obj = self.__class__.objects(**{id_field: self[id_field]}).first()
         for field in self._fields:
             setattr(self, field, obj[field])
+        self._loaded_fields = None
+        self._changed_fields = set()
 
     @classmethod
     def drop_collection(cls):
@@ -117,6 +231,332 @@ class Document(BaseDocument):
         """
         db = _get_db()
         db.drop_collection(cls._meta['collection'])
+        bump_collection_version(db[cls._meta['collection']].full_name)
+
+    @classmethod
+    def export(cls, path, format='jsonl', query=None, fields=None,
+               batch_size=1000):
+        """Write the documents in this :class:`~mongoengine.Document`\ 's
+        collection to a file, as JSON lines or CSV. The documents are
+        streamed from the database as raw dictionaries, so memory use doesn't
+        grow with the size of the collection. Returns a dictionary of
+        statistics: the number of ``documents`` written, the ``seconds``
+        taken and the ``documents_per_second``.
+
+        JSON lines files contain a document per line, in MongoDB's extended
+        JSON format, so they may be read back without loss by
+        :meth:`~mongoengine.Document.import_`. CSV files have a header row of
+        field names; the values of string, date and id fields are written as
+        they are, and other values (including any ids and dates within them)
+        as extended JSON. The values of compressed fields are written
+        decompressed in either format.
+
+        :param path: the path of the file to write
+        :param format: ``'jsonl'`` or ``'csv'``
+        :param query: a :class:`~mongoengine.queryset.QuerySet`, or a
+            dictionary of query keyword arguments, selecting the documents to
+            export
+        :param fields: a list of the fields to export; defaults to all fields
+        :param batch_size: the number of documents to fetch from the server
+            in each batch
+
+        .. versionadded:: 0.5
+        """
+        if format not in ('jsonl', 'csv'):
+            raise ValueError('Unknown export format "%s"' % format)
+
+        queryset = query
+        if not isinstance(queryset, QuerySet):
+            queryset = cls.objects(**(query or {}))
+
+        if fields is None:
+            id_field = cls._meta['id_field']
+            fields = [id_field] + sorted(name for name in cls._fields
+                                         if name != id_field)
+        for name in fields:
+            if name not in cls._fields:
+                raise InvalidQueryError('Cannot resolve field "%s"' % name)
+        names, fields = fields, [cls._fields[name] for name in fields]
+
+        projection = [field.db_field for field in fields]
+        if format == 'jsonl' and cls._meta.get('allow_inheritance', True):
+            projection += ['_cls', '_types']
+        query = queryset._query
+        if queryset._where_clause:
+            query = dict(query, **{'$where': queryset._where_clause})
+        cursor = queryset._collection.find(query, fields=projection)
+        if hasattr(cursor, 'batch_size'):
+            cursor.batch_size(batch_size)
+
+        start = time.time()
+        count = 0
+        output = open(path, 'wb')
+        try:
+            if format == 'jsonl':
+                for son in cursor:
+                    for field in fields:
+                        if field.db_field in son:
+                            son[field.db_field] = _decompress_son_value(
+                                field, son[field.db_field])
+                    output.write(json.dumps(son,
+                                            default=pymongo.json_util.default))
+                    output.write('\n')
+                    count += 1
+            else:
+                writer = csv.writer(output)
+                writer.writerow(names)
+                for son in cursor:
+                    writer.writerow([_to_csv_value(field, _decompress_son_value(
+                                         field, son.get(field.db_field)))
+                                     for field in fields])
+                    count += 1
+        finally:
+            output.close()
+        return _transfer_stats(count, start)
+
+    @classmethod
+    def import_(cls, path, format=None, chunk_size=1000, validate=True,
+                processes=None):
+        """Insert the documents in a file written by
+        :meth:`~mongoengine.Document.export` into this
+        :class:`~mongoengine.Document`\ 's collection. The file is read
+        lazily and the documents are inserted in chunks using
+        :meth:`~mongoengine.queryset.QuerySet.insert`\ 's bulk insert path.
+        Given ``processes``, later chunks are decoded and validated by a pool
+        of worker processes meanwhile, with at most two chunks per process
+        read ahead of those inserted. If a worker takes longer than
+        ``IMPORT_CHUNK_TIMEOUT`` seconds over a chunk (e.g. because it died),
+        an :class:`~mongoengine.queryset.OperationError` is raised.
+        Returns a dictionary of statistics: the number of ``documents``
+        inserted, the ``seconds`` taken and the ``documents_per_second``.
+
+        If a document fails validation, a
+        :class:`~mongoengine.ValidationError` is raised; the chunks before it
+        will already have been inserted.
+
+        :param path: the path of the file to read
+        :param format: ``'jsonl'`` or ``'csv'``; by default, CSV is assumed
+            for paths ending in ``.csv``
+        :param chunk_size: the number of documents to insert at a time
+        :param validate: validates the documents; set to ``False`` to skip.
+        :param processes: the number of worker processes to validate
+            documents with; by default (or with ``0``) documents are
+            validated in this process
+
+        .. versionadded:: 0.5
+        .. versionchanged:: 0.5 - the worker processes are sent the lines
+            of the file, rather than the decoded documents
+        """
+        if format is None:
+            format = path.lower().endswith('.csv') and 'csv' or 'jsonl'
+        if format not in ('jsonl', 'csv'):
+            raise ValueError('Unknown import format "%s"' % format)
+
+        start = time.time()
+        count = 0
+        pool = None
+        input = open(path, 'rb')
+        try:
+            # The records are only decoded by _decode_chunk, so that the
+            # worker processes are sent plain strings: documents decoded from
+            # extended JSON may hold values that can't be pickled
+            header = None
+            if format == 'jsonl':
+                records = (line for line in input if line.strip())
+            else:
+                records = csv.reader(input)
+                header = _read_csv_header(cls, records)
+
+            tasks = ((cls.__name__, format, header, chunk)
+                     for chunk in _iter_chunks(records, chunk_size))
+            if not validate:
+                chunks = itertools.imap(_decode_chunk, tasks)
+            elif not processes:
+                chunks = itertools.imap(_validate_chunk, tasks)
+            else:
+                pool = multiprocessing.Pool(processes)
+                chunks = _imap_bounded(pool, _validate_chunk_as_json, tasks,
+                                       processes * 2, IMPORT_CHUNK_TIMEOUT)
+                chunks = (json.loads(chunk,
+                                     object_hook=pymongo.json_util.object_hook)
+                          for chunk in chunks)
+
+            for chunk in chunks:
+                cls.objects._insert_raw(chunk)
+                count += len(chunk)
+        finally:
+            input.close()
+            if pool is not None:
+                pool.terminate()
+        return _transfer_stats(count, start)
+
+
+def _transfer_stats(count, start):
+    """Return the statistics reported by exports and imports.
+    """
+    elapsed = time.time() - start
+    rate = 0.0
+    if elapsed:
+        rate = count / elapsed
+    return {'documents': count, 'seconds': elapsed,
+            'documents_per_second': rate}
+
+
+def _iter_chunks(iterable, size):
+    """Yield lists of up to ``size`` items from ``iterable``.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def _get_changed_paths(value, prefix):
+    """Return the paths, below ``prefix``, of the fields that have been
+    assigned to on an embedded document (or those embedded in it) since it
+    was loaded.
+    """
+    paths = []
+    if isinstance(value, EmbeddedDocument):
+        for name, field in value._fields.items():
+            path = '%s.%s' % (prefix, field.db_field)
+            if name in value._changed_fields:
+                paths.append(path)
+            else:
+                paths += _get_changed_paths(value._data.get(name), path)
+    return paths
+
+
+def _imap_bounded(pool, func, iterable, window, timeout):
+    """Yield ``func`` applied to each item of ``iterable`` by a process pool,
+    in order. Unlike ``pool.imap``, which reads the whole of ``iterable``
+    ahead of the results, at most ``window`` items are in flight at a time.
+    The pool loses the item of a worker that dies, so waiting on each result
+    gives up after ``timeout`` seconds.
+    """
+    def get_result(result):
+        try:
+            return result.get(timeout)
+        except multiprocessing.TimeoutError:
+            raise OperationError('No result from a worker process in %s '
+                                 'seconds' % timeout)
+
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield get_result(pending.popleft())
+    while pending:
+        yield get_result(pending.popleft())
+
+
+def _decode_chunk(task):
+    """Decode a chunk of records being imported into raw documents. The task
+    is a tuple of the document class's name, the format of the file, its CSV
+    header (if any) and the records: lines of extended JSON, or CSV rows.
+    """
+    class_name, format, header, records = task
+    if format == 'jsonl':
+        return [json.loads(line, object_hook=pymongo.json_util.object_hook)
+                for line in records]
+
+    cls = get_document(class_name)
+    fields = [cls._fields[name] for name in header]
+
+    # Documents exported as CSV don't keep their type information, so they
+    # are all imported as instances of the given class
+    types = {}
+    if cls._meta.get('allow_inheritance', True):
+        types = {'_cls': cls._class_name,
+                 '_types': cls._superclasses.keys() + [cls._class_name]}
+
+    sons = []
+    for row in records:
+        son = dict(types)
+        for field, value in zip(fields, row):
+            if value != '':
+                son[field.db_field] = _from_csv_value(field, value)
+        sons.append(son)
+    return sons
+
+
+def _validate_chunk(task):
+    """Decode and validate a chunk of documents being imported, given as
+    for :func:`_decode_chunk`, returning them ready for insertion.
+    """
+    cls = get_document(task[0])
+    validated = []
+    for son in _decode_chunk(task):
+        try:
+            doc = cls._from_son(son)
+        except (TypeError, ValueError), err:
+            raise ValidationError('Could not load document (%s)' % err)
+        doc.validate()
+        validated.append(doc.to_mongo())
+    return validated
+
+
+def _validate_chunk_as_json(task):
+    """Run :func:`_validate_chunk` in the worker processes used by
+    :meth:`~mongoengine.Document.import_`, returning the documents as extended
+    JSON, as the values they hold can't all be pickled.
+    """
+    return json.dumps(_validate_chunk(task), default=pymongo.json_util.default)
+
+
+def _to_csv_value(field, value):
+    """Convert a value from a raw document to a CSV cell. Only the values of
+    string, date and id fields are written as they are; :func:`_from_csv_value`
+    reads any other value as extended JSON, so ids and dates in lists, dicts
+    and references survive the round trip.
+    """
+    from fields import StringField, DateTimeField
+
+    if value is None:
+        return ''
+    if isinstance(field, StringField):
+        return unicode(value).encode('utf-8')
+    if isinstance(field, DateTimeField) and \
+       isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(field, ObjectIdField) and \
+       isinstance(value, pymongo.objectid.ObjectId):
+        return str(value)
+    return json.dumps(value, default=pymongo.json_util.default)
+
+
+def _from_csv_value(field, value):
+    """Convert a CSV cell written by :func:`_to_csv_value` back to a value.
+    """
+    from fields import StringField, DateTimeField
+
+    if isinstance(field, StringField):
+        return value.decode('utf-8')
+    if isinstance(field, DateTimeField):
+        format = '%Y-%m-%dT%H:%M:%S'
+        if '.' in value:
+            format += '.%f'
+        return datetime.datetime.strptime(value, format)
+    if isinstance(field, ObjectIdField):
+        return pymongo.objectid.ObjectId(value)
+    return json.loads(value, object_hook=pymongo.json_util.object_hook)
+
+
+def _read_csv_header(cls, reader):
+    """Read the header row of a CSV file written by
+    :meth:`~mongoengine.Document.export`, returning the names of its fields.
+    Empty cells in the rows after it are left out when they're decoded.
+    """
+    try:
+        header = reader.next()
+    except StopIteration:
+        return []
+    for name in header:
+        if name not in cls._fields:
+            raise InvalidQueryError('Cannot resolve field "%s"' % name)
+    return header
 
 
 class MapReduceDocument(object):
@@ -128,32 +568,45 @@ class MapReduceDocument(object):
                 an ``ObjectId`` found in the given ``collection``, 
                 the object can be accessed via the ``object`` property.
     :param value: The result(s) for this key.
+    :param batch: a list of the results whose objects are loaded together
+        with this one's
 
     .. versionadded:: 0.3
     """
 
-    def __init__(self, document, collection, key, value):
+    def __init__(self, document, collection, key, value, batch=None):
         self._document = document
         self._collection = collection
         self.key = key
         self.value = value
+        if batch is None:
+            batch = [self]
+        self._batch = batch
 
     @property
     def object(self):
         """Lazy-load the object referenced by ``self.key``. ``self.key`` 
-        should be the ``primary_key``.
+        should be the ``primary_key``. The objects referenced by the other
+        results in the same batch are loaded at the same time, in a single
+        query. ``None`` is given if there is no such object.
+
+        .. versionchanged:: 0.5 - Objects are loaded in batches
         """
-        id_field = self._document()._meta['id_field']
-        id_field_type = type(id_field)
-
-        if not isinstance(self.key, id_field_type):
-            try:
-                self.key = id_field_type(self.key)
-            except:
-                raise Exception("Could not cast key as %s" % \
-                                id_field_type.__name__)
-
-        if not hasattr(self, "_key_object"):
-            self._key_object = self._document.objects.with_id(self.key)
-            return self._key_object
+        if not hasattr(self, '_key_object'):
+            id_field = self._document._meta['id_field']
+            id_field = self._document._fields[id_field]
+
+            pending = [doc for doc in self._batch
+                       if not hasattr(doc, '_key_object')]
+            keys = []
+            for doc in pending:
+                try:
+                    keys.append(id_field.to_mongo(doc.key))
+                except ValidationError:
+                    keys.append(None)
+
+            objects = self._document.objects.in_bulk(
+                [key for key in keys if key is not None])
+            for doc, key in zip(pending, keys):
+                doc._key_object = objects.get(key)
         return self._key_object
@@ -1,16 +1,27 @@
 from base import BaseField, ObjectIdField, ValidationError, get_document
 from document import Document, EmbeddedDocument
 from connection import _get_db
+from compression import (COMPRESS_THRESHOLD, get_codec, compress_value,
+                         is_compressed, decompress_value)
+from cache import bump_collection_version
 from operator import itemgetter
 
 import re
 import pymongo
+import pymongo.database
 import pymongo.dbref
+import pymongo.errors
 import pymongo.son
 import pymongo.binary
 import datetime
 import decimal
 import gridfs
+import hashlib
+import mmap
+import os
+import StringIO
+import tempfile
+from multiprocessing.pool import ThreadPool
 import warnings
 import types
 
@@ -23,20 +34,78 @@ __all__ = ['StringField', 'IntField', 'FloatField', 'BooleanField',
 
 RECURSIVE_REFERENCE_CONSTANT = 'self'
 
+# The update operators whose values are stored (or matched against stored
+# values) as they are, so must be compressed for compressed fields
+_COMPRESSED_UPDATE_OPS = ('set', 'push', 'pushAll', 'addToSet', 'pull',
+                          'pullAll')
+
+
+class _CompressedValue(object):
+    """A compressed value loaded from the database, which is decompressed
+    when its field is first accessed.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+
+def _load_compressed(field, instance):
+    """Decompress a field's value on a document, if it is still compressed.
+    """
+    value = instance._data.get(field.name)
+    if isinstance(value, _CompressedValue):
+        instance._data[field.name] = field._decompress(value.data)
+
 
 class StringField(BaseField):
     """A unicode string field.
+
+    :param compress: compress values of at least ``compress_threshold``
+        bytes (encoded as UTF-8) - ``True`` for zlib, or a
+        :class:`~mongoengine.compression.BaseCodec` or the name of a
+        registered one. Compressed values are only decompressed when they
+        are first accessed, and can't be queried. Values written by updates
+        (e.g. ``set__body=...``) are compressed too.
+    :param compress_threshold: the size, in bytes, below which values are
+        stored uncompressed
+
+    .. versionchanged:: 0.5 - added ``compress`` and ``compress_threshold``
     """
 
-    def __init__(self, regex=None, max_length=None, min_length=None, **kwargs):
+    def __init__(self, regex=None, max_length=None, min_length=None,
+                 compress=False, compress_threshold=COMPRESS_THRESHOLD,
+                 **kwargs):
         self.regex = re.compile(regex) if regex else None
         self.max_length = max_length
         self.min_length = min_length
+        self.codec = get_codec(compress)
+        self.compress_threshold = compress_threshold
         super(StringField, self).__init__(**kwargs)
 
+    def __get__(self, instance, owner):
+        if instance is not None:
+            _load_compressed(self, instance)
+        return super(StringField, self).__get__(instance, owner)
+
+    def to_mongo(self, value):
+        value = unicode(value)
+        if self.codec is not None:
+            data = value.encode('utf-8')
+            if len(data) >= self.compress_threshold:
+                return compress_value(data, self.codec)
+        return value
+
     def to_python(self, value):
+        if is_compressed(value):
+            # Values inside lists and dicts can't be decompressed lazily
+            if self.name is None:
+                return self._decompress(value)
+            return _CompressedValue(value)
         return unicode(value)
 
+    def _decompress(self, value):
+        return decompress_value(value).decode('utf-8')
+
     def validate(self, value):
         assert isinstance(value, (str, unicode))
 
@@ -54,6 +123,9 @@ class StringField(BaseField):
         return None
 
     def prepare_query_value(self, op, value):
+        if self.codec is not None and op in _COMPRESSED_UPDATE_OPS and \
+           value is not None:
+            return self.to_mongo(value)
         if not isinstance(op, basestring):
             return value
 
@@ -527,19 +599,50 @@ class GenericReferenceField(BaseField):
 
 class BinaryField(BaseField):
     """A binary data field.
+
+    :param compress: compress values of at least ``compress_threshold``
+        bytes, as for :class:`~mongoengine.StringField`
+    :param compress_threshold: the size, in bytes, below which values are
+        stored uncompressed
+
+    .. versionchanged:: 0.5 - added ``compress`` and ``compress_threshold``
     """
 
-    def __init__(self, max_bytes=None, **kwargs):
+    def __init__(self, max_bytes=None, compress=False,
+                 compress_threshold=COMPRESS_THRESHOLD, **kwargs):
         self.max_bytes = max_bytes
+        self.codec = get_codec(compress)
+        self.compress_threshold = compress_threshold
         super(BinaryField, self).__init__(**kwargs)
 
+    def __get__(self, instance, owner):
+        if instance is not None:
+            _load_compressed(self, instance)
+        return super(BinaryField, self).__get__(instance, owner)
+
     def to_mongo(self, value):
+        if self.codec is not None and len(value) >= self.compress_threshold:
+            return compress_value(str(value), self.codec)
         return pymongo.binary.Binary(value)
 
     def to_python(self, value):
+        if is_compressed(value):
+            # Values inside lists and dicts can't be decompressed lazily
+            if self.name is None:
+                return self._decompress(value)
+            return _CompressedValue(value)
         # Returns str not unicode as this is binary data
         return str(value)
 
+    def _decompress(self, value):
+        return decompress_value(value)
+
+    def prepare_query_value(self, op, value):
+        if self.codec is not None and op in _COMPRESSED_UPDATE_OPS and \
+           value is not None:
+            return self.to_mongo(value)
+        return value
+
     def validate(self, value):
         assert isinstance(value, str)
 
@@ -551,16 +654,74 @@ class GridFSError(Exception):
     pass
 
 
+GRIDFS_CHUNK_SIZE = 256 * 1024
+
+# Files larger than this are spooled to disk while they are hashed for
+# deduplication
+DEDUP_SPOOL_SIZE = 4 * 1024 * 1024
+
+# GridFS file attributes that PyMongo accepts under Python-style names
+_GRIDFS_ALIASES = {'content_type': 'contentType'}
+
+_gridfs = {}
+
+
+def _get_gridfs(collection_name='fs'):
+    """Return the shared :class:`gridfs.GridFS` instance for a collection
+    prefix on the current database, creating it on first use. GridFS needs
+    a PyMongo database, so other backends raise
+    :class:`~pymongo.errors.OperationFailure`.
+    """
+    db = _get_db()
+    if not isinstance(db, pymongo.database.Database):
+        raise pymongo.errors.OperationFailure('GridFS is not supported by '
+                                              'the %s backend' %
+                                              db.__class__.__name__)
+    key = (id(db), collection_name)
+    cached = _gridfs.get(key)
+    # The database is kept with its GridFS so a reconnection (which creates a
+    # new database object) can't be served an instance for the old one
+    if cached is None or cached[0] is not db:
+        cached = (db, gridfs.GridFS(db, collection_name))
+        _gridfs[key] = cached
+    return cached[1]
+
+
 class GridFSProxy(object):
     """Proxy object to handle writing and reading of files to and from GridFS
 
+    The file is opened once, and reads share its position, so large files may
+    be streamed with :meth:`iter_chunks`, :meth:`readinto` or :meth:`seek` and
+    ``read(size)`` without loading them into memory.
+
     .. versionadded:: 0.4
+
+    .. versionchanged:: 0.5 - the open file is cached, and ranged and
+       chunked reads were added
+    .. versionchanged:: 0.5 - added ``collection_name``; the GridFS instance
+       is shared and only looked up when the file is used
+    .. versionchanged:: 0.5 - added ``dedup``
+    .. versionchanged:: 0.5 - added ``compress`` and ``compress_threshold``
     """
 
-    def __init__(self, grid_id=None):
-        self.fs = gridfs.GridFS(_get_db())  # Filesystem instance
-        self.newfile = None                 # Used for partial writes
-        self.grid_id = grid_id              # Store GridFS id for file
+    def __init__(self, grid_id=None, collection_name='fs', dedup=False,
+                 compress=False, compress_threshold=COMPRESS_THRESHOLD):
+        self.collection_name = collection_name  # GridFS collection prefix
+        self.dedup = dedup                      # Share files by content
+        self.codec = get_codec(compress)        # Compress files' chunks
+        self.compress_threshold = compress_threshold
+        self.newfile = None                     # Used for partial writes
+        self.grid_id = grid_id                  # Store GridFS id for file
+        self.gridout = None                     # The file, once opened
+        self._fs = None
+
+    @property
+    def fs(self):
+        """The (shared) GridFS instance the file is stored in.
+        """
+        if self._fs is None:
+            self._fs = _get_gridfs(self.collection_name)
+        return self._fs
 
     def __getattr__(self, name):
         obj = self.get()
@@ -574,21 +735,295 @@ class GridFSProxy(object):
     def get(self, id=None):
         if id:
             self.grid_id = id
-        try:
-            return self.fs.get(id or self.grid_id)
-        except:
-            # File has been deleted
-            return None
+            self.gridout = None
+        if self.gridout is None:
+            try:
+                gridout = self.fs.get(self.grid_id)
+            except:
+                # File has been deleted
+                return None
+            compression = getattr(gridout, 'compression', None)
+            if compression is not None:
+                chunks = _get_db()[self.collection_name].chunks
+                gridout = _CompressedGridOut(gridout, chunks,
+                                             get_codec(compression))
+            self.gridout = gridout
+        return self.gridout
 
     def new_file(self, **kwargs):
         self.newfile = self.fs.new_file(**kwargs)
         self.grid_id = self.newfile._id
+        self.gridout = None
+        self._bump_collection_versions()
+
+    def _bump_collection_versions(self):
+        """Mark the GridFS collections as changed, as for writes through
+        querysets.
+        """
+        db = _get_db()
+        bump_collection_version(db[self.collection_name].files.full_name)
+        bump_collection_version(db[self.collection_name].chunks.full_name)
 
     def put(self, file, **kwargs):
         if self.grid_id:
             raise GridFSError('This document already has a file. Either delete '
                               'it or call replace to overwrite it')
-        self.grid_id = self.fs.put(file, **kwargs)
+        if self.dedup:
+            self.grid_id = self._put_dedup(file, self._store, **kwargs)
+        else:
+            self.grid_id = self._store(file, **kwargs)
+        self.gridout = None
+        self._bump_collection_versions()
+
+    def _store(self, file, **kwargs):
+        """Store a file in GridFS, compressing its chunks if the field
+        compresses files, and return its id.
+        """
+        if self.codec is not None:
+            return self._put_chunks(file, **kwargs)
+        return self.fs.put(file, **kwargs)
+
+    def _put_dedup(self, file, store, **kwargs):
+        """Store a file with ``store`` unless a file with the same content is
+        already stored, in which case its reference count is increased and its
+        id is returned instead. Content is hashed as it is read, and spooled
+        to a temporary file if it is large. Attributes given for the file must
+        match those of a stored file it would share, or a
+        :class:`GridFSError` is raised.
+        """
+        digest = hashlib.sha256()
+        if isinstance(file, basestring):
+            digest.update(file)
+        else:
+            spool = tempfile.SpooledTemporaryFile(max_size=DEDUP_SPOOL_SIZE)
+            while True:
+                data = file.read(GRIDFS_CHUNK_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                spool.write(data)
+            spool.seek(0)
+            file = spool
+        digest = digest.hexdigest()
+
+        files = _get_db()[self.collection_name].files
+        files.ensure_index('sha256')
+        # Files whose count has dropped to zero are being deleted, so they
+        # can't be shared
+        query = {'sha256': digest, 'refcount': {'$gt': 0}}
+        attributes = dict((_GRIDFS_ALIASES.get(key, key), value)
+                          for key, value in kwargs.items())
+        existing = self._modify_file(dict(query, **attributes),
+                                     {'$inc': {'refcount': 1}})
+        if existing is not None:
+            return existing['_id']
+        if files.find_one(query) is not None:
+            # A shared file only has one set of attributes, which can't be
+            # changed for the documents already using it
+            raise GridFSError('A file with the same content is already '
+                              'stored with different attributes')
+        return store(file, sha256=digest, refcount=1, **kwargs)
+
+    def _modify_file(self, query, update):
+        """Atomically update a file's GridFS document, returning the updated
+        document, or ``None`` if no file matched.
+        """
+        files = _get_db()[self.collection_name].files
+        command = pymongo.son.SON([
+            ('findandmodify', files.name),
+            ('query', query),
+            ('update', update),
+            ('new', True),
+        ])
+        try:
+            return files.database.command(command).get('value')
+        except pymongo.errors.OperationFailure, err:
+            # Older servers report a miss as an error rather than a null value
+            if u'No matching object found' in unicode(err):
+                return None
+            raise
+
+    def parallel_put(self, file, workers=4, chunk_size=GRIDFS_CHUNK_SIZE,
+                     chunks_per_task=16, **kwargs):
+        """Store a file like :meth:`put`, uploading ranges of its GridFS
+        chunks concurrently on ``workers`` threads. Once every chunk is
+        stored, their MD5 is checked with the server's ``filemd5`` command,
+        and only then is the file's document written - so the file can't be
+        read before it is complete, and a failed upload leaves no file
+        behind.
+
+        :param file: a string or file-like object to store
+        :param workers: the number of threads to upload with
+        :param chunk_size: the size of the file's GridFS chunks, in bytes
+        :param chunks_per_task: the number of chunks each thread inserts at
+            once
+        :param kwargs: attributes to store with the file (e.g.
+            ``content_type``), as for :meth:`put`
+
+        .. versionadded:: 0.5
+        """
+        if self.grid_id:
+            raise GridFSError('This document already has a file. Either delete '
+                              'it or call replace to overwrite it')
+
+        def store(file, **kwargs):
+            return self._put_chunks(file, workers, chunk_size,
+                                    chunks_per_task, **kwargs)
+
+        if self.dedup:
+            self.grid_id = self._put_dedup(file, store, **kwargs)
+        else:
+            self.grid_id = store(file, **kwargs)
+        self.gridout = None
+        self._bump_collection_versions()
+
+    def _put_chunks(self, file, workers=1, chunk_size=GRIDFS_CHUNK_SIZE,
+                    chunks_per_task=16, **kwargs):
+        """Store a file by inserting its chunks on ``workers`` threads,
+        compressing each chunk if the field compresses files, and return its
+        id. The file's document is written last.
+        """
+        if isinstance(file, basestring):
+            file = StringIO.StringIO(file)
+
+        db = _get_db()
+        self.fs  # Make sure GridFS has indexed the chunks
+        chunks = db[self.collection_name].chunks
+        file_id = kwargs.pop('_id', None) or pymongo.objectid.ObjectId()
+        md5 = hashlib.md5()
+        length = 0
+        codec = self.codec
+
+        def insert_chunks(docs):
+            chunks.insert(docs, safe=True)
+
+        pool = ThreadPool(workers)
+        try:
+            try:
+                # Read the file into ranges of chunks as they are uploaded,
+                # with a bounded number of ranges waiting in memory
+                pending = []
+                n = 0
+                finished = False
+                while not finished:
+                    docs = []
+                    while len(docs) < chunks_per_task:
+                        data = _read_exactly(file, chunk_size)
+                        if not data:
+                            finished = True
+                            break
+                        if n == 0 and len(data) < min(chunk_size,
+                                                      self.compress_threshold):
+                            # The whole file is too small to compress
+                            codec = None
+                        length += len(data)
+                        if codec is not None:
+                            data = codec.compress(data)
+                        md5.update(data)
+                        docs.append({'files_id': file_id, 'n': n,
+                                     'data': pymongo.binary.Binary(data)})
+                        n += 1
+                    if docs:
+                        pending.append(pool.apply_async(insert_chunks, (docs,)))
+                    while len(pending) > workers * 2:
+                        pending.pop(0).get()
+                for result in pending:
+                    result.get()
+            finally:
+                pool.close()
+                pool.join()
+
+            command = pymongo.son.SON([('filemd5', file_id),
+                                       ('root', self.collection_name)])
+            server_md5 = db.command(command)['md5']
+            if server_md5 != md5.hexdigest():
+                raise GridFSError('MD5 of the uploaded file does not match '
+                                  '(%s stored, %s sent)'
+                                  % (server_md5, md5.hexdigest()))
+        except:
+            chunks.remove({'files_id': file_id})
+            raise
+
+        file_doc = {
+            '_id': file_id,
+            'length': length,
+            'chunkSize': chunk_size,
+            'uploadDate': datetime.datetime.utcnow(),
+            'md5': md5.hexdigest(),
+        }
+        if codec is not None:
+            # Chunks hold chunk_size bytes each once they are decompressed
+            file_doc['compression'] = codec.name
+        for key, value in kwargs.items():
+            file_doc[_GRIDFS_ALIASES.get(key, key)] = value
+        db[self.collection_name].files.insert(file_doc, safe=True)
+        return file_id
+
+    def parallel_download(self, path, workers=4, chunks_per_task=16):
+        """Write the file to ``path``, fetching ranges of its GridFS chunks
+        concurrently on ``workers`` threads. Chunks are copied straight into
+        a memory-mapped output file, and the file's MD5 is checked once it is
+        complete (compressed files are checked by decompressing each chunk
+        instead). Returns the number of bytes written.
+
+        .. versionadded:: 0.5
+        """
+        gridout = self.get()
+        if gridout is None:
+            raise GridFSError('There is no file to download')
+        length, chunk_size = gridout.length, gridout.chunk_size
+        chunks = _get_db()[self.collection_name].chunks
+        codec = None
+        if isinstance(gridout, _CompressedGridOut):
+            codec = gridout.codec
+        count = (length + chunk_size - 1) // chunk_size
+        ranges = [(start, min(start + chunks_per_task, count))
+                  for start in xrange(0, count, chunks_per_task)]
+
+        output = open(path, 'w+b')
+        try:
+            if not length:
+                return 0
+            output.truncate(length)
+            mapped = mmap.mmap(output.fileno(), length)
+            try:
+                def fetch_chunks(bounds):
+                    start, end = bounds
+                    query = {'files_id': self.grid_id,
+                             'n': {'$gte': start, '$lt': end}}
+                    fetched = 0
+                    for chunk in chunks.find(query):
+                        offset = chunk['n'] * chunk_size
+                        data = chunk['data']
+                        if codec is not None:
+                            data = codec.decompress(str(data))
+                        mapped[offset:offset + len(data)] = data
+                        fetched += 1
+                    if fetched != end - start:
+                        raise GridFSError('Chunks %d to %d of the file are '
+                                          'incomplete' % (start, end - 1))
+
+                pool = ThreadPool(workers)
+                try:
+                    pool.map(fetch_chunks, ranges)
+                finally:
+                    pool.close()
+                    pool.join()
+
+                md5 = getattr(gridout, 'md5', None)
+                if md5 is not None and codec is None:
+                    digest = hashlib.md5()
+                    for offset in xrange(0, length, chunk_size):
+                        digest.update(mapped[offset:offset + chunk_size])
+                    if digest.hexdigest() != md5:
+                        raise GridFSError('MD5 of the downloaded file does '
+                                          'not match')
+                mapped.flush()
+            finally:
+                mapped.close()
+        finally:
+            output.close()
+        return length
 
     def write(self, string):
         if self.grid_id:
@@ -605,16 +1040,86 @@ class GridFSProxy(object):
             self.grid_id = self.newfile._id
         self.newfile.writelines(lines) 
 
-    def read(self):
+    def read(self, size=-1):
+        """Read the file. With no ``size``, the whole file is returned;
+        otherwise up to ``size`` bytes are read from the current position.
+        Returns ``None`` if there is no file.
+        """
+        gridout = self.get()
+        if gridout is None:
+            return None
         try:
-            return self.get().read()
+            if size < 0:
+                gridout.seek(0)
+            return gridout.read(size)
         except:
             return None
 
+    def seek(self, pos, whence=os.SEEK_SET):
+        """Set the position reads start from, as with :meth:`file.seek`.
+        """
+        self.get().seek(pos, whence)
+
+    def tell(self):
+        """Return the position the next read will start from.
+        """
+        return self.get().tell()
+
+    def read_range(self, start, end=None):
+        """Read the bytes from ``start`` up to (but not including) ``end``,
+        or to the end of the file if ``end`` is ``None`` - e.g. to answer an
+        HTTP Range request.
+        """
+        gridout = self.get()
+        gridout.seek(start)
+        if end is None:
+            return gridout.read()
+        return gridout.read(max(end - start, 0))
+
+    def readinto(self, buffer):
+        """Read up to ``len(buffer)`` bytes from the current position into
+        ``buffer``, a :class:`bytearray` or writable :class:`memoryview`, and
+        return the number of bytes read (``0`` at the end of the file).
+        """
+        data = self.get().read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def iter_chunks(self, size=None, start=0, end=None):
+        """Iterate over the file (or the bytes from ``start`` up to ``end``)
+        in strings of up to ``size`` bytes, holding only one in memory at a
+        time. ``size`` defaults to the file's GridFS chunk size, so each
+        string is read from a single chunk. ::
+
+            for data in doc.file.iter_chunks():
+                response.write(data)
+        """
+        gridout = self.get()
+        size = size or gridout.chunk_size
+        if end is None:
+            end = gridout.length
+        gridout.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = gridout.read(min(size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
     def delete(self):
         # Delete file from GridFS, FileField still remains
-        self.fs.delete(self.grid_id)
+        if self.dedup and self.grid_id is not None:
+            # Shared files are only deleted with their last reference
+            file_doc = self._modify_file({'_id': self.grid_id},
+                                         {'$inc': {'refcount': -1}})
+            if file_doc is None or file_doc.get('refcount', 0) <= 0:
+                self.fs.delete(self.grid_id)
+        else:
+            self.fs.delete(self.grid_id)
         self.grid_id = None
+        self.gridout = None
+        self._bump_collection_versions()
 
     def replace(self, file, **kwargs):
         self.delete()
@@ -625,25 +1130,129 @@ class GridFSProxy(object):
             self.newfile.close()
 
 
+class _CompressedGridOut(object):
+    """Reads a GridFS file whose chunks were compressed one by one. Only the
+    chunks that are read are fetched and decompressed, so seeking is as cheap
+    as for uncompressed files. Other attributes are those of the underlying
+    :class:`gridfs.grid_file.GridOut`.
+    """
+
+    def __init__(self, gridout, chunks, codec):
+        self._gridout = gridout
+        self._chunks = chunks
+        self.codec = codec
+        self.length = gridout.length
+        self.chunk_size = gridout.chunk_size
+        self._position = 0
+        self._chunk_n = None
+        self._chunk_data = ''
+
+    def __getattr__(self, name):
+        return getattr(self._gridout, name)
+
+    def __dir__(self):
+        return sorted(set(dir(type(self)) + self.__dict__.keys() +
+                          dir(self._gridout)))
+
+    def _get_chunk(self, n):
+        if self._chunk_n != n:
+            chunk = self._chunks.find_one({'files_id': self._gridout._id,
+                                           'n': n})
+            if chunk is None:
+                raise GridFSError('Chunk %d of the file is missing' % n)
+            self._chunk_data = self.codec.decompress(str(chunk['data']))
+            self._chunk_n = n
+        return self._chunk_data
+
+    def read(self, size=-1):
+        remaining = max(self.length - self._position, 0)
+        if size < 0 or size > remaining:
+            size = remaining
+        parts = []
+        while size > 0:
+            n, offset = divmod(self._position, self.chunk_size)
+            data = self._get_chunk(n)[offset:offset + size]
+            if not data:
+                raise GridFSError('Chunk %d of the file is truncated' % n)
+            parts.append(data)
+            self._position += len(data)
+            size -= len(data)
+        return ''.join(parts)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._position
+        elif whence == os.SEEK_END:
+            pos += self.length
+        if pos < 0:
+            raise IOError('Invalid seek position')
+        self._position = pos
+
+    def tell(self):
+        return self._position
+
+
+def _read_exactly(file, size):
+    """Read ``size`` bytes from a file-like object, or fewer only at the end
+    of the file, so every GridFS chunk but the last is full.
+    """
+    data = file.read(size)
+    while data and len(data) < size:
+        more = file.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
 class FileField(BaseField):
     """A GridFS storage field.
 
+    :param collection_name: the GridFS collection prefix (bucket) to store
+        files in
+    :param dedup: store each distinct content once - files are looked up by
+        their SHA-256 when they are put, and shared files are reference
+        counted, so deleting a file only removes its data once no other
+        document uses it. A file can't be shared with attributes (e.g.
+        ``content_type``) other than those it was stored with.
+    :param compress: compress each of a file's GridFS chunks, as for
+        :class:`~mongoengine.StringField` - files smaller than
+        ``compress_threshold`` bytes, and files written with
+        :meth:`~mongoengine.fields.GridFSProxy.write`, are stored
+        uncompressed
+    :param compress_threshold: the size, in bytes, below which files are
+        stored uncompressed
+
     .. versionadded:: 0.4
+
+    .. versionchanged:: 0.5 - added ``collection_name``, ``dedup``,
+       ``compress`` and ``compress_threshold``
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, collection_name='fs', dedup=False, compress=False,
+                 compress_threshold=COMPRESS_THRESHOLD, **kwargs):
+        self.collection_name = collection_name
+        self.dedup = dedup
+        self.compress = compress
+        self.compress_threshold = compress_threshold
         super(FileField, self).__init__(**kwargs)
 
+    def _new_proxy(self, grid_id=None):
+        return GridFSProxy(grid_id, collection_name=self.collection_name,
+                           dedup=self.dedup, compress=self.compress,
+                           compress_threshold=self.compress_threshold)
+
     def __get__(self, instance, owner):
         if instance is None:
             return self
 
         # Check if a file already exists for this model
         grid_file = instance._data.get(self.name)
-        self.grid_file = grid_file
-        if self.grid_file:
-            return self.grid_file
-        return GridFSProxy()
+        if grid_file is None:
+            # Keep the empty proxy, so files put through it are saved
+            grid_file = self._new_proxy()
+            instance._data[self.name] = grid_file
+        return grid_file
 
     def __set__(self, instance, value):
         if isinstance(value, file) or isinstance(value, str):
@@ -659,10 +1268,12 @@ class FileField(BaseField):
                 grid_file.put(value)
             else:
                 # Create a new proxy object as we don't already have one
-                instance._data[self.name] = GridFSProxy()
-                instance._data[self.name].put(value)
+                grid_file = self._new_proxy()
+                instance._data[self.name] = grid_file
+                grid_file.put(value)
         else:
             instance._data[self.name] = value
+        instance._changed_fields.add(self.name)
 
     def to_mongo(self, value):
         # Store the GridFS file id in MongoDB
@@ -672,12 +1283,15 @@ class FileField(BaseField):
 
     def to_python(self, value):
         if value is not None:
-            return GridFSProxy(value)
+            return self._new_proxy(value)
 
     def validate(self, value):
         if value.grid_id is not None:
             assert isinstance(value, GridFSProxy)
             assert isinstance(value.grid_id, pymongo.objectid.ObjectId)
+        elif self.required:
+            # Reading the field gives an empty proxy, which isn't a file
+            raise ValidationError('Field "%s" is required' % self.name)
 
 
 class GeoPointField(BaseField):
@@ -0,0 +1,1479 @@
+"""A pure-Python, in-memory stand-in for a MongoDB database, selected with
+``connect(db_name, backend='memory')``. It evaluates the query and update
+documents that MongoEngine builds, so documents and querysets may be used
+without a server, e.g. in unit tests. Data is kept for the life of the
+process, in a database per name.
+"""
+
+import datetime
+import hashlib
+import math
+import re
+import threading
+
+import pymongo.binary
+import pymongo.code
+import pymongo.errors
+import pymongo.objectid
+import pymongo.son
+
+__all__ = ['MemoryDatabase', 'MemoryCollection', 'MemoryCursor',
+           'get_database', 'drop_database']
+
+
+RE_TYPE = type(re.compile(''))
+
+# Older versions of PyMongo report duplicate keys as plain operation failures
+DuplicateKeyError = getattr(pymongo.errors, 'DuplicateKeyError',
+                            pymongo.errors.OperationFailure)
+
+# The number of documents $near queries return when no limit is given
+NEAR_LIMIT = 100
+
+# The order of BSON types when sorting values of different types
+_TYPE_ORDER = ['null', 'number', 'string', 'object', 'array', 'binary', 'oid',
+               'bool', 'date', 'regex']
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(name):
+    """Return the in-memory database called ``name``, creating it the first
+    time it is asked for.
+    """
+    _databases_lock.acquire()
+    try:
+        if name not in _databases:
+            _databases[name] = MemoryDatabase(name)
+        return _databases[name]
+    finally:
+        _databases_lock.release()
+
+
+def drop_database(name_or_database):
+    """Remove every collection from an in-memory database.
+    """
+    name = name_or_database
+    if isinstance(name_or_database, MemoryDatabase):
+        name = name_or_database.name
+    if name in _databases:
+        database = _databases[name]
+        for collection in database.collection_names():
+            database.drop_collection(collection)
+
+
+def _to_bson(value):
+    """Copy a value as it would be after a round trip through BSON: tuples
+    become lists, strings become unicode and datetimes lose their
+    sub-millisecond precision.
+    """
+    if isinstance(value, dict):
+        return dict((unicode(key), _to_bson(item))
+                    for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_to_bson(item) for item in value]
+    if isinstance(value, (pymongo.binary.Binary, pymongo.code.Code)):
+        return value
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise pymongo.errors.InvalidStringData('Strings must be valid '
+                                                   'UTF-8: %r' % value)
+    if isinstance(value, datetime.datetime):
+        offset = value.utcoffset()
+        if offset is not None:
+            value = (value - offset).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+def _freeze(value):
+    """Return a hashable version of a value, for use as an index key.
+    """
+    if isinstance(value, dict):
+        return ('object', tuple(sorted((key, _freeze(item))
+                                       for key, item in value.items())))
+    if isinstance(value, list):
+        return ('array', tuple(_freeze(item) for item in value))
+    if isinstance(value, RE_TYPE):
+        return ('regex', value.pattern, value.flags)
+    return value
+
+
+def _type_name(value):
+    """Return the name of a value's BSON type.
+    """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, long, float)):
+        return 'number'
+    if isinstance(value, pymongo.binary.Binary):
+        return 'binary'
+    if isinstance(value, basestring):
+        return 'string'
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, list):
+        return 'array'
+    if isinstance(value, pymongo.objectid.ObjectId):
+        return 'oid'
+    if isinstance(value, datetime.datetime):
+        return 'date'
+    if isinstance(value, RE_TYPE):
+        return 'regex'
+    return 'other'
+
+
+def _sort_key(value):
+    """Return a key that orders values of any type as MongoDB does.
+    """
+    name = _type_name(value)
+    if name in _TYPE_ORDER:
+        rank = _TYPE_ORDER.index(name)
+    else:
+        rank = len(_TYPE_ORDER)
+    if name == 'object':
+        value = sorted((key, _sort_key(item)) for key, item in value.items())
+    elif name == 'array':
+        value = [_sort_key(item) for item in value]
+    elif name == 'regex':
+        value = value.pattern
+    elif name == 'other':
+        value = repr(value)
+    return (rank, value)
+
+
+def _lookup(value, parts):
+    """Return the values found at a (split) dotted path in a document. Arrays
+    met along the path are expanded, as MongoDB does, so a path may lead to
+    several values, or none if it leads nowhere.
+    """
+    if not parts:
+        return [value]
+    part, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        if part in value:
+            return _lookup(value[part], rest)
+        return []
+    if isinstance(value, list):
+        results = []
+        if part.isdigit() and int(part) < len(value):
+            results.extend(_lookup(value[int(part)], rest))
+        for item in value:
+            if isinstance(item, dict):
+                results.extend(_lookup(item, parts))
+        return results
+    return []
+
+
+def _expand(values):
+    """Return values with the items of any arrays among them added, which is
+    what MongoDB compares query values against.
+    """
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if isinstance(value, list):
+            expanded.extend(value)
+    return expanded
+
+
+def _equal(value, query_value):
+    """Return whether a stored value equals a query value (or matches it, for
+    a regular expression).
+    """
+    if isinstance(query_value, RE_TYPE):
+        return (isinstance(value, basestring) and
+                query_value.search(value) is not None)
+    if isinstance(value, bool) != isinstance(query_value, bool):
+        return False
+    return _type_name(value) == _type_name(query_value) and \
+           value == query_value
+
+
+def _match_equal(values, query_value):
+    """Return whether any of the values at a path equals a query value. A
+    ``None`` query value also matches a missing field.
+    """
+    if query_value is None and not values:
+        return True
+    for value in _expand(values):
+        if _equal(value, query_value):
+            return True
+    return False
+
+
+def _compare(values, query_value, compare):
+    """Return whether any of the values at a path compares true with a query
+    value. Only values of the same type are compared.
+    """
+    query_type = _type_name(query_value)
+    for value in _expand(values):
+        if _type_name(value) == query_type and compare(value, query_value):
+            return True
+    return False
+
+
+def _compile_regex(pattern, options=''):
+    if isinstance(pattern, RE_TYPE):
+        return pattern
+    flags = 0
+    for option in options:
+        flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(option, 0)
+    return re.compile(pattern, flags)
+
+
+def _distance(point, other, spherical=False):
+    """Return the distance between two points, in the points' own units or,
+    for spherical distances, in radians (points are longitude, latitude).
+    """
+    if not spherical:
+        return math.hypot(point[0] - other[0], point[1] - other[1])
+    lng1, lat1, lng2, lat2 = map(math.radians, [point[0], point[1],
+                                                other[0], other[1]])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _points(values):
+    """Return the geographical points among the values at a path.
+    """
+    return [value for value in values
+            if isinstance(value, list) and len(value) == 2 and
+               _type_name(value[0]) == _type_name(value[1]) == 'number']
+
+
+def _within(point, shape):
+    """Return whether a point is within a ``$within`` shape.
+    """
+    if '$center' in shape:
+        center, radius = shape['$center']
+        return _distance(point, center) <= radius
+    if '$centerSphere' in shape:
+        center, radius = shape['$centerSphere']
+        return _distance(point, center, spherical=True) <= radius
+    if '$box' in shape:
+        (x1, y1), (x2, y2) = shape['$box']
+        return (min(x1, x2) <= point[0] <= max(x1, x2) and
+                min(y1, y2) <= point[1] <= max(y1, y2))
+    raise pymongo.errors.OperationFailure('Unsupported $within shape: %r' %
+                                          shape.keys())
+
+
+def _near(condition):
+    """Return the point, maximum distance and whether distances are
+    spherical for a ``$near`` or ``$nearSphere`` condition, or ``None`` if
+    the condition isn't one.
+    """
+    if not _is_operators(condition):
+        return None
+    for operator in ('$near', '$nearSphere'):
+        if operator in condition:
+            return (condition[operator], condition.get('$maxDistance'),
+                    operator == '$nearSphere')
+    return None
+
+
+def _lookup_values(condition):
+    """Return the values a query condition compares a field with for
+    equality (a value, or the items of an ``$in`` operator), or ``None`` for
+    other conditions.
+    """
+    if _is_operators(condition):
+        if condition.keys() != ['$in']:
+            return None
+        values = condition['$in']
+    else:
+        values = [condition]
+    if [value for value in values if isinstance(value, RE_TYPE)]:
+        return None
+    return values
+
+
+def _is_operators(condition):
+    """Return whether a query condition is a document of query operators,
+    rather than a value to compare with.
+    """
+    return (isinstance(condition, dict) and bool(condition) and
+            [key for key in condition if key.startswith('$')] ==
+            condition.keys())
+
+
+def _match_operator(values, operator, argument, condition):
+    if operator == '$eq':
+        return _match_equal(values, argument)
+    if operator == '$ne':
+        return not _match_equal(values, argument)
+    if operator == '$gt':
+        return _compare(values, argument, lambda a, b: a > b)
+    if operator == '$gte':
+        return _compare(values, argument, lambda a, b: a >= b)
+    if operator == '$lt':
+        return _compare(values, argument, lambda a, b: a < b)
+    if operator == '$lte':
+        return _compare(values, argument, lambda a, b: a <= b)
+    if operator == '$in':
+        return bool([item for item in argument
+                     if _match_equal(values, item)])
+    if operator == '$nin':
+        return not [item for item in argument if _match_equal(values, item)]
+    if operator == '$all':
+        for value in values:
+            items = value if isinstance(value, list) else [value]
+            if argument and not [query_value for query_value in argument
+                                 if not [item for item in items
+                                         if _equal(item, query_value)]]:
+                return True
+        return False
+    if operator == '$size':
+        return bool([value for value in values
+                     if isinstance(value, list) and len(value) == argument])
+    if operator == '$exists':
+        return bool(values) == bool(argument)
+    if operator == '$mod':
+        divisor, remainder = argument
+        return bool([value for value in _expand(values)
+                     if _type_name(value) == 'number' and
+                        value % divisor == remainder])
+    if operator == '$regex':
+        regex = _compile_regex(argument, condition.get('$options', ''))
+        return _match_equal(values, regex)
+    if operator == '$options':
+        return True
+    if operator == '$not':
+        if isinstance(argument, dict):
+            return not _match_condition(values, argument)
+        return not _match_equal(values, _compile_regex(argument))
+    if operator == '$elemMatch':
+        for value in values:
+            if not isinstance(value, list):
+                continue
+            for item in value:
+                if _is_operators(argument):
+                    if _match_condition([item], argument):
+                        return True
+                elif isinstance(item, dict) and _match(item, argument):
+                    return True
+        return False
+    if operator == '$within':
+        return bool([point for point in _points(values)
+                     if _within(point, argument)])
+    if operator in ('$near', '$nearSphere'):
+        point, max_distance, spherical = _near(condition)
+        for value in _points(values):
+            if max_distance is None or \
+               _distance(value, point, spherical) <= max_distance:
+                return True
+        return False
+    if operator == '$maxDistance':
+        return True
+    raise pymongo.errors.OperationFailure('Query operator %s is not '
+                                          'supported by the memory backend' %
+                                          operator)
+
+
+def _match_condition(values, condition):
+    """Return whether the values at a path satisfy a query condition.
+    """
+    if _is_operators(condition):
+        for operator, argument in condition.items():
+            if not _match_operator(values, operator, argument, condition):
+                return False
+        return True
+    return _match_equal(values, condition)
+
+
+def _match(document, spec):
+    """Return whether a document matches a query document.
+    """
+    for key, condition in spec.items():
+        if key == '$or':
+            if not [clause for clause in condition
+                    if _match(document, clause)]:
+                return False
+        elif key == '$and':
+            if [clause for clause in condition
+                if not _match(document, clause)]:
+                return False
+        elif key == '$nor':
+            if [clause for clause in condition if _match(document, clause)]:
+                return False
+        elif key == '$where':
+            raise pymongo.errors.OperationFailure('Javascript ($where) is not '
+                                                  'supported by the memory '
+                                                  'backend')
+        elif not _match_condition(_lookup(document, key.split('.')),
+                                  condition):
+            return False
+    return True
+
+
+def _get_near(spec):
+    """Return the path and ``$near`` condition of a query, if it has one.
+    """
+    for key, condition in spec.items():
+        near = _near(condition)
+        if near is not None:
+            return key, near
+    return None
+
+
+def _copy_path(source, target, parts):
+    """Copy the value at a dotted path from one document to another, for
+    projections. Arrays of embedded documents are projected item by item.
+    """
+    part, rest = parts[0], parts[1:]
+    if part not in source:
+        return
+    value = source[part]
+    if not rest:
+        target[part] = _to_bson(value)
+    elif isinstance(value, dict):
+        _copy_path(value, target.setdefault(part, {}), rest)
+    elif isinstance(value, list):
+        items = target.setdefault(part, [{} for item in value
+                                         if isinstance(item, dict)])
+        for item, projected in zip([item for item in value
+                                    if isinstance(item, dict)], items):
+            _copy_path(item, projected, rest)
+
+
+def _remove_path(document, parts):
+    part, rest = parts[0], parts[1:]
+    if isinstance(document, list):
+        for item in document:
+            if isinstance(item, dict):
+                _remove_path(item, parts)
+        return
+    if not isinstance(document, dict) or part not in document:
+        return
+    if rest:
+        _remove_path(document[part], rest)
+    else:
+        del document[part]
+
+
+def _project(document, fields):
+    """Return a copy of a document with only the fields a projection (a list
+    of field names, or a document of flags and ``$slice`` operators)
+    selects.
+    """
+    if fields is None:
+        return _to_bson(document)
+    if not isinstance(fields, dict):
+        fields = dict((field, 1) for field in fields)
+
+    slices = {}
+    flags = {}
+    for key, value in fields.items():
+        if isinstance(value, dict) and '$slice' in value:
+            slices[key] = value['$slice']
+        else:
+            flags[key] = value
+
+    included = [key for key, value in flags.items() if value and key != '_id']
+    if included:
+        result = {}
+        if flags.get('_id', 1) and '_id' in document:
+            result['_id'] = _to_bson(document['_id'])
+        for key in included + slices.keys():
+            _copy_path(document, result, key.split('.'))
+    else:
+        result = _to_bson(document)
+        for key, value in flags.items():
+            if not value:
+                _remove_path(result, key.split('.'))
+
+    for key, argument in slices.items():
+        for value in _lookup(result, key.split('.')):
+            if not isinstance(value, list):
+                continue
+            if isinstance(argument, list):
+                skip, limit = argument
+                if skip < 0:
+                    skip = max(len(value) + skip, 0)
+                value[:] = value[skip:skip + limit]
+            elif argument >= 0:
+                value[:] = value[:argument]
+            else:
+                value[:] = value[argument:]
+    return result
+
+
+def _resolve(document, parts, create=False):
+    """Return the container (a document or an array) holding the value at a
+    dotted path, and the key or index of the value within it. Embedded
+    documents are created along the way if ``create`` is set; otherwise
+    ``None`` is returned for paths that lead nowhere.
+    """
+    container = document
+    for i, part in enumerate(parts):
+        key = part
+        if isinstance(container, list):
+            if not part.isdigit():
+                raise pymongo.errors.OperationFailure('Cannot apply a '
+                                                      'modifier to "%s" in '
+                                                      'an array' % part)
+            key = int(part)
+            if create:
+                container.extend([None] * (key + 1 - len(container)))
+            elif key >= len(container):
+                return None, None
+        elif not isinstance(container, dict):
+            if create:
+                raise pymongo.errors.OperationFailure('Cannot set "%s" in a '
+                                                      'non-document value' %
+                                                      '.'.join(parts))
+            return None, None
+        if i == len(parts) - 1:
+            return container, key
+        if isinstance(container, dict) and key not in container:
+            if not create:
+                return None, None
+            container[key] = {}
+        elif isinstance(container, list) and container[key] is None and \
+             create:
+            container[key] = {}
+        container = container[key]
+
+
+def _get_value(container, key, default=None):
+    if isinstance(container, dict):
+        return container.get(key, default)
+    if key < len(container):
+        return container[key]
+    return default
+
+
+def _get_array(container, key, operator):
+    value = _get_value(container, key)
+    if value is None:
+        return None
+    if not isinstance(value, list):
+        raise pymongo.errors.OperationFailure('Cannot apply %s modifier to '
+                                              'non-array' % operator)
+    return value
+
+
+def _positional_path(document, spec, path):
+    """Replace the positional operator (``$``) in an update path with the
+    index of the first array item matched by the query.
+    """
+    if '.$' not in path:
+        return path
+    prefix, suffix = path.split('.$', 1)
+    array = _lookup(document, prefix.split('.'))
+    array = array and array[0]
+    if isinstance(array, list):
+        conditions = []
+        for key, condition in spec.items():
+            if key == prefix:
+                conditions.append(([], condition))
+            elif key.startswith(prefix + '.'):
+                rest = key[len(prefix) + 1:]
+                conditions.append((rest.split('.'), condition))
+        for index, item in enumerate(array):
+            if conditions and not [
+                    condition for parts, condition in conditions
+                    if not _match_condition(_lookup(item, parts),
+                                            condition)]:
+                return '%s.%d%s' % (prefix, index, suffix)
+    raise pymongo.errors.OperationFailure('The positional operator did not '
+                                          'find the match needed from the '
+                                          'query')
+
+
+def _pull_matches(item, condition):
+    if isinstance(condition, dict) and not _is_operators(condition):
+        return isinstance(item, dict) and _match(item, condition)
+    if _is_operators(condition):
+        return _match_condition([item], condition)
+    return _equal(item, condition)
+
+
+def _apply_modifier(document, operator, path, argument):
+    parts = path.split('.')
+    if operator == '$unset':
+        container, key = _resolve(document, parts)
+        if isinstance(container, dict) and key in container:
+            del container[key]
+        elif isinstance(container, list):
+            container[key] = None
+        return
+    if operator == '$pop' or operator in ('$pull', '$pullAll'):
+        container, key = _resolve(document, parts)
+        if container is None:
+            return
+        array = _get_array(container, key, operator)
+        if not array:
+            return
+        if operator == '$pop':
+            if argument < 0:
+                del array[0]
+            else:
+                del array[-1]
+        elif operator == '$pull':
+            array[:] = [item for item in array
+                        if not _pull_matches(item, argument)]
+        else:
+            array[:] = [item for item in array if not
+                        [value for value in argument if _equal(item, value)]]
+        return
+
+    container, key = _resolve(document, parts, create=True)
+    if operator in ('$set', '$setOnInsert'):
+        container[key] = argument
+    elif operator == '$inc':
+        value = _get_value(container, key, 0)
+        if _type_name(value) != 'number' or _type_name(argument) != 'number':
+            raise pymongo.errors.OperationFailure('Cannot apply $inc '
+                                                  'modifier to non-number')
+        container[key] = value + argument
+    elif operator in ('$push', '$pushAll', '$addToSet'):
+        array = _get_array(container, key, operator)
+        if array is None:
+            array = container[key] = []
+        if operator == '$push':
+            array.append(argument)
+        elif operator == '$pushAll':
+            array.extend(argument)
+        else:
+            items = [argument]
+            if isinstance(argument, dict) and '$each' in argument:
+                items = argument['$each']
+            for item in items:
+                if not [value for value in array if _equal(value, item)]:
+                    array.append(item)
+    else:
+        raise pymongo.errors.OperationFailure('Update operator %s is not '
+                                              'supported by the memory '
+                                              'backend' % operator)
+
+
+def _apply_update(document, update, spec, insert=False):
+    """Return a copy of a document updated by an update document, which is
+    either a set of update operators or a replacement document. ``$setOnInsert``
+    only applies to the ``insert`` of an upsert.
+    """
+    if not [key for key in update if key.startswith('$')]:
+        updated = _to_bson(update)
+        if '_id' in document:
+            updated['_id'] = document['_id']
+        return updated
+
+    updated = _to_bson(document)
+    for operator, fields in update.items():
+        if not operator.startswith('$'):
+            raise pymongo.errors.OperationFailure('Cannot mix update '
+                                                  'operators and fields')
+        if operator == '$setOnInsert' and not insert:
+            continue
+        for path, argument in fields.items():
+            path = _positional_path(updated, spec, path)
+            if (path == '_id' or path.startswith('_id.')) and not insert:
+                raise pymongo.errors.OperationFailure('Modifying _id is not '
+                                                      'allowed')
+            _apply_modifier(updated, operator, path, _to_bson(argument))
+    return updated
+
+
+def _upsert_document(spec, update):
+    """Return the document an upsert inserts: the query's equality
+    conditions, updated by the update document.
+    """
+    document = {}
+    if [key for key in update if key.startswith('$')]:
+        for key, condition in spec.items():
+            if key.startswith('$') or _is_operators(condition) or \
+               isinstance(condition, RE_TYPE):
+                continue
+            container, name = _resolve(document, key.split('.'), create=True)
+            container[name] = _to_bson(condition)
+    elif '_id' in spec and not _is_operators(spec['_id']):
+        document['_id'] = spec['_id']
+    return _apply_update(document, update, {}, insert=True)
+
+
+class _Index(object):
+    """A hash index, mapping the (frozen) values of its fields to the ids of
+    the documents that have them. Array fields add a key for each item as
+    well as for the whole array, like MongoDB's multikey indexes.
+    """
+
+    def __init__(self, name, fields, unique=False, sparse=False):
+        self.name = name
+        self.fields = fields
+        self.unique = unique
+        self.sparse = sparse
+        self.entries = {}
+        self.document_keys = {}
+
+    def keys(self, document):
+        """Return the index keys of a document.
+        """
+        keys = [()]
+        present = False
+        for field, direction in self.fields:
+            values = _lookup(document, field.split('.'))
+            present = present or bool(values)
+            expanded = []
+            for value in values or [None]:
+                expanded.append(_freeze(value))
+                if isinstance(value, list):
+                    expanded.extend(_freeze(item) for item in value)
+            keys = [key + (value,) for key in keys for value in expanded]
+        if self.sparse and not present:
+            return []
+        return list(set(keys))
+
+    def conflicts(self, document, document_id):
+        """Return the key of a document that another document already has, in
+        a unique index.
+        """
+        if not self.unique:
+            return None
+        for key in self.keys(document):
+            if self.entries.get(key, set()) - set([document_id]):
+                return key
+        return None
+
+    def add(self, document_id, document):
+        keys = self.keys(document)
+        self.document_keys[document_id] = keys
+        for key in keys:
+            self.entries.setdefault(key, set()).add(document_id)
+
+    def remove(self, document_id):
+        for key in self.document_keys.pop(document_id, []):
+            ids = self.entries.get(key)
+            if ids is not None:
+                ids.discard(document_id)
+                if not ids:
+                    del self.entries[key]
+
+    def lookup(self, spec):
+        """Return the ids of the documents that may match a query, or
+        ``None`` if the query doesn't give the values of every indexed field
+        (by equality or ``$in``).
+        """
+        if self.sparse:
+            return None
+        keys = [()]
+        for field, direction in self.fields:
+            if field not in spec:
+                return None
+            values = _lookup_values(spec[field])
+            if values is None:
+                return None
+            values = [_freeze(value) for value in values]
+            keys = [key + (value,) for key in keys for value in values]
+        ids = set()
+        for key in keys:
+            ids.update(self.entries.get(key, ()))
+        return ids
+
+
+class MemoryCursor(object):
+    """A cursor over the documents in a
+    :class:`~mongoengine.memory.MemoryCollection` that match a query, with
+    the methods of PyMongo's cursors that MongoEngine uses. The query is run
+    when the first result is asked for.
+    """
+
+    def __init__(self, collection, spec=None, fields=None, skip=0, limit=0,
+                 sort=None, **kwargs):
+        self.collection = collection
+        self._spec = _to_bson(spec or {})
+        self._fields = fields
+        self._skip = skip
+        self._limit = limit
+        self._ordering = sort
+        self._hint = None
+        self._max_scan = None
+        self._where = None
+        self._results = None
+        self._position = 0
+
+    def _check_unevaluated(self):
+        if self._results is not None:
+            raise pymongo.errors.InvalidOperation('Cannot set options after '
+                                                  'executing query')
+
+    def limit(self, limit):
+        self._check_unevaluated()
+        self._limit = limit
+        return self
+
+    def skip(self, skip):
+        self._check_unevaluated()
+        self._skip = skip
+        return self
+
+    def sort(self, key_or_list, direction=None):
+        self._check_unevaluated()
+        if isinstance(key_or_list, basestring):
+            key_or_list = [(key_or_list, direction or pymongo.ASCENDING)]
+        self._ordering = list(key_or_list)
+        return self
+
+    def hint(self, index):
+        self._check_unevaluated()
+        self._hint = index
+        return self
+
+    def max_scan(self, max_scan):
+        self._check_unevaluated()
+        self._max_scan = max_scan
+        return self
+
+    def max_time_ms(self, max_time_ms):
+        self._check_unevaluated()
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    def where(self, code):
+        self._check_unevaluated()
+        self._where = code
+        return self
+
+    def rewind(self):
+        self._results = None
+        self._position = 0
+        return self
+
+    def clone(self):
+        cursor = MemoryCursor(self.collection, self._spec, self._fields,
+                              self._skip, self._limit, self._ordering)
+        cursor._hint = self._hint
+        cursor._max_scan = self._max_scan
+        cursor._where = self._where
+        return cursor
+
+    def _match(self, needed=None):
+        """Return the matching documents, in order, with how many documents
+        were examined and the index used to find them. Unsorted queries stop
+        after the ``needed`` number of matches, if given.
+        """
+        if self._where is not None:
+            raise pymongo.errors.OperationFailure('Javascript ($where) is not '
+                                                  'supported by the memory '
+                                                  'backend')
+        index, documents = self.collection._plan(self._spec, self._ordering,
+                                                 self._hint)
+        if self._max_scan:
+            documents = documents[:self._max_scan]
+
+        near = _get_near(self._spec)
+        if needed is None or self._ordering or near is not None:
+            matched = [document for document in documents
+                       if _match(document, self._spec)]
+        else:
+            matched = []
+            for document in documents:
+                if len(matched) == needed:
+                    break
+                if _match(document, self._spec):
+                    matched.append(document)
+
+        if near is not None and not self._ordering:
+            path, (point, max_distance, spherical) = near
+
+            def distance(document):
+                points = _points(_lookup(document, path.split('.')))
+                return min(_distance(value, point, spherical)
+                           for value in points)
+            matched.sort(key=distance)
+            if not self._limit:
+                matched = matched[:NEAR_LIMIT]
+
+        for key, direction in reversed(self._ordering or []):
+            parts = key.split('.')
+            reverse = direction == pymongo.DESCENDING
+
+            def sort_key(document):
+                # Arrays sort by their smallest (or largest) item, and empty
+                # arrays before any other value
+                keys = []
+                for value in _lookup(document, parts) or [None]:
+                    if not isinstance(value, list):
+                        keys.append(_sort_key(value))
+                    elif value:
+                        keys.extend(_sort_key(item) for item in value)
+                    else:
+                        keys.append((-1, None))
+                if reverse:
+                    return max(keys)
+                return min(keys)
+            matched.sort(key=sort_key, reverse=reverse)
+        return matched, len(documents), index
+
+    def _evaluate(self):
+        if self._results is None:
+            self.collection.database._lock.acquire()
+            try:
+                needed = None
+                if self._limit:
+                    needed = (self._skip or 0) + abs(self._limit)
+                matched = self._match(needed)[0]
+                matched = matched[self._skip:]
+                if self._limit:
+                    matched = matched[:abs(self._limit)]
+                self._results = [_project(document, self._fields)
+                                 for document in matched]
+            finally:
+                self.collection.database._lock.release()
+        return self._results
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        results = self._evaluate()
+        if self._position >= len(results):
+            raise StopIteration
+        self._position += 1
+        return results[self._position - 1]
+
+    def __getitem__(self, index):
+        self._check_unevaluated()
+        if isinstance(index, slice):
+            if index.step is not None:
+                raise IndexError('Cursor instances do not support slice '
+                                 'steps')
+            start = index.start or 0
+            if start < 0 or (index.stop is not None and index.stop < 0):
+                raise IndexError('Cursor instances do not support negative '
+                                 'indices')
+            self._skip = start
+            if index.stop is not None:
+                limit = index.stop - start
+                if limit <= 0:
+                    raise IndexError('stop index must be greater than start '
+                                     'index for slice %r' % index)
+                self._limit = limit
+            return self
+        if index < 0:
+            raise IndexError('Cursor instances do not support negative '
+                             'indices')
+        cursor = self.clone()
+        cursor._skip = self._skip + index
+        cursor._limit = -1
+        for document in cursor:
+            return document
+        raise IndexError('no such item for Cursor instance')
+
+    def count(self, with_limit_and_skip=False):
+        self.collection.database._lock.acquire()
+        try:
+            count = len(self._match()[0])
+        finally:
+            self.collection.database._lock.release()
+        if with_limit_and_skip:
+            count = max(count - (self._skip or 0), 0)
+            if self._limit:
+                count = min(count, abs(self._limit))
+        return count
+
+    def distinct(self, key):
+        self.collection.database._lock.acquire()
+        try:
+            matched = self._match()[0]
+        finally:
+            self.collection.database._lock.release()
+        values = []
+        seen = set()
+        for document in matched:
+            for value in _lookup(document, key.split('.')):
+                items = value if isinstance(value, list) else [value]
+                for item in items:
+                    frozen = _freeze(item)
+                    if frozen not in seen:
+                        seen.add(frozen)
+                        values.append(_to_bson(item))
+        return values
+
+    def explain(self):
+        """Return a plan in the format of older MongoDB servers: the cursor
+        (``BasicCursor`` for a full scan, or ``BtreeCursor`` and the index's
+        name) and the number of documents examined (``nscanned``) and
+        matched (``n``).
+        """
+        self.collection.database._lock.acquire()
+        try:
+            matched, scanned, index = self._match()
+        finally:
+            self.collection.database._lock.release()
+        cursor = 'BasicCursor'
+        if index is not None:
+            cursor = 'BtreeCursor %s' % index
+        return {'cursor': cursor, 'n': len(matched), 'nscanned': scanned,
+                'nscannedObjects': scanned, 'millis': 0, 'indexBounds': {}}
+
+
+class MemoryCollection(object):
+    """A collection of documents kept in memory, with the methods of
+    PyMongo's collections that MongoEngine uses. Documents are copied on the
+    way in and out, so changes to them aren't shared.
+    """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = '%s.%s' % (database.name, name)
+        self._clear()
+
+    def _clear(self):
+        self._documents = {}
+        # The insertion position of each document, for natural order, and
+        # the keys of every document in that order (rebuilt after removals)
+        self._positions = {}
+        self._next_position = 0
+        self._order = []
+        self._indexes = {}
+        self._options = {}
+        self._created = False
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        return self.database['%s.%s' % (self.name, name)]
+
+    def __repr__(self):
+        return 'MemoryCollection(%r, %r)' % (self.database, self.name)
+
+    def _exists(self):
+        return bool(self._created or self._documents or self._indexes)
+
+    def _plan(self, spec, ordering=None, hint=None):
+        """Return the name of the index used to run a query, and the
+        documents to examine, in insertion order. Equality and ``$in``
+        conditions on ``_id`` or on every field of an index are looked up
+        rather than scanned for.
+        """
+        if hint is not None:
+            name = self._index_name(hint)
+            if name != '_id_' and name not in self._indexes:
+                raise pymongo.errors.OperationFailure('bad hint')
+
+        ids = None
+        index_name = None
+        if '_id' in spec and _lookup_values(spec['_id']) is not None:
+            ids = set(_freeze(value) for value in _lookup_values(spec['_id']))
+            index_name = '_id_'
+        if ids is None:
+            for index in self._indexes.values():
+                found = index.lookup(spec)
+                if found is not None and (ids is None or
+                                          len(found) < len(ids)):
+                    ids, index_name = found, index.name
+
+        if ids is None:
+            documents = [self._documents[key] for key in self._natural()]
+            # Report the index that MongoDB would use for a range or sort
+            first_fields = [ordering and ordering[0][0]] + spec.keys()
+            for name, index in sorted(self._indexes.items()):
+                if index.fields[0][0] in first_fields:
+                    index_name = name
+                    break
+        else:
+            ids = [key for key in ids if key in self._documents]
+            documents = [self._documents[key] for key in self._natural(ids)]
+        if hint is not None:
+            index_name = self._index_name(hint)
+        return index_name, documents
+
+    def _natural(self, keys=None):
+        """Return document keys (by default, those of every document) in the
+        order the documents were inserted.
+        """
+        if keys is not None:
+            return sorted(keys, key=self._positions.__getitem__)
+        if self._order is None:
+            self._order = self._natural(self._documents)
+        return self._order
+
+    def _index_name(self, key_or_list):
+        if isinstance(key_or_list, basestring) and \
+           key_or_list in self._indexes:
+            return key_or_list
+        fields = self._index_fields(key_or_list)
+        return '_'.join('%s_%s' % (field, direction)
+                        for field, direction in fields)
+
+    def _index_fields(self, key_or_list):
+        if isinstance(key_or_list, basestring):
+            return [(key_or_list, pymongo.ASCENDING)]
+        return [(field, direction) for field, direction in key_or_list]
+
+    def _check_unique(self, document, key):
+        if key is None:
+            key = _freeze(document['_id'])
+            if key in self._documents:
+                raise DuplicateKeyError('E11000 duplicate key error index: '
+                                        '%s.$_id_  dup key: { : %r }' %
+                                        (self.full_name, document['_id']))
+        for index in self._indexes.values():
+            conflict = index.conflicts(document, key)
+            if conflict is not None:
+                raise DuplicateKeyError('E11000 duplicate key error index: '
+                                        '%s.$%s  dup key: { : %r }' %
+                                        (self.full_name, index.name,
+                                         conflict))
+
+    def _insert(self, document):
+        self._check_unique(document, None)
+        key = _freeze(document['_id'])
+        self._documents[key] = document
+        self._positions[key] = self._next_position
+        self._next_position += 1
+        if self._order is not None:
+            self._order.append(key)
+        for index in self._indexes.values():
+            index.add(key, document)
+        self._created = True
+
+        max_documents = self._options.get('max')
+        if self._options.get('capped') and max_documents and \
+           len(self._documents) > max_documents:
+            keys = self._natural()
+            for key in keys[:len(keys) - max_documents]:
+                self._remove(key)
+
+    def _replace(self, key, document):
+        self._check_unique(document, key)
+        self._documents[key] = document
+        for index in self._indexes.values():
+            index.remove(key)
+            index.add(key, document)
+
+    def _remove(self, key):
+        del self._documents[key]
+        del self._positions[key]
+        self._order = None
+        for index in self._indexes.values():
+            index.remove(key)
+
+    def _find_keys(self, spec, sort=None, limit=None):
+        cursor = MemoryCursor(self, spec, sort=sort)
+        return [_freeze(document['_id'])
+                for document in cursor._match(limit)[0][:limit]]
+
+    def find(self, *args, **kwargs):
+        return MemoryCursor(self, *args, **kwargs)
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for document in self.find(spec_or_id, *args, **kwargs).limit(-1):
+            return document
+        return None
+
+    def count(self):
+        return len(self._documents)
+
+    def insert(self, doc_or_docs, manipulate=True, safe=False, **kwargs):
+        documents = doc_or_docs
+        if isinstance(doc_or_docs, dict):
+            documents = [doc_or_docs]
+        ids = []
+        self.database._lock.acquire()
+        try:
+            for document in documents:
+                if '_id' not in document:
+                    document['_id'] = pymongo.objectid.ObjectId()
+                self._insert(_to_bson(document))
+                ids.append(document['_id'])
+        finally:
+            self.database._lock.release()
+        if isinstance(doc_or_docs, dict):
+            return ids[0]
+        return ids
+
+    def save(self, to_save, manipulate=True, safe=False, **kwargs):
+        if '_id' not in to_save:
+            return self.insert(to_save, safe=safe)
+        self.update({'_id': to_save['_id']}, to_save, upsert=True, safe=safe)
+        return to_save['_id']
+
+    def update(self, spec, document, upsert=False, manipulate=False,
+               safe=False, multi=False, **kwargs):
+        spec = _to_bson(spec)
+        self.database._lock.acquire()
+        try:
+            keys = self._find_keys(spec, limit=not multi and 1 or None)
+            for key in keys:
+                updated = _apply_update(self._documents[key], document, spec)
+                self._replace(key, updated)
+            upserted = None
+            if not keys and upsert:
+                inserted = _upsert_document(spec, document)
+                if '_id' not in inserted:
+                    inserted['_id'] = pymongo.objectid.ObjectId()
+                self._insert(inserted)
+                upserted = inserted['_id']
+        finally:
+            self.database._lock.release()
+        if safe:
+            result = {'ok': 1.0, 'err': None, 'n': len(keys) or int(upsert),
+                      'updatedExisting': bool(keys)}
+            if upserted is not None:
+                result['upserted'] = upserted
+            return result
+        return None
+
+    def remove(self, spec_or_id=None, safe=False, **kwargs):
+        if spec_or_id is None:
+            spec_or_id = {}
+        elif not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        self.database._lock.acquire()
+        try:
+            keys = self._find_keys(spec_or_id)
+            for key in keys:
+                self._remove(key)
+        finally:
+            self.database._lock.release()
+        if safe:
+            return {'ok': 1.0, 'err': None, 'n': len(keys)}
+        return None
+
+    def create_index(self, key_or_list, unique=False, drop_dups=False,
+                     sparse=False, name=None, **kwargs):
+        fields = self._index_fields(key_or_list)
+        name = name or self._index_name(fields)
+        if name == '_id_':
+            return name
+        self.database._lock.acquire()
+        try:
+            if name in self._indexes:
+                return name
+            index = _Index(name, fields, unique=unique, sparse=sparse)
+            for key in list(self._natural()):
+                document = self._documents[key]
+                if index.conflicts(document, key) is not None:
+                    if not drop_dups:
+                        raise DuplicateKeyError('E11000 duplicate key error '
+                                                'index: %s.$%s' %
+                                                (self.full_name, name))
+                    self._remove(key)
+                    continue
+                index.add(key, document)
+            self._indexes[name] = index
+        finally:
+            self.database._lock.release()
+        return name
+
+    def ensure_index(self, key_or_list, cache_for=None, **kwargs):
+        return self.create_index(key_or_list, **kwargs)
+
+    def drop_index(self, index_or_name):
+        name = self._index_name(index_or_name)
+        if name not in self._indexes:
+            raise pymongo.errors.OperationFailure('index not found')
+        del self._indexes[name]
+
+    def drop_indexes(self):
+        self._indexes = {}
+
+    def index_information(self):
+        information = {'_id_': {'key': [('_id', 1)]}}
+        for name, index in self._indexes.items():
+            information[name] = {'key': list(index.fields)}
+            if index.unique:
+                information[name]['unique'] = True
+            if index.sparse:
+                information[name]['sparse'] = True
+        return information
+
+    def options(self):
+        return dict(self._options)
+
+    def map_reduce(self, *args, **kwargs):
+        raise pymongo.errors.OperationFailure('Map/reduce is not supported by '
+                                              'the memory backend')
+
+    def group(self, *args, **kwargs):
+        raise pymongo.errors.OperationFailure('group is not supported by the '
+                                              'memory backend')
+
+
+class _MemoryConnection(object):
+    """The connection of in-memory databases, for dropping them.
+    """
+
+    def __getitem__(self, name):
+        return get_database(name)
+
+    def drop_database(self, name_or_database):
+        drop_database(name_or_database)
+
+    def database_names(self):
+        return [name for name, database in _databases.items()
+                if database.collection_names()]
+
+
+class MemoryDatabase(object):
+    """A database of :class:`~mongoengine.memory.MemoryCollection`\ s, with
+    the methods and commands of PyMongo's databases that MongoEngine uses.
+    Use :func:`~mongoengine.memory.get_database` rather than creating
+    databases directly, so that every connection shares the same data.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.connection = _MemoryConnection()
+        self._collections = {}
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        self._lock.acquire()
+        try:
+            if name not in self._collections:
+                self._collections[name] = MemoryCollection(self, name)
+            return self._collections[name]
+        finally:
+            self._lock.release()
+
+    def __repr__(self):
+        return 'MemoryDatabase(%r)' % self.name
+
+    def authenticate(self, name, password):
+        return True
+
+    def collection_names(self):
+        return sorted(name for name, collection in self._collections.items()
+                      if collection._exists())
+
+    def create_collection(self, name, **options):
+        self._lock.acquire()
+        try:
+            collection = self[name]
+            if collection._exists():
+                raise pymongo.errors.CollectionInvalid('collection %s already '
+                                                       'exists' % name)
+            collection._options = dict(options)
+            collection._created = True
+            return collection
+        finally:
+            self._lock.release()
+
+    def drop_collection(self, name_or_collection):
+        name = name_or_collection
+        if isinstance(name_or_collection, MemoryCollection):
+            name = name_or_collection.name
+        self._lock.acquire()
+        try:
+            # Collection objects are cached (e.g. by QuerySetManager), so
+            # empty them rather than forgetting them
+            if name in self._collections:
+                self._collections[name]._clear()
+        finally:
+            self._lock.release()
+
+    def dereference(self, dbref):
+        return self[dbref.collection].find_one({'_id': dbref.id})
+
+    def eval(self, code, *args):
+        raise pymongo.errors.OperationFailure('Javascript (db.eval) is not '
+                                              'supported by the memory '
+                                              'backend')
+
+    def command(self, command, value=1, check=True, allowable_errors=[],
+                **kwargs):
+        if isinstance(command, basestring):
+            command = pymongo.son.SON([(command, value)])
+        command = pymongo.son.SON(command)
+        command.update(kwargs)
+        name = command.keys()[0]
+        handler = getattr(self, '_command_%s' % name.lower(), None)
+        if handler is None:
+            raise pymongo.errors.OperationFailure('command %r failed: no such '
+                                                  'cmd (not supported by the '
+                                                  'memory backend)' %
+                                                  dict(command))
+        self._lock.acquire()
+        try:
+            result = handler(command)
+        finally:
+            self._lock.release()
+        result['ok'] = 1.0
+        return result
+
+    def _command_count(self, command):
+        collection = self[command['count']]
+        cursor = collection.find(command.get('query'))
+        cursor.skip(command.get('skip', 0)).limit(command.get('limit', 0))
+        if command.get('hint') is not None:
+            cursor.hint(command['hint'].items())
+        if command.get('maxScan') is not None:
+            cursor.max_scan(command['maxScan'])
+        return {'n': float(cursor.count(with_limit_and_skip=True))}
+
+    def _command_distinct(self, command):
+        collection = self[command['distinct']]
+        cursor = collection.find(command.get('query'))
+        return {'values': cursor.distinct(command['key'])}
+
+    def _command_findandmodify(self, command):
+        collection = self[command['findandmodify']]
+        spec = _to_bson(command.get('query') or {})
+        sort = command.get('sort')
+        if sort is not None:
+            sort = sort.items()
+        keys = collection._find_keys(spec, sort, limit=1)
+        value = None
+        if command.get('remove'):
+            if keys:
+                value = collection._documents[keys[0]]
+                collection._remove(keys[0])
+        elif keys:
+            value = collection._documents[keys[0]]
+            updated = _apply_update(value, command['update'], spec)
+            collection._replace(keys[0], updated)
+            if command.get('new'):
+                value = updated
+        elif command.get('upsert'):
+            updated = _upsert_document(spec, command['update'])
+            if '_id' not in updated:
+                updated['_id'] = pymongo.objectid.ObjectId()
+            collection._insert(updated)
+            if command.get('new'):
+                value = updated
+        if value is not None:
+            value = _project(value, command.get('fields'))
+        return {'value': value}
+
+    def _command_filemd5(self, command):
+        chunks = self['%s.chunks' % command.get('root', 'fs')]
+        chunks = chunks.find({'files_id': command['filemd5']},
+                             sort=[('n', 1)])
+        md5 = hashlib.md5()
+        for chunk in chunks:
+            md5.update(str(chunk['data']))
+        return {'md5': unicode(md5.hexdigest()), 'numChunks': chunks.count()}
+
+    def _command_collstats(self, command):
+        collection = self[command['collstats']]
+        size = sum(len(repr(document))
+                   for document in collection._documents.values())
+        count = len(collection._documents)
+        return {'ns': collection.full_name, 'count': count, 'size': size,
+                'avgObjSize': count and float(size) / count or 0.0,
+                'nindexes': len(collection._indexes) + 1,
+                'capped': bool(collection._options.get('capped'))}
@@ -1,20 +1,60 @@
 from connection import _get_db
+from cache import (LocalCache, get_result_cache, get_collection_version,
+                   bump_collection_version, make_key)
+from advisor import record_query, get_strict_indexes, get_scan_verdict
+from compression import is_compressed
 
 import pprint
 import pymongo
+import pymongo.binary
 import pymongo.code
+import pymongo.cursor
 import pymongo.dbref
+import pymongo.json_util
 import pymongo.objectid
+import pymongo.son
 import re
 import copy
 import itertools
+import base64
+import hashlib
+import json
+import warnings
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __all__ = ['queryset_manager', 'Q', 'InvalidQueryError',
-           'InvalidCollectionError']
+           'InvalidCollectionError', 'UnindexedQueryError']
 
 # The maximum number of items to display in a QuerySet.__repr__
 REPR_OUTPUT_SIZE = 20
 
+# The default maximum number of documents held by a QuerySet's result cache
+CACHE_MAX_SIZE = 1000
+
+# The number of map/reduce results whose documents are loaded at a time
+MAP_REDUCE_BATCH_SIZE = 100
+
+# Cursor options that aren't supported by older versions of PyMongo
+_CURSOR_MAX_SCAN = hasattr(pymongo.cursor.Cursor, 'max_scan')
+_CURSOR_MAX_TIME_MS = hasattr(pymongo.cursor.Cursor, 'max_time_ms')
+
+# The number of Javascript functions kept with their field names substituted
+SUB_JS_FIELDS_CACHE_SIZE = 200
+
+# Javascript code with field names substituted, keyed by document class and
+# the original code. Code may be built dynamically, so the least recently
+# used entries are evicted
+_sub_js_fields_cache = LocalCache(max_entries=SUB_JS_FIELDS_CACHE_SIZE,
+                                  timeout=None)
+
+# The Javascript functions this process has stored on the server, as
+# (database, function name) pairs
+_stored_js_functions = set()
+
 
 class DoesNotExist(Exception):
     pass
@@ -32,6 +72,10 @@ class OperationError(Exception):
     pass
 
 
+class UnindexedQueryError(OperationError):
+    pass
+
+
 class InvalidCollectionError(Exception):
     pass
 
@@ -281,10 +325,14 @@ class QuerySet(object):
         self._query_obj = Q()
         self._initial_query = {}
         self._where_clause = None
-        self._loaded_fields = []
+        self._loaded_fields = {}
         self._ordering = []
         self._snapshot = False
         self._timeout = True
+        self._hint = None
+        self._max_scan = None
+        self._max_time_ms = None
+        self._cursor_checked = False
 
         # If inheritance is allowed, only return instances and instances of
         # subclasses of the class being used
@@ -294,6 +342,22 @@ class QuerySet(object):
         self._limit = None
         self._skip = None
 
+        self._result_cache = None
+        self._result_cache_enabled = False
+        self._result_cache_max_size = CACHE_MAX_SIZE
+        self._result_cache_done = False
+        self._result_cache_position = 0
+        self._shared_cache_sons = None
+
+        self._stored_js = document._meta.get('stored_js', False)
+        self._strict_indexes = document._meta.get('strict_indexes')
+
+        cache_results = document._meta.get('cache_results', False)
+        self._shared_cache_enabled = bool(cache_results)
+        self._shared_cache_timeout = None
+        if not isinstance(cache_results, bool):
+            self._shared_cache_timeout = cache_results
+
     @property
     def _query(self):
         if self._mongo_query is None:
@@ -367,6 +431,7 @@ class QuerySet(object):
         self._query_obj &= query
         self._mongo_query = None
         self._cursor_obj = None
+        self._reset_result_cache()
         return self
 
     def filter(self, *q_objs, **query):
@@ -430,8 +495,10 @@ class QuerySet(object):
             if self._where_clause:
                 self._cursor_obj.where(self._where_clause)
 
-            # apply default ordering
-            if self._document._meta['ordering']:
+            # apply the queryset's ordering, falling back to the default
+            if self._ordering:
+                self._cursor_obj.sort(self._ordering)
+            elif self._document._meta['ordering']:
                 self.order_by(*self._document._meta['ordering'])
 
             if self._limit is not None:
@@ -440,8 +507,60 @@ class QuerySet(object):
             if self._skip is not None:
                 self._cursor_obj.skip(self._skip)
 
+            if self._hint is not None:
+                self._cursor_obj.hint(self._hint)
+
+            if self._max_scan is not None:
+                self._cursor_obj.max_scan(self._max_scan)
+
+            if self._max_time_ms is not None:
+                self._cursor_obj.max_time_ms(self._max_time_ms)
+
+            self._cursor_checked = False
+
         return self._cursor_obj
 
+    @property
+    def _checked_cursor(self):
+        """The cursor, for running the query. The first time the query is
+        run, its shape is recorded for the index advisor and, in strict index
+        mode, checked for its use of indexes.
+        """
+        cursor = self._cursor
+        if not self._cursor_checked:
+            query = self._query
+            if self._where_clause:
+                query = dict(query, **{'$where': self._where_clause})
+            record_query(self._document, query, self._ordering)
+            self._check_indexes(query)
+            self._cursor_checked = True
+        return cursor
+
+    def _check_indexes(self, query):
+        """In strict index mode, raise an
+        :class:`~mongoengine.queryset.UnindexedQueryError` (or warn) if the
+        query scans the whole collection. The plan for each query shape is
+        only checked once.
+        """
+        collection = self._document._meta['collection']
+        mode = self._strict_indexes
+        if mode is None:
+            mode = get_strict_indexes(collection)
+        if not mode or self._hint is not None:
+            # Queries with a hint use the index they were given
+            return
+
+        full_scan = get_scan_verdict(self._document, query, self._ordering,
+                                     self._cursor_obj.explain)
+        if full_scan:
+            fields = ', '.join(sorted(query.keys())) or 'no conditions'
+            message = (u'Query on collection "%s" (%s) does not use an index'
+                       % (collection, fields))
+            if mode == 'warn':
+                warnings.warn(message, RuntimeWarning)
+            else:
+                raise UnindexedQueryError(message)
+
     @classmethod
     def _lookup_field(cls, document, parts):
         """Lookup a field based on its attribute and return a list containing
@@ -559,18 +678,29 @@ class QuerySet(object):
         :class:`~mongoengine.queryset.DoesNotExist` or `DocumentName.DoesNotExist`
         if no results are found.
 
+        At most two documents are fetched, in a single query, which is enough
+        to tell whether the match is unique.
+
         .. versionadded:: 0.3
         """
         self.__call__(*q_objs, **query)
-        count = self.count()
-        if count == 1:
-            return self[0]
-        elif count > 1:
-            message = u'%d items returned, instead of 1' % count
+        results = []
+        if self._limit != 0:
+            limit = 2
+            if self._limit is not None:
+                limit = min(self._limit, limit)
+            cursor = self._checked_cursor.clone().limit(limit)
+            if self._shared_cache_enabled:
+                cursor = self._iter_shared_cache_results(cursor, 'get', limit)
+            results = [self._from_son(son) for son in cursor]
+
+        if len(results) == 1:
+            return results[0]
+        elif len(results) > 1:
+            message = u'2 or more items returned, instead of 1'
             raise self._document.MultipleObjectsReturned(message)
-        else:
-            raise self._document.DoesNotExist("%s matching query does not exist."
-                                              % self._document._class_name)
+        raise self._document.DoesNotExist("%s matching query does not exist."
+                                          % self._document._class_name)
 
     def get_or_create(self, *q_objs, **query):
         """Retrieve unique object or create, if it doesn't exist. Returns a tuple of 
@@ -582,24 +712,100 @@ class QuerySet(object):
         dictionary of default values for the new document may be provided as a
         keyword argument called :attr:`defaults`.
 
+        The document is created with a ``findAndModify`` upsert, which only
+        writes the new document's fields (``$setOnInsert``) if nothing matches
+        the query by then, so a document created concurrently is returned
+        rather than overwritten. A unique index covering the query also stops
+        concurrent upserts from creating a document each. Servers older than
+        2.4 don't support ``$setOnInsert``; the document is then inserted
+        after the lookup, with a warning if no unique index covers the query,
+        as concurrent calls may create duplicate documents.
+
         .. versionadded:: 0.3
+        .. versionchanged:: 0.5 - documents are created atomically
         """
         defaults = query.get('defaults', {})
         if 'defaults' in query:
             del query['defaults']
 
-        self.__call__(*q_objs, **query)
-        count = self.count()
-        if count == 0:
-            query.update(defaults)
-            doc = self._document(**query)
-            doc.save()
-            return doc, True
-        elif count == 1:
-            return self.first(), False
+        try:
+            return self.get(*q_objs, **query), False
+        except self._document.DoesNotExist:
+            pass
+
+        doc = self._document(**dict(query, **defaults))
+        doc.validate()
+        son = doc.to_mongo()
+        id_condition = self._query.get('_id')
+        if id_condition is not None and not isinstance(id_condition, dict):
+            # The upsert takes the id from the query
+            son.pop('_id', None)
+            object_id = id_condition
         else:
-            message = u'%d items returned, instead of 1' % count
-            raise self._document.MultipleObjectsReturned(message)
+            object_id = son.get('_id')
+            if object_id is None:
+                object_id = son['_id'] = pymongo.objectid.ObjectId()
+
+        if son:
+            try:
+                result = self._find_and_modify(update={'$setOnInsert': son},
+                                               upsert=True)
+            except OperationError, err:
+                if u'duplicate key' in unicode(err):
+                    # A concurrent upsert created the document first
+                    return self.get(*q_objs, **query), False
+                if u'$setOnInsert' not in unicode(err):
+                    raise
+            else:
+                if result['value'] is not None:
+                    return self._from_son(result['value']), False
+                return self._set_created_id(doc, object_id), True
+
+        if not self._has_unique_index():
+            message = (u'get_or_create on collection "%s" may create '
+                       u'duplicate documents, as no unique index covers its '
+                       u'query' % self._collection.name)
+            warnings.warn(message, RuntimeWarning)
+        collection = self._collection
+        try:
+            object_id = collection.insert(doc.to_mongo(), safe=True)
+        except pymongo.errors.OperationFailure, err:
+            if u'duplicate key' not in unicode(err):
+                raise OperationError(u'Could not save document (%s)' %
+                                     unicode(err))
+            # Another process created a matching document since the lookup
+            # above, which is returned as it is rather than overwritten
+            try:
+                return self.get(*q_objs, **query), False
+            except self._document.DoesNotExist:
+                raise OperationError(u'Tried to save duplicate unique keys '
+                                     u'(%s)' % unicode(err))
+        finally:
+            self._bump_collection_version()
+        return self._set_created_id(doc, object_id), True
+
+    def _set_created_id(self, doc, object_id):
+        """Set the id of a document that has just been inserted, returning
+        it.
+        """
+        id_field = self._document._meta['id_field']
+        doc[id_field] = doc._fields[id_field].to_python(object_id)
+        doc._changed_fields = set()
+        return doc
+
+    def _has_unique_index(self):
+        """Return whether a unique index (or the ``_id`` index) covers the
+        equality conditions of the query, so that no two documents can match
+        it.
+        """
+        keys = set(key for key, condition in self._query.items()
+                   if not isinstance(condition, dict))
+        for name, index in self._collection.index_information().items():
+            if name != '_id_' and not index.get('unique'):
+                continue
+            if set(field for field, direction in index['key']) <= keys:
+                return True
+        return False
 
     def create(self, **kwargs):
         """Create new object. Returns the saved object instance.
@@ -610,6 +816,42 @@ class QuerySet(object):
         doc.save()
         return doc
 
+    def insert(self, docs, safe=True, validate=True):
+        """Insert a list of new :class:`~mongoengine.Document` objects in a
+        single round trip, setting their ids. This is much faster than saving
+        the documents one by one.
+
+        :param docs: a list of documents to insert
+        :param safe: check if the operation succeeded before returning
+        :param validate: validates the documents; set to ``False`` to skip.
+
+        .. versionadded:: 0.5
+        """
+        if validate:
+            for doc in docs:
+                doc.validate()
+        object_ids = self._insert_raw([doc.to_mongo() for doc in docs],
+                                      safe=safe)
+        id_field = self._document._meta['id_field']
+        for doc, object_id in zip(docs, object_ids):
+            doc[id_field] = doc._fields[id_field].to_python(object_id)
+        return docs
+
+    def _insert_raw(self, sons, safe=True):
+        """Insert a list of PyMongo SON objects, returning their ids.
+        """
+        if not sons:
+            return []
+        try:
+            return self._collection.insert(sons, safe=safe)
+        except pymongo.errors.OperationFailure, err:
+            message = u'Could not insert documents (%s)'
+            if u'duplicate key' in unicode(err):
+                message = u'Tried to insert duplicate unique keys (%s)'
+            raise OperationError(message % unicode(err))
+        finally:
+            self._bump_collection_version()
+
     def first(self):
         """Retrieve the first object matching the query.
         """
@@ -655,30 +897,207 @@ class QuerySet(object):
         try:
             if self._limit == 0:
                 raise StopIteration
-            return self._document._from_son(self._cursor.next())
+            if self._result_cache_done:
+                return self._next_cached()
+            if self._shared_cache_enabled:
+                if self._shared_cache_sons is None:
+                    cursor = self._checked_cursor.clone()
+                    self._shared_cache_sons = \
+                        self._iter_shared_cache_results(cursor)
+                son = self._shared_cache_sons.next()
+            else:
+                son = self._checked_cursor.next()
+
+            doc = self._from_son(son)
+            if self._result_cache is not None:
+                self._result_cache.append(doc)
+                if len(self._result_cache) > self._result_cache_max_size:
+                    # Too many results to hold in memory, stop caching until
+                    # the queryset is next rewound
+                    self._result_cache = None
+            return doc
         except StopIteration, e:
+            if self._result_cache is not None:
+                self._result_cache_done = True
             self.rewind()
             raise e
 
+    def _next_cached(self):
+        """Return the next document from the result cache.
+        """
+        position = self._result_cache_position
+        if position >= len(self._result_cache):
+            raise StopIteration
+        self._result_cache_position += 1
+        return self._result_cache[position]
+
     def rewind(self):
         """Rewind the cursor to its unevaluated state.
 
         .. versionadded:: 0.3
         """
+        self._result_cache_position = 0
+        self._shared_cache_sons = None
+        if not (self._result_cache_done and self._result_cache_enabled):
+            # Any partially filled cache will be refilled from the start
+            self._reset_result_cache()
         self._cursor.rewind()
 
+    def cache(self, enabled=True, max_size=CACHE_MAX_SIZE):
+        """Enable or disable caching of the results of this queryset. When
+        enabled, documents are kept as the results are iterated over, and once
+        all of the results have been fetched, further iteration, indexing,
+        :meth:`~mongoengine.queryset.QuerySet.count`,
+        :meth:`~mongoengine.queryset.QuerySet.first` and :func:`repr` are
+        served from memory rather than querying the database again. ::
+
+            posts = BlogPost.objects(published=True).cache()
+            titles = [post.title for post in posts]   # queries the database
+            authors = [post.author for post in posts] # served from the cache
+
+        The cache is discarded when the queryset is modified (e.g. filtered,
+        reordered or sliced). As a safeguard against very large results,
+        caching is abandoned for an iteration that returns more than
+        ``max_size`` documents.
+
+        :param enabled: whether or not results are cached
+        :param max_size: the maximum number of documents to cache
+
+        .. versionadded:: 0.5
+        """
+        self._result_cache_enabled = enabled
+        self._result_cache_max_size = max_size
+        self._reset_result_cache()
+        if self._cursor_obj is not None:
+            self._cursor_obj.rewind()
+        return self
+
+    def cache_results(self, enabled=True, timeout=None):
+        """Enable or disable the shared result cache for this queryset. Unlike
+        :meth:`~mongoengine.queryset.QuerySet.cache`, cached results are shared
+        between querysets (and, depending on the backend, processes), which
+        suits hot queries on collections that rarely change. ::
+
+            settings = Setting.objects(site=site).cache_results(timeout=60)
+
+        Results are cached by collection, query, ordering, skip, limit and
+        selected fields. Every write made through MongoEngine (saving or
+        deleting documents, or updating or deleting through a queryset)
+        increases a version number kept for the collection, so stale results
+        are never served by this process. The cache may also be enabled for
+        every query on a document by setting ``cache_results`` in its
+        :attr:`meta` dictionary to ``True`` or to a timeout in seconds.
+
+        The backend is set with :func:`~mongoengine.cache.set_result_cache`;
+        by default results are kept in an in-process LRU cache.
+
+        :param enabled: whether or not the shared result cache is used
+        :param timeout: the number of seconds results are cached for; the
+            backend's default timeout is used if ``None``
+
+        .. versionadded:: 0.5
+        """
+        self._shared_cache_enabled = enabled
+        self._shared_cache_timeout = timeout
+        self._reset_result_cache()
+        return self
+
+    def _iter_shared_cache_results(self, cursor, *key_parts):
+        """Yield the SON documents for a cursor from the shared result cache.
+        On a miss, the query's results are streamed, and cached once they
+        have all been read unless there are more than the result cache's
+        maximum size.
+        """
+        collection = self._collection_obj.full_name
+        fields = None
+        if self._loaded_fields:
+            fields = self._loaded_fields
+        key = make_key(collection, get_collection_version(collection),
+                       self._query, self._where_clause, self._ordering,
+                       self._skip, self._limit, fields, self._max_scan,
+                       self._max_time_ms, key_parts)
+
+        backend = get_result_cache()
+        sons = backend.get(key)
+        if sons is not None:
+            for son in sons:
+                yield son
+            return
+
+        sons = []
+        for son in cursor:
+            if sons is not None:
+                sons.append(son)
+                if len(sons) > self._result_cache_max_size:
+                    sons = None
+            yield son
+        if sons is not None:
+            backend.set(key, sons, self._shared_cache_timeout)
+
+    def _bump_collection_version(self):
+        """Mark the collection as changed, so that no results cached before
+        the change are served.
+        """
+        bump_collection_version(self._collection_obj.full_name)
+
+    def _reset_result_cache(self):
+        """Discard any cached results, e.g. as the query has changed.
+        """
+        self._result_cache = None
+        if self._result_cache_enabled:
+            self._result_cache = []
+        self._result_cache_done = False
+        self._result_cache_position = 0
+        self._shared_cache_sons = None
+
     def count(self):
         """Count the selected elements in the query.
         """
         if self._limit == 0:
             return 0
-        return self._cursor.count(with_limit_and_skip=True)
+        if self._result_cache_done:
+            return len(self._result_cache)
+        if self._hint is not None or self._max_time_ms is not None or \
+           self._max_scan is not None:
+            return self._count_command()
+        return self._checked_cursor.count(with_limit_and_skip=True)
+
+    def _count_command(self):
+        """Count the selected documents with a count command, which (unlike
+        cursors' counts) honours the query's hint, scan limit and time limit.
+        """
+        # Record the query for the index advisor, as for any other query
+        self._checked_cursor
+        query = self._query
+        if self._where_clause:
+            query = dict(query, **{'$where': self._where_clause})
+
+        command = pymongo.son.SON([
+            ('count', self._collection.name),
+            ('query', query),
+        ])
+        if self._limit:
+            command['limit'] = self._limit
+        if self._skip:
+            command['skip'] = self._skip
+        if self._hint is not None:
+            command['hint'] = pymongo.son.SON(self._hint)
+        if self._max_scan is not None:
+            command['maxScan'] = self._max_scan
+        if self._max_time_ms is not None:
+            command['maxTimeMS'] = self._max_time_ms
+
+        try:
+            result = self._collection.database.command(command)
+        except pymongo.errors.OperationFailure, err:
+            raise OperationError(u'Count failed (%s)' % unicode(err))
+        return int(result['n'])
 
     def __len__(self):
         return self.count()
 
     def map_reduce(self, map_f, reduce_f, finalize_f=None, limit=None,
-                   scope=None, keep_temp=False):
+                   scope=None, keep_temp=False, output=None):
         """Perform a map/reduce query using the current query spec
         and ordering. While ``map_reduce`` respects ``QuerySet`` chaining,
         it must be the last call made, as it does not return a maleable
@@ -697,15 +1116,27 @@ class QuerySet(object):
         :param limit: number of objects from current query to provide
                       to map/reduce method
         :param keep_temp: keep temporary table (boolean, default ``True``)
+        :param output: where to put the results; ``'inline'`` returns them
+            directly without writing them to a collection (they must fit in
+            a single document), the name of a collection replaces that
+            collection with the results, and a dictionary with a
+            ``'replace'``, ``'merge'`` or ``'reduce'`` key and a collection
+            name combines the results with that collection's contents. By
+            default the results are written to a temporary collection.
+            Results are sorted by the queryset's ordering, which for inline
+            results is done in the client.
 
         Returns an iterator yielding
-        :class:`~mongoengine.document.MapReduceDocument`.
+        :class:`~mongoengine.document.MapReduceDocument`. The documents
+        referenced by the results' keys are loaded in batches, the first time
+        the :attr:`object` of a result in each batch is accessed.
 
         .. note:: Map/Reduce requires server version **>= 1.1.1**. The PyMongo
            :meth:`~pymongo.collection.Collection.map_reduce` helper requires
            PyMongo version **>= 1.2**.
 
         .. versionadded:: 0.3
+        .. versionchanged:: 0.5 - Added ``output``
         """
         from document import MapReduceDocument
 
@@ -716,14 +1147,13 @@ class QuerySet(object):
         if isinstance(map_f, pymongo.code.Code):
             map_f_scope = map_f.scope
             map_f = unicode(map_f)
-        map_f = pymongo.code.Code(self._sub_js_fields(map_f), map_f_scope)
+        map_f_code = self._sub_js_fields(map_f)
 
         reduce_f_scope = {}
         if isinstance(reduce_f, pymongo.code.Code):
             reduce_f_scope = reduce_f.scope
             reduce_f = unicode(reduce_f)
         reduce_f_code = self._sub_js_fields(reduce_f)
-        reduce_f = pymongo.code.Code(reduce_f_code, reduce_f_scope)
 
         mr_args = {'query': self._query, 'keeptemp': keep_temp}
 
@@ -733,8 +1163,6 @@ class QuerySet(object):
                 finalize_f_scope = finalize_f.scope
                 finalize_f = unicode(finalize_f)
             finalize_f_code = self._sub_js_fields(finalize_f)
-            finalize_f = pymongo.code.Code(finalize_f_code, finalize_f_scope)
-            mr_args['finalize'] = finalize_f
 
         if scope:
             mr_args['scope'] = scope
@@ -742,15 +1170,85 @@ class QuerySet(object):
         if limit:
             mr_args['limit'] = limit
 
-        results = self._collection.map_reduce(map_f, reduce_f, **mr_args)
-        results = results.find()
+        def run():
+            map_js = self._get_js_function(map_f_code, map_f_scope)
+            reduce_js = self._get_js_function(reduce_f_code, reduce_f_scope)
+            if finalize_f:
+                mr_args['finalize'] = self._get_js_function(finalize_f_code,
+                                                            finalize_f_scope)
+            if output is None:
+                results = self._collection.map_reduce(map_js, reduce_js,
+                                                      **mr_args)
+                return results.find()
+            return self._map_reduce_command(map_js, reduce_js, output,
+                                            mr_args)
+        results = self._run_js(run)
 
         if self._ordering:
-            results = results.sort(self._ordering)
+            if output == 'inline':
+                # Inline results aren't a cursor, so they are sorted here
+                results = _sort_sons(results, self._ordering)
+            else:
+                results = results.sort(self._ordering)
+
+        # Group the results into batches, so the documents they reference
+        # may be loaded together
+        results = iter(results)
+        while True:
+            batch = []
+            for doc in itertools.islice(results, MAP_REDUCE_BATCH_SIZE):
+                batch.append(MapReduceDocument(self._document,
+                                               self._collection, doc['_id'],
+                                               doc['value'], batch=batch))
+            if not batch:
+                break
+            for doc in batch:
+                yield doc
+
+    def _map_reduce_command(self, map_f, reduce_f, output, mr_args):
+        """Run a mapreduce command writing its results to ``output``,
+        returning the results (a list, for inline output) or a cursor over
+        the collection they were written to.
+        """
+        if output == 'inline':
+            out = {'inline': 1}
+        elif isinstance(output, basestring):
+            out = output
+        else:
+            actions = [key for key in output
+                       if key in ('replace', 'merge', 'reduce')]
+            if len(actions) != 1:
+                raise InvalidQueryError('Map/reduce output must have one of '
+                                        'the keys "replace", "merge" or '
+                                        '"reduce"')
+            out = pymongo.son.SON([(actions[0], output[actions[0]])])
+            out.update(output)
+
+        command = pymongo.son.SON([
+            ('mapreduce', self._collection.name),
+            ('map', map_f),
+            ('reduce', reduce_f),
+            ('out', out),
+        ])
+        command.update(mr_args)
+        command.pop('keeptemp', None)
+
+        database = self._collection.database
+        try:
+            result = database.command(command)
+        except pymongo.errors.OperationFailure, err:
+            raise OperationError(u'Map/reduce failed (%s)' % unicode(err))
+
+        if output == 'inline':
+            return result['results']
 
-        for doc in results:
-            yield MapReduceDocument(self._document, self._collection,
-                                    doc['_id'], doc['value'])
+        collection = result['result']
+        if isinstance(collection, dict):
+            database = database.connection[collection['db']]
+            collection = collection['collection']
+        collection = database[collection]
+        bump_collection_version(collection.full_name)
+        return collection.find()
 
     def limit(self, n):
         """Limit the number of returned documents to `n`. This may also be
@@ -763,6 +1261,7 @@ class QuerySet(object):
         else:
             self._cursor.limit(n)
         self._limit = n
+        self._reset_result_cache()
 
         # Return self to allow chaining
         return self
@@ -775,6 +1274,7 @@ class QuerySet(object):
         """
         self._cursor.skip(n)
         self._skip = n
+        self._reset_result_cache()
         return self
 
     def __getitem__(self, key):
@@ -782,9 +1282,14 @@ class QuerySet(object):
         """
         # Slice provided
         if isinstance(key, slice):
+            self._reset_result_cache()
             try:
                 self._cursor_obj = self._cursor[key]
+                # Like limit(), keep the number of documents rather than the
+                # index to stop at
                 self._skip, self._limit = key.start, key.stop
+                if key.stop is not None:
+                    self._limit = key.stop - (key.start or 0)
             except IndexError, err:
                 # PyMongo raises an error if key.start == key.stop, catch it,
                 # bin it, kill it. 
@@ -799,9 +1304,142 @@ class QuerySet(object):
             return self
         # Integer index provided
         elif isinstance(key, int):
-            return self._document._from_son(self._cursor[key])
+            if self._result_cache is not None:
+                if self._result_cache_done or 0 <= key < len(self._result_cache):
+                    return self._result_cache[key]
+            if self._shared_cache_enabled:
+                cursor = self._checked_cursor.clone()
+                cursor = cursor.skip((self._skip or 0) + key)
+                cursor = list(self._iter_shared_cache_results(
+                    cursor.limit(1), 'index', key))
+                if not cursor:
+                    raise IndexError('no such item for Cursor instance')
+                return self._from_son(cursor[0])
+            return self._from_son(self._checked_cursor[key])
         raise AttributeError
 
+    def after(self, last=None, limit=None):
+        """Seek past a document in the queryset's ordering, for keyset
+        ("seek") pagination. Unlike :meth:`~mongoengine.queryset.QuerySet.skip`,
+        which makes the server walk over every skipped document, the sort keys
+        of the last document seen are turned into a range query, so every page
+        is as cheap to fetch as the first one::
+
+            feed = Activity.objects.order_by('-created')
+            page = list(feed.after(limit=50))
+            token = feed.continuation_token(page[-1])
+            ...
+            page = list(Activity.objects.order_by('-created').after(token,
+                                                                    limit=50))
+
+        The primary key is added to the ordering as a final tie-breaker, so
+        pages never overlap or miss documents that share sort keys. The sort
+        fields should be present on every document and loaded on the document
+        used to seek.
+
+        :param last: the last document of the previous page, or a token
+            returned by :meth:`~mongoengine.queryset.QuerySet.continuation_token`;
+            if ``None`` the first page is returned
+        :param limit: the maximum number of documents to return
+
+        .. versionadded:: 0.5
+        """
+        ordering = self._get_keyset_ordering()
+        self._ordering = ordering
+
+        if last is not None:
+            if isinstance(last, basestring):
+                values = self._decode_continuation_token(last, ordering)
+            else:
+                values = self._get_keyset_values(last, ordering)
+
+            # (a > x) or (a == x and b > y) or (a == x and b == y and c > z)...
+            clauses = []
+            for i, (key, direction) in enumerate(ordering):
+                clause = dict(zip([k for k, d in ordering[:i]], values[:i]))
+                operator = '$gt'
+                if direction == pymongo.DESCENDING:
+                    operator = '$lt'
+                clause[key] = {operator: values[i]}
+                clauses.append(clause)
+            # The clauses are kept in a single raw $or, as the query tree would
+            # otherwise merge them with the query's own conditions on the
+            # same fields (e.g. two $lt conditions on a field)
+            self._query_obj &= Q(__raw__={'$or': clauses})
+            self._mongo_query = None
+
+        self._cursor_obj = None
+        self._reset_result_cache()
+        if limit is not None:
+            self.limit(limit)
+        return self
+
+    def continuation_token(self, document):
+        """Return an opaque token that may be passed to
+        :meth:`~mongoengine.queryset.QuerySet.after` to fetch the documents
+        following ``document`` in the queryset's ordering. Tokens are URL-safe
+        strings, so they may be handed out to clients.
+
+        :param document: the last document of the current page
+
+        .. versionadded:: 0.5
+        """
+        ordering = self._get_keyset_ordering()
+        values = self._get_keyset_values(document, ordering)
+        token = {'keys': ordering, 'values': values}
+        token = json.dumps(token, default=pymongo.json_util.default)
+        return base64.urlsafe_b64encode(token)
+
+    def _get_keyset_ordering(self):
+        """Return the ordering used for keyset pagination - the queryset's
+        ordering, finished off with the primary key to make it unique.
+        """
+        ordering = list(self._ordering)
+        if not ordering and self._document._meta['ordering']:
+            ordering = self._get_order_key_list(
+                *self._document._meta['ordering'])
+
+        if '_id' not in [key for key, direction in ordering]:
+            direction = pymongo.ASCENDING
+            if ordering:
+                direction = ordering[-1][1]
+            ordering.append(('_id', direction))
+        return ordering
+
+    def _get_keyset_values(self, document, ordering):
+        """Extract the values of the sort keys from a document.
+        """
+        son = document.to_mongo()
+        son['_id'] = self._document._fields[
+            self._document._meta['id_field']].to_mongo(document.pk)
+        values = []
+        for key, direction in ordering:
+            value = son
+            for part in key.split('.'):
+                if not isinstance(value, dict):
+                    value = None
+                    break
+                value = value.get(part)
+            values.append(value)
+        return values
+
+    def _decode_continuation_token(self, token, ordering):
+        """Decode a continuation token, checking that it was created for the
+        same ordering.
+        """
+        try:
+            token = base64.urlsafe_b64decode(str(token))
+            token = json.loads(token, object_hook=pymongo.json_util.object_hook)
+            keys = [(key, direction) for key, direction in token['keys']]
+            values = token['values']
+        except (TypeError, ValueError, KeyError):
+            raise InvalidQueryError('Invalid continuation token')
+
+        if keys != ordering or len(values) != len(ordering):
+            raise InvalidQueryError('Continuation token does not match the '
+                                    'ordering of the queryset')
+        return values
+
     def distinct(self, field):
         """Return a list of distinct values for a given field.
 
@@ -809,30 +1447,98 @@ class QuerySet(object):
 
         .. versionadded:: 0.4
         """
-        return self._cursor.distinct(field)
+        return self._checked_cursor.distinct(field)
 
     def only(self, *fields):
-        """Load only a subset of this document's fields. ::
+        """Load only a subset of this document's fields. Fields on embedded
+        documents may be given using dot-notation. ::
 
-            post = BlogPost.objects(...).only("title")
+            post = BlogPost.objects(...).only("title", "author.name")
 
         :param fields: fields to include
 
         .. versionadded:: 0.3
+        .. versionchanged:: 0.5 - Added subfield support
+        """
+        self._set_loaded_fields(fields, 1)
+        return self
+
+    def exclude(self, *fields):
+        """Load all but a subset of this document's fields. Fields on embedded
+        documents may be given using dot-notation. ::
+
+            post = BlogPost.objects(...).exclude("comments")
+
+        :param fields: fields to exclude
+
+        .. versionadded:: 0.5
+        """
+        self._set_loaded_fields(fields, 0)
+        return self
+
+    def fields(self, **kwargs):
+        """Manipulate how the fields of the returned documents are loaded,
+        using Django-style keyword arguments. Fields are included with a value
+        of ``1`` and excluded with ``0``, and the items of a list field may be
+        limited by prefixing the field name with ``slice__`` and giving a
+        number of items (negative to count from the end) or a ``[skip,
+        limit]`` pair::
+
+            post = BlogPost.objects(...).fields(slice__comments=5)
+
+        :param kwargs: the fields to include, exclude or slice
+
+        .. versionadded:: 0.5
         """
-        self._loaded_fields = []
+        includes = []
+        excludes = []
+        for key, value in kwargs.items():
+            parts = key.split('__')
+            if parts[0] == 'slice':
+                field = QuerySet._translate_field_name(self._document,
+                                                       '.'.join(parts[1:]))
+                self._loaded_fields[field] = {'$slice': value}
+                self._reset_result_cache()
+            elif value:
+                includes.append('.'.join(parts))
+            else:
+                excludes.append('.'.join(parts))
+
+        if includes and excludes:
+            raise InvalidQueryError('Fields cannot be both included and '
+                                    'excluded')
+        if includes:
+            self._set_loaded_fields(includes, 1)
+        elif excludes:
+            self._set_loaded_fields(excludes, 0)
+        return self
+
+    def _set_loaded_fields(self, fields, value):
+        """Replace the fields included or excluded from the results (keeping
+        any list slices) with the given fields.
+        """
+        self._loaded_fields = dict((field, spec) for field, spec
+                                   in self._loaded_fields.items()
+                                   if isinstance(spec, dict))
         for field in fields:
-            if '.' in field:
-                raise InvalidQueryError('Subfields cannot be used as '
-                                        'arguments to QuerySet.only')
             # Translate field name
-            field = QuerySet._lookup_field(self._document, field)[-1].db_field
-            self._loaded_fields.append(field)
+            field = QuerySet._translate_field_name(self._document, field)
+            self._loaded_fields[field] = value
 
         # _cls is needed for polymorphism
-        if self._document._meta.get('allow_inheritance'):
-            self._loaded_fields += ['_cls']
-        return self
+        if value and self._document._meta.get('allow_inheritance'):
+            self._loaded_fields['_cls'] = 1
+        self._reset_result_cache()
+
+    def _from_son(self, son):
+        """Create a document from a PyMongo SON returned by the query, noting
+        which of its fields were loaded if the query didn't fetch them all.
+        """
+        doc = self._document._from_son(son)
+        if doc is not None and self._loaded_fields:
+            doc._loaded_fields = _get_loaded_fields(doc.__class__,
+                                                    self._loaded_fields)
+        return doc
 
     def order_by(self, *keys):
         """Order the :class:`~mongoengine.queryset.QuerySet` by the keys. The
@@ -842,6 +1548,16 @@ class QuerySet(object):
         :param keys: fields to order the query results by; keys may be
             prefixed with **+** or **-** to determine the ordering direction
         """
+        key_list = self._get_order_key_list(*keys)
+        self._ordering = key_list
+        self._cursor.sort(key_list)
+        self._reset_result_cache()
+        return self
+
+    def _get_order_key_list(self, *keys):
+        """Build a PyMongo sort specification from ordering keys prefixed with
+        **+** or **-**.
+        """
         key_list = []
         for key in keys:
             if not key: continue
@@ -851,11 +1567,14 @@ class QuerySet(object):
             if key[0] in ('-', '+'):
                 key = key[1:]
             key = key.replace('__', '.')
+            try:
+                key = QuerySet._translate_field_name(self._document, key)
+            except (KeyError, AttributeError, InvalidQueryError):
+                # Not a known field (e.g. a map/reduce result's value), so use
+                # the key as it is
+                pass
             key_list.append((key, direction))
-
-        self._ordering = key_list
-        self._cursor.sort(key_list)
-        return self
+        return key_list
 
     def explain(self, format=False):
         """Return an explain plan record for the
@@ -869,6 +1588,65 @@ class QuerySet(object):
             plan = pprint.pformat(plan)
         return plan
 
+    def hint(self, index_spec):
+        """Tell the server which index to use for the query, rather than
+        leaving it to the query planner. The index is given in the same way
+        as in the ``indexes`` :attr:`meta` option: a field name or a tuple of
+        field names, optionally prefixed with **+** or **-**, with ``_types``
+        added to the front automatically for documents that allow
+        inheritance. ::
+
+            Order.objects(customer=c, status='open').hint(('customer', '-date'))
+
+        Queries with a hint are never refused by strict index mode.
+
+        :param index_spec: the index to use, or ``None`` to remove the hint
+
+        .. versionadded:: 0.5
+        """
+        if index_spec is not None:
+            index_spec = QuerySet._build_index_spec(self._document, index_spec)
+        self._hint = index_spec
+        # The cursor is rebuilt with the new hint, or none
+        self._cursor_obj = None
+        self._reset_result_cache()
+        return self
+
+    def max_time_ms(self, ms):
+        """Limit the time the server may spend running the query, in
+        milliseconds. Queries that run out of time raise an error.
+
+        Requires PyMongo **>= 2.7** and MongoDB **>= 2.6**.
+
+        :param ms: the maximum number of milliseconds, or ``None`` for no
+            limit
+
+        .. versionadded:: 0.5
+        """
+        if ms is not None and not _CURSOR_MAX_TIME_MS:
+            raise OperationError('max_time_ms requires PyMongo >= 2.7')
+        self._max_time_ms = ms
+        self._cursor_obj = None
+        self._reset_result_cache()
+        return self
+
+    def max_scan(self, n):
+        """Limit the number of documents (or index entries) the server may
+        scan while running the query. When the limit is reached, the
+        documents found so far are returned.
+
+        :param n: the maximum number of documents to scan, or ``None`` for
+            no limit
+
+        .. versionadded:: 0.5
+        """
+        if n is not None and not _CURSOR_MAX_SCAN:
+            raise OperationError('max_scan requires PyMongo >= 1.7')
+        self._max_scan = n
+        self._cursor_obj = None
+        self._reset_result_cache()
+        return self
+
     def snapshot(self, enabled):
         """Enable or disable snapshot mode when querying.
 
@@ -888,7 +1666,10 @@ class QuerySet(object):
 
         :param safe: check if the operation succeeded before returning
         """
-        self._collection.remove(self._query, safe=safe)
+        try:
+            self._collection.remove(self._query, safe=safe)
+        finally:
+            self._bump_collection_version()
 
     @classmethod
     def _transform_update(cls, _doc_cls=None, **update):
@@ -942,6 +1723,76 @@ class QuerySet(object):
 
         return mongo_update
 
+    def modify(self, new=False, upsert=False, remove=False, **update):
+        """Atomically update (or remove) the first document matched by the
+        query and return it, using MongoDB's ``findAndModify`` command. The
+        query's ordering decides which document is modified, and only the
+        fields selected with :meth:`~mongoengine.queryset.QuerySet.only` are
+        loaded. ::
+
+            job = Job.objects(state='queued').order_by('+created').modify(
+                new=True, set__state='running')
+
+        Returns ``None`` if no document matched the query.
+
+        :param new: return the document as it is after the update, rather than
+            before it
+        :param upsert: insert a new document if no document matched the query
+        :param remove: remove the matched document rather than updating it
+        :param update: Django-style update keyword arguments
+
+        .. note:: ``findAndModify`` requires server version **>= 1.3.0**.
+
+        .. versionadded:: 0.5
+        """
+        if remove and update:
+            raise OperationError('Conflicting parameters: update and remove')
+        if not remove and not update:
+            raise OperationError('No update parameters, would remove data')
+
+        update = QuerySet._transform_update(self._document, **update)
+        result = self._find_and_modify(update=update, upsert=upsert, new=new,
+                                       remove=remove, sort=True, fields=True)
+        if result['value'] is None:
+            return None
+        return self._from_son(result['value'])
+
+    def _find_and_modify(self, update=None, upsert=False, new=False,
+                         remove=False, sort=False, fields=False):
+        """Run a findAndModify command for the current query, returning the
+        raw command response. The matched (or new) document is available as
+        the response's ``value``, which is ``None`` if nothing matched.
+        """
+        command = pymongo.son.SON([
+            ('findandmodify', self._collection.name),
+            ('query', self._query),
+        ])
+        if sort:
+            ordering = self._ordering
+            if not ordering and self._document._meta['ordering']:
+                ordering = self._get_order_key_list(
+                    *self._document._meta['ordering'])
+            if ordering:
+                command['sort'] = pymongo.son.SON(ordering)
+        if fields and self._loaded_fields:
+            command['fields'] = self._loaded_fields
+        if remove:
+            command['remove'] = True
+        else:
+            command['update'] = update
+            command['new'] = new
+            command['upsert'] = upsert
+
+        try:
+            return self._collection.database.command(command)
+        except pymongo.errors.OperationFailure, err:
+            # Older servers report a miss as an error rather than a null value
+            if u'No matching object found' in unicode(err):
+                return {'value': None}
+            raise OperationError(u'Find and modify failed (%s)' % unicode(err))
+        finally:
+            self._bump_collection_version()
+
     def update(self, safe_update=True, upsert=False, **update):
         """Perform an atomic update on the fields matched by the query. When 
         ``safe_update`` is used, the number of affected documents is returned.
@@ -965,6 +1816,8 @@ class QuerySet(object):
                 message = u'update() method requires MongoDB 1.1.3+'
                 raise OperationError(message)
             raise OperationError(u'Update failed (%s)' % unicode(err))
+        finally:
+            self._bump_collection_version()
 
     def update_one(self, safe_update=True, upsert=False, **update):
         """Perform an atomic update on first field matched by the query. When 
@@ -990,6 +1843,8 @@ class QuerySet(object):
                 return ret['n']
         except pymongo.errors.OperationFailure, e:
             raise OperationError(u'Update failed [%s]' % unicode(e))
+        finally:
+            self._bump_collection_version()
 
     def __iter__(self):
         return self
@@ -1000,6 +1855,11 @@ class QuerySet(object):
         substituted for the MongoDB name of the field (specified using the
         :attr:`name` keyword argument in a field's constructor).
         """
+        key = (self._document, code)
+        sub_code = _sub_js_fields_cache.get(key)
+        if sub_code is not None:
+            return sub_code
+
         def field_sub(match):
             # Extract just the field name, and look up the field objects
             field_name = match.group(1).split('.')
@@ -1007,7 +1867,76 @@ class QuerySet(object):
             # Substitute the correct name for the field into the javascript
             return u'["%s"]' % fields[-1].db_field
 
-        return re.sub(u'\[\s*~([A-z_][A-z_0-9.]+?)\s*\]', field_sub, code)
+        sub_code = re.sub(u'\[\s*~([A-z_][A-z_0-9.]+?)\s*\]', field_sub, code)
+        _sub_js_fields_cache.set(key, sub_code)
+        return sub_code
+
+    def stored_js(self, enabled=True):
+        """Store the Javascript functions used by this queryset's
+        :meth:`~mongoengine.queryset.QuerySet.map_reduce` and
+        :meth:`~mongoengine.queryset.QuerySet.exec_js` calls on the server,
+        in the database's ``system.js`` collection, and refer to them by name
+        rather than sending them with every call. Functions are named after a
+        hash of their code, and each is stored once per process (and again
+        if the server loses it, e.g. when the database is dropped). Stored
+        functions may also be used for every query on a document by setting
+        ``stored_js`` to ``True`` in its :attr:`meta` dictionary.
+
+        Variables in a function's scope are made available to the stored
+        function as global variables.
+
+        :param enabled: whether or not stored functions are used
+
+        .. versionadded:: 0.5
+        """
+        self._stored_js = enabled
+        return self
+
+    def _get_js_function(self, code, scope=None):
+        """Return a :class:`~pymongo.code.Code` object for a Javascript
+        function. If stored functions are enabled, the function is stored on
+        the server (if it hasn't been already) and a short function calling
+        it is returned instead.
+        """
+        scope = scope or {}
+        if not self._stored_js:
+            return pymongo.code.Code(code, scope)
+
+        if isinstance(code, unicode):
+            code = code.encode('utf-8')
+        name = 'mongoengine_%s' % hashlib.sha1(code).hexdigest()
+        database = self._collection.database
+        key = (repr(database), name)
+        if key not in _stored_js_functions:
+            try:
+                database['system.js'].save({'_id': name,
+                                            'value': pymongo.code.Code(code)},
+                                           safe=True)
+            except pymongo.errors.OperationFailure, err:
+                message = u'Could not store Javascript function (%s)'
+                raise OperationError(message % unicode(err))
+            _stored_js_functions.add(key)
+
+        caller = u'function() { return %s.apply(this, arguments); }' % name
+        return pymongo.code.Code(caller, scope)
+
+    def _run_js(self, run):
+        """Return the result of ``run``, a function that runs Javascript got
+        from :meth:`_get_js_function`. Stored functions are only saved once,
+        so if the server no longer has one (e.g. as the database has been
+        dropped since), the functions are saved again and ``run`` retried.
+        """
+        try:
+            return run()
+        except (pymongo.errors.OperationFailure, OperationError), err:
+            database = repr(self._collection.database)
+            missing = [key for key in list(_stored_js_functions)
+                       if key[0] == database and key[1] in unicode(err)]
+            if not missing:
+                raise
+            for key in missing:
+                _stored_js_functions.discard(key)
+            return run()
 
     def exec_js(self, code, *fields, **options):
         """Execute a Javascript function on the server. A list of fields may be
@@ -1047,48 +1976,72 @@ class QuerySet(object):
             query['$where'] = self._where_clause
 
         scope['query'] = query
-        code = pymongo.code.Code(code, scope=scope)
 
         db = _get_db()
-        return db.eval(code, *fields)
+        return self._run_js(lambda: db.eval(self._get_js_function(code, scope),
+                                            *fields))
+
+    def _iter_field_values(self, field):
+        """Yield the values of a field across the documents matched by the
+        query. Only the field itself is fetched from the database, and the
+        results are streamed rather than loaded into memory at once. Lists met
+        along the (dotted) path are expanded, and documents without a value
+        for the field are skipped.
+        """
+        db_field = QuerySet._translate_field_name(self._document, field)
+        query = self._query
+        if self._where_clause:
+            query = dict(query, **{'$where': self._where_clause})
+
+        cursor = self._collection.find(query, fields=[db_field],
+                                       snapshot=self._snapshot,
+                                       timeout=self._timeout)
+        parts = db_field.split('.')
+        for doc in cursor:
+            for value in _get_son_values(doc, parts):
+                yield value
 
     def sum(self, field):
         """Sum over the values of the specified field.
 
+        The values are summed in the client from a cursor that only fetches
+        the field, so unlike Javascript-based aggregation this doesn't hold the
+        database's lock.
+
         :param field: the field to sum over; use dot-notation to refer to
             embedded document fields
+
+        .. versionchanged:: 0.5 no longer uses ``db.eval``
         """
-        sum_func = """
-            function(sumField) {
-                var total = 0.0;
-                db[collection].find(query).forEach(function(doc) {
-                    total += (doc[sumField] || 0.0);
-                });
-                return total;
-            }
-        """
-        return self.exec_js(sum_func, field)
+        total = 0.0
+        for value in self._iter_field_values(field):
+            if isinstance(value, (int, long, float)):
+                total += value
+        return total
 
     def average(self, field):
         """Average over the values of the specified field.
 
+        The values are averaged in the client from a cursor that only fetches
+        the field, so unlike Javascript-based aggregation this doesn't hold the
+        database's lock.
+
         :param field: the field to average over; use dot-notation to refer to
             embedded document fields
+
+        .. versionchanged:: 0.5 no longer uses ``db.eval``
         """
-        average_func = """
-            function(averageField) {
-                var total = 0.0;
-                var num = 0;
-                db[collection].find(query).forEach(function(doc) {
-                    if (doc[averageField] !== undefined) {
-                        total += doc[averageField];
-                        num += 1;
-                    }
-                });
-                return total / num;
-            }
-        """
-        return self.exec_js(average_func, field)
+        total = 0.0
+        num = 0
+        for value in self._iter_field_values(field):
+            # Nulls and other non-numeric values are left out of the average
+            if isinstance(value, (int, long, float)):
+                total += value
+                num += 1
+        if num == 0:
+            # As returned by the Javascript implementation
+            return float('nan')
+        return total / num
 
     def item_frequencies(self, field, normalize=False):
         """Returns a dictionary of all items present in a field across
@@ -1096,45 +2049,279 @@ class QuerySet(object):
         This is useful for generating tag clouds, or searching documents.
 
         If the field is a :class:`~mongoengine.ListField`, the items within
-        each list will be counted individually.
+        each list will be counted individually. As with the Javascript-based
+        implementation this replaces, the items are converted to strings for
+        use as keys.
 
         :param field: the field to use
         :param normalize: normalize the results so they add to 1.0
+
+        .. versionchanged:: 0.5 no longer uses ``db.eval``
         """
-        freq_func = """
-            function(field) {
-                if (options.normalize) {
-                    var total = 0.0;
-                    db[collection].find(query).forEach(function(doc) {
-                        if (doc[field].constructor == Array) {
-                            total += doc[field].length;
-                        } else {
-                            total++;
-                        }
-                    });
-                }
-
-                var frequencies = {};
-                var inc = 1.0;
-                if (options.normalize) {
-                    inc /= total;
-                }
-                db[collection].find(query).forEach(function(doc) {
-                    if (doc[field].constructor == Array) {
-                        doc[field].forEach(function(item) {
-                            frequencies[item] = inc + (frequencies[item] || 0);
-                        });
-                    } else {
-                        var item = doc[field];
-                        frequencies[item] = inc + (frequencies[item] || 0);
-                    }
-                });
-                return frequencies;
-            }
+        frequencies = {}
+        total = 0
+        for item in self._iter_field_values(field):
+            key = _js_string(item)
+            frequencies[key] = frequencies.get(key, 0) + 1
+            total += 1
+
+        inc = 1.0
+        if normalize and total:
+            inc /= total
+        return dict((key, count * inc) for key, count in frequencies.items())
+
+    def aggregate(self, group_by=None, count=True, batch_size=1000,
+                  **aggregates):
+        """Group the documents matched by the query and compute aggregates
+        for each group, in a single pass over a cursor that only fetches the
+        fields involved. Returns a list of dictionaries, one per group,
+        containing the values of the ``group_by`` fields, the number of
+        documents (``count``) and the requested aggregates, named
+        ``<field>__<aggregate>``::
+
+            >>> Ticket.objects(closed=False).aggregate(group_by=['status'],
+            ...                                        sum='hours')
+            [{'status': u'new', 'count': 12, 'hours__sum': 30.5},
+             {'status': u'open', 'count': 4, 'hours__sum': 9.0}]
+
+        Group values are given as they are stored in the database (though
+        compressed values are decompressed). If a
+        ``group_by`` field is a list, each document is counted in the group of
+        every item in the list. Documents without a value for a field being
+        aggregated are left out of that aggregate, which is ``None`` for
+        groups without any values. Fields on embedded documents may be
+        referred to using dot-notation. The query's ordering, skip and limit
+        decide which documents are aggregated.
+
+        :param group_by: a field name or list of field names to group by; if
+            not given, all documents form a single group
+        :param count: whether or not to count the documents in each group
+        :param batch_size: the number of documents to fetch from the server
+            in each batch
+        :param aggregates: the aggregates to compute, as ``sum``, ``avg``,
+            ``min`` or ``max`` keyword arguments giving a field name or list
+            of field names each
+
+        .. versionadded:: 0.5
         """
-        return self.exec_js(freq_func, field, normalize=normalize)
+        def as_list(fields):
+            if fields is None:
+                return []
+            if isinstance(fields, basestring):
+                return [fields]
+            return list(fields)
+
+        group_by = as_list(group_by)
+        for op in aggregates:
+            if op not in ('sum', 'avg', 'min', 'max'):
+                raise InvalidQueryError('Unknown aggregate "%s"' % op)
+        aggregates = [(field, op) for op in ('sum', 'avg', 'min', 'max')
+                      for field in as_list(aggregates.get(op))]
+
+        def db_path(field):
+            return QuerySet._translate_field_name(self._document, field)
+
+        def lookup(field):
+            return QuerySet._lookup_field(self._document, field.split('.'))[-1]
+
+        group_paths = [db_path(field) for field in group_by]
+        aggregate_paths = [db_path(field) for field, op in aggregates]
+        group_fields = [lookup(field) for field in group_by]
+        aggregate_fields = [lookup(field) for field, op in aggregates]
+
+        query = self._query
+        if self._where_clause:
+            query = dict(query, **{'$where': self._where_clause})
+        projection = list(set(group_paths + aggregate_paths)) or ['_id']
+        cursor = self._collection.find(query, fields=projection,
+                                       snapshot=self._snapshot,
+                                       timeout=self._timeout)
+        if hasattr(cursor, 'batch_size'):
+            cursor.batch_size(batch_size)
+        ordering = self._ordering or \
+            self._get_order_key_list(*self._document._meta['ordering'])
+        if ordering:
+            cursor.sort(ordering)
+        if self._limit is not None:
+            cursor.limit(self._limit)
+        if self._skip is not None:
+            cursor.skip(self._skip)
+        if self._limit == 0:
+            # A cursor with a limit of 0 isn't limited at all
+            cursor = []
+
+        group_paths = [path.split('.') for path in group_paths]
+        aggregate_paths = [path.split('.') for path in aggregate_paths]
+        numeric = (int, long, float)
+
+        # Each group's state is its count and a list of accumulators, one for
+        # each aggregate ([total, number of values] for averages)
+        groups = {}
+        for doc in cursor:
+            group_values = []
+            for field, parts in zip(group_fields, group_paths):
+                values = [_decompress_son_value(field, value)
+                          for value in _get_son_values(doc, parts)]
+                group_values.append(values or [None])
+            values = [[_decompress_son_value(field, value)
+                       for value in _get_son_values(doc, parts)]
+                      for field, parts in zip(aggregate_fields,
+                                              aggregate_paths)]
+
+            for key in itertools.product(*group_values):
+                try:
+                    state = groups.get(key)
+                except TypeError:
+                    raise InvalidQueryError('Cannot group by fields whose '
+                                            'values are documents')
+                if state is None:
+                    state = groups[key] = [0, [None] * len(aggregates)]
+                state[0] += 1
+                accumulators = state[1]
+
+                for i, (field, op) in enumerate(aggregates):
+                    for value in values[i]:
+                        if value is None:
+                            continue
+                        acc = accumulators[i]
+                        if op == 'sum':
+                            if isinstance(value, numeric):
+                                accumulators[i] = (acc or 0) + value
+                        elif op == 'avg':
+                            if isinstance(value, numeric):
+                                if acc is None:
+                                    acc = accumulators[i] = [0.0, 0]
+                                acc[0] += value
+                                acc[1] += 1
+                        elif op == 'min':
+                            if acc is None or value < acc:
+                                accumulators[i] = value
+                        elif op == 'max':
+                            if acc is None or value > acc:
+                                accumulators[i] = value
+
+        if not group_by and not groups:
+            groups[()] = [0, [None] * len(aggregates)]
+
+        results = []
+        for key, (num, accumulators) in sorted(groups.items()):
+            result = dict(zip(group_by, key))
+            if count:
+                result['count'] = num
+            for (field, op), acc in zip(aggregates, accumulators):
+                if op == 'avg' and acc is not None:
+                    acc = acc[0] / acc[1]
+                result['%s__%s' % (field, op)] = acc
+            results.append(result)
+        return results
+
+    def to_arrays(self, *fields, **options):
+        """Return the values of the given fields across the documents matched
+        by the query as NumPy arrays, in a dictionary keyed by field name. The
+        arrays are filled straight from a cursor that only fetches the given
+        fields, without building :class:`~mongoengine.Document` objects.
+
+        The type of each array depends on the field:
+        :class:`~mongoengine.IntField`\ s give ``int64`` arrays,
+        :class:`~mongoengine.FloatField`\ s ``float64``,
+        :class:`~mongoengine.BooleanField`\ s ``bool`` and
+        :class:`~mongoengine.DateTimeField`\ s ``datetime64``.
+        :class:`~mongoengine.StringField`\ s with a ``max_length`` give
+        fixed-width unicode arrays; other fields give ``object`` arrays of the
+        values as they are stored in the database (decompressed, if they were
+        compressed). Missing values are ``NaN``
+        (floats), ``NaT`` (datetimes), ``0``, ``False``, an empty string or
+        ``None``.
+
+        Requires NumPy.
+
+        :param fields: the fields to fetch, using dot-notation for fields on
+            embedded documents
+        :param structured: return a single structured array with a named
+            column per field instead of a dictionary
+
+        .. versionadded:: 0.5
+        """
+        if numpy is None:
+            raise ImportError('NumPy is required to use QuerySet.to_arrays')
+        if not fields:
+            raise InvalidQueryError('No fields given to QuerySet.to_arrays')
+        structured = options.get('structured', False)
+
+        columns = []
+        field_objs = []
+        for field in fields:
+            parts = QuerySet._lookup_field(self._document, field.split('.'))
+            db_field = '.'.join(f.db_field for f in parts)
+            dtype, missing = _get_array_dtype(parts[-1])
+            columns.append((field, db_field, dtype, missing))
+            field_objs.append(parts[-1])
+
+        query = self._query
+        if self._where_clause:
+            query = dict(query, **{'$where': self._where_clause})
+        projection = [db_field for field, db_field, dtype, missing in columns]
+        cursor = self._collection.find(query, fields=projection,
+                                       snapshot=self._snapshot,
+                                       timeout=self._timeout)
+        ordering = self._ordering or \
+            self._get_order_key_list(*self._document._meta['ordering'])
+        if ordering:
+            cursor.sort(ordering)
+        if self._limit is not None:
+            cursor.limit(self._limit)
+        if self._skip is not None:
+            cursor.skip(self._skip)
+        if self._limit == 0:
+            # A cursor with a limit of 0 isn't limited at all
+            cursor = []
+
+        # Fill buffers that double in size whenever they run out of space
+        size = 1024
+        if self._limit is not None:
+            size = max(min(self._limit, size), 1)
+        buffers = [numpy.empty(size, dtype=dtype)
+                   for field, db_field, dtype, missing in columns]
+        paths = [db_field.split('.') for field, db_field, d, m in columns]
+        fill = [missing for field, db_field, dtype, missing in columns]
+
+        count = 0
+        for doc in cursor:
+            if count == size:
+                size *= 2
+                for i, buffer in enumerate(buffers):
+                    grown = numpy.empty(size, dtype=buffer.dtype)
+                    grown[:count] = buffer
+                    buffers[i] = grown
+            for i, parts in enumerate(paths):
+                value = _get_son_value(doc, parts)
+                if value is None:
+                    value = fill[i]
+                else:
+                    value = _decompress_son_value(field_objs[i], value)
+                buffers[i][count] = value
+            count += 1
+
+        arrays = dict((field, buffers[i][:count].copy())
+                      for i, (field, d, t, m) in enumerate(columns))
+        if not structured:
+            return arrays
+
+        dtype = [(str(field), arrays[field].dtype) for field, d, t, m in columns]
+        result = numpy.empty(count, dtype=dtype)
+        for field, db_field, dtype, missing in columns:
+            result[str(field)] = arrays[field]
+        return result
 
     def __repr__(self):
+        # Only a complete cache is used, as filling one would fetch every
+        # result rather than the few that are shown
+        if self._result_cache_done:
+            data = self._result_cache[:REPR_OUTPUT_SIZE + 1]
+            if len(data) > REPR_OUTPUT_SIZE:
+                data[-1] = "...(remaining elements truncated)..."
+            return repr(data)
+
         limit = REPR_OUTPUT_SIZE + 1
         if self._limit is not None and self._limit < limit:
             limit = self._limit
@@ -1144,6 +2331,150 @@ class QuerySet(object):
         return repr(data)
 
 
+def _get_son_values(son, parts):
+    """Return the values found at the given path in a SON document, expanding
+    any lists along the way.
+    """
+    values = [son]
+    for part in parts:
+        found = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                found.append(value[part])
+            elif isinstance(value, list):
+                found += [item[part] for item in value
+                          if isinstance(item, dict) and part in item]
+        values = found
+
+    # Expand lists at the end of the path into their items
+    items = []
+    for value in values:
+        if isinstance(value, list):
+            items += value
+        else:
+            items.append(value)
+    return items
+
+
+def _get_loaded_fields(doc_cls, projection):
+    """Work out which of a document class's fields are fully loaded by a
+    projection. Returns a dictionary mapping the names of the fields to
+    ``True``, or to a list of the (database) paths loaded if only parts of an
+    embedded document were included. Fields that are excluded, in part or in
+    whole, or that are sliced, are left out.
+    """
+    names = dict((field.db_field, name)
+                 for name, field in doc_cls._fields.items())
+    includes, excludes, slices = [], [], []
+    for path, spec in projection.items():
+        if isinstance(spec, dict):
+            slices.append(path)
+        elif spec:
+            includes.append(path)
+        else:
+            excludes.append(path)
+
+    if includes:
+        loaded = {doc_cls._meta['id_field']: True}
+        for path in includes:
+            parts = path.split('.', 1)
+            name = names.get(parts[0])
+            if name is None:
+                continue
+            if len(parts) == 1:
+                loaded[name] = True
+            elif loaded.get(name) is not True:
+                loaded.setdefault(name, []).append(parts[1])
+    else:
+        loaded = dict((name, True) for name in doc_cls._fields)
+
+    for path in excludes + slices:
+        name = names.get(path.split('.', 1)[0])
+        if name is not None:
+            loaded.pop(name, None)
+    return loaded
+
+
+def _get_son_value(son, parts):
+    """Return the value found at the given path in a SON document, or
+    ``None`` if there is no such value.
+    """
+    value = son
+    for part in parts:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _decompress_son_value(field, value):
+    """Return a value from a raw document as it would be stored without
+    compression, if it was compressed by a (list of) compressed
+    :class:`~mongoengine.StringField` or :class:`~mongoengine.BinaryField`.
+    """
+    if isinstance(value, list):
+        return [_decompress_son_value(field, item) for item in value]
+    if not is_compressed(value):
+        return value
+    # The items of a list are compressed by its item field
+    field = getattr(field, 'field', field)
+    if not hasattr(field, '_decompress'):
+        return value
+    value = field._decompress(value)
+    if isinstance(value, str):
+        # Binary data is stored as BSON binary
+        value = pymongo.binary.Binary(value)
+    return value
+
+
+def _sort_sons(sons, ordering):
+    """Return a list of SON documents sorted by a PyMongo sort specification,
+    for results that can't be sorted by the server.
+    """
+    sons = list(sons)
+    for key, direction in reversed(ordering):
+        parts = key.split('.')
+        sons.sort(key=lambda son: _get_son_value(son, parts),
+                  reverse=direction == pymongo.DESCENDING)
+    return sons
+
+
+def _get_array_dtype(field):
+    """Return the NumPy dtype used to hold the values of a field, and the
+    value used in place of missing values.
+    """
+    from fields import (StringField, IntField, FloatField, BooleanField,
+                        DateTimeField)
+
+    if isinstance(field, IntField):
+        return numpy.dtype('int64'), 0
+    if isinstance(field, FloatField):
+        return numpy.dtype('float64'), float('nan')
+    if isinstance(field, BooleanField):
+        return numpy.dtype('bool'), False
+    if isinstance(field, DateTimeField):
+        return numpy.dtype('datetime64[us]'), numpy.datetime64('NaT')
+    if isinstance(field, StringField) and field.max_length:
+        return numpy.dtype('U%d' % field.max_length), u''
+    return numpy.dtype('object'), None
+
+
+def _js_string(value):
+    """Convert a value to a string in the same way as Javascript does when it
+    is used as an object key.
+    """
+    if isinstance(value, basestring):
+        return unicode(value)
+    if value is None:
+        return u'null'
+    if isinstance(value, bool):
+        return value and u'true' or u'false'
+    if isinstance(value, float) and value == value and \
+       value not in (float('inf'), float('-inf')) and value == int(value):
+        return unicode(int(value))
+    return unicode(value)
+
+
 class QuerySetManager(object):
 
     def __init__(self, manager_func=None):
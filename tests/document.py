@@ -1,8 +1,12 @@
 import unittest
 from datetime import datetime
+import os
+import shutil
+import tempfile
 import pymongo
 
 from mongoengine import *
+import mongoengine.document
 from mongoengine.connection import _get_db
 
 
@@ -432,6 +436,208 @@ class DocumentTest(unittest.TestCase):
         self.assertEqual(person.name, "Mr Test User")
         self.assertEqual(person.age, 21)
 
+    def test_modify(self):
+        """Ensure that a document may be atomically updated in place.
+        """
+        person = self.Person(name='Test User', age=20)
+        person.save()
+
+        self.assertTrue(person.modify(inc__age=1, set__name='Mr Test User'))
+        self.assertEqual(person.name, 'Mr Test User')
+        self.assertEqual(person.age, 21)
+
+        person_obj = self.Person.objects.first()
+        self.assertEqual(person_obj.age, 21)
+
+        person.delete()
+        self.assertFalse(person.modify(inc__age=1))
+
+    def test_export_import(self):
+        """Ensure that documents may be exported to and imported from files.
+        """
+        class Event(Document):
+            name = StringField()
+            count = IntField(db_field='c')
+            date = DateTimeField()
+            tags = ListField(StringField())
+
+        Event.drop_collection()
+        date = datetime(2010, 5, 1, 9, 30, 15)
+        Event(name=u'Caf\xe9', count=2, date=date, tags=['a', 'b']).save()
+        Event(name='Party', count=5).save()
+
+        path = tempfile.mkdtemp()
+        try:
+            jsonl_path = os.path.join(path, 'events.jsonl')
+            stats = Event.export(jsonl_path)
+            self.assertEqual(stats['documents'], 2)
+
+            csv_path = os.path.join(path, 'events.csv')
+            stats = Event.export(csv_path, format='csv',
+                                 query={'count__gt': 3},
+                                 fields=['name', 'count'])
+            self.assertEqual(stats['documents'], 1)
+            self.assertEqual(open(csv_path).read().splitlines(),
+                             ['name,count', 'Party,5'])
+
+            events = list(Event.objects.order_by('count'))
+            Event.drop_collection()
+
+            for processes in (0, None, 2):
+                stats = Event.import_(jsonl_path, chunk_size=1,
+                                      processes=processes)
+                self.assertEqual(stats['documents'], 2)
+                imported = list(Event.objects.order_by('count'))
+                for event, imported_event in zip(events, imported):
+                    self.assertEqual(event.id, imported_event.id)
+                    self.assertEqual(event.name, imported_event.name)
+                    self.assertEqual(event.date, imported_event.date)
+                    self.assertEqual(event.tags, imported_event.tags)
+                Event.drop_collection()
+
+            stats = Event.import_(csv_path, validate=False)
+            self.assertEqual(stats['documents'], 1)
+            event = Event.objects.get()
+            self.assertEqual(event.name, 'Party')
+            self.assertEqual(event.count, 5)
+
+            # Invalid documents aren't inserted
+            Event.drop_collection()
+            open(csv_path, 'w').write('name,count\nParty,"""many"""\n')
+            for processes in (0, 2):
+                self.assertRaises(ValidationError, Event.import_, csv_path,
+                                  processes=processes)
+            self.assertEqual(Event.objects.count(), 0)
+        finally:
+            shutil.rmtree(path)
+
+        Event.drop_collection()
+
+    def test_import_worker_died(self):
+        """Ensure that importing raises, rather than waiting forever, when a
+        worker process dies.
+        """
+        class Event(Document):
+            name = StringField()
+
+            def validate(self):
+                os._exit(1)
+
+        path = tempfile.mkdtemp()
+        timeout = mongoengine.document.IMPORT_CHUNK_TIMEOUT
+        mongoengine.document.IMPORT_CHUNK_TIMEOUT = 1
+        try:
+            jsonl_path = os.path.join(path, 'events.jsonl')
+            open(jsonl_path, 'w').write('{"name": "Party"}\n')
+            self.assertRaises(OperationError, Event.import_, jsonl_path,
+                              processes=1)
+        finally:
+            mongoengine.document.IMPORT_CHUNK_TIMEOUT = timeout
+            shutil.rmtree(path)
+
+    def test_export_import_csv_values(self):
+        """Ensure that ids and dates inside lists, dicts and references
+        survive a round trip through CSV.
+        """
+        class Venue(Document):
+            name = StringField()
+
+        class Ticket(Document):
+            venue = ReferenceField(Venue)
+            details = DictField()
+            times = ListField(DateTimeField())
+
+        Venue.drop_collection()
+        Ticket.drop_collection()
+        venue = Venue(name='Hall')
+        venue.save()
+        date = datetime(2010, 5, 1, 9, 30, 15)
+        Ticket(venue=venue, times=[date],
+               details={'seller': venue.id, 'sold': date}).save()
+
+        path = tempfile.mkdtemp()
+        try:
+            csv_path = os.path.join(path, 'tickets.csv')
+            Ticket.export(csv_path, format='csv')
+            Ticket.drop_collection()
+            Ticket.import_(csv_path)
+        finally:
+            shutil.rmtree(path)
+
+        ticket = Ticket.objects.get()
+        self.assertEqual(ticket.venue, venue)
+        self.assertEqual(ticket.times, [date])
+        self.assertEqual(ticket.details, {'seller': venue.id, 'sold': date})
+
+        Venue.drop_collection()
+        Ticket.drop_collection()
+
+    def test_save_partial(self):
+        """Ensure that saving a partially loaded document only writes the
+        fields that were loaded or changed.
+        """
+        class User(EmbeddedDocument):
+            name = StringField()
+            email = StringField()
+
+        class BlogPost(Document):
+            title = StringField(required=True)
+            views = IntField(default=0)
+            author = EmbeddedDocumentField(User)
+            tags = ListField(StringField())
+
+        BlogPost.drop_collection()
+        BlogPost(title='Test', views=10, tags=['a', 'b', 'c'],
+                 author=User(name='Test User', email='a@b.com')).save()
+
+        # Fields that weren't loaded keep their values
+        post = BlogPost.objects.only('author.name').get()
+        post.author.name = 'New User'
+        post.save()
+        post = BlogPost.objects.get()
+        self.assertEqual(post.title, 'Test')
+        self.assertEqual(post.views, 10)
+        self.assertEqual(post.author.name, 'New User')
+        self.assertEqual(post.author.email, 'a@b.com')
+
+        # ...unless they are assigned to on an embedded document
+        post = BlogPost.objects.only('author.name').get()
+        post.author.email = 'c@d.com'
+        post.save()
+        post = BlogPost.objects.get()
+        self.assertEqual(post.author.name, 'New User')
+        self.assertEqual(post.author.email, 'c@d.com')
+
+        # Sliced lists are left alone unless assigned to
+        post = BlogPost.objects.fields(slice__tags=1).get()
+        post.title = 'New Title'
+        post.save()
+        post = BlogPost.objects.get()
+        self.assertEqual(post.title, 'New Title')
+        self.assertEqual(post.tags, ['a', 'b', 'c'])
+
+        post = BlogPost.objects.exclude('title').get()
+        post.tags = ['d']
+        post.author = None
+        post.save()
+        post = BlogPost.objects.get()
+        self.assertEqual(post.title, 'New Title')
+        self.assertEqual(post.tags, ['d'])
+        self.assertEqual(post.author, None)
+
+        post = BlogPost.objects.exclude('id').get()
+        self.assertRaises(OperationError, post.save)
+
+        # Reloading loads all of the fields
+        post = BlogPost.objects.only('tags').get()
+        post.reload()
+        post.save()
+        post = BlogPost.objects.get()
+        self.assertEqual(post.title, 'New Title')
+        self.assertEqual(post.views, 10)
+
+        BlogPost.drop_collection()
+
     def test_dictionary_access(self):
         """Ensure that dictionary-style field access works properly.
         """
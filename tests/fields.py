@@ -1,5 +1,8 @@
 import unittest
 import datetime
+import os
+import shutil
+import tempfile
 from decimal import Decimal
 
 import pymongo
@@ -605,6 +608,89 @@ class FieldTest(unittest.TestCase):
 
         Attachment.drop_collection()
 
+    def test_compressed_fields(self):
+        """Ensure that string and binary fields may be compressed, and that
+        compressed values are decompressed when first accessed.
+        """
+        from mongoengine.compression import (BaseCodec, register_codec,
+                                             COMPRESSED_SUBTYPE)
+
+        class ReverseCodec(BaseCodec):
+            name = 'reverse'
+
+            def compress(self, data):
+                return data[::-1]
+
+            def decompress(self, data):
+                return data[::-1]
+
+        register_codec(ReverseCodec())
+
+        class Report(Document):
+            title = StringField(compress=True)
+            body = StringField(compress=True, compress_threshold=10)
+            data = BinaryField(compress='bz2', compress_threshold=10)
+            notes = ListField(StringField(compress='reverse',
+                                          compress_threshold=0))
+
+        Report.drop_collection()
+
+        body = u'{"values": [%s]} \u2603' % ', '.join(['1'] * 1000)
+        data = '\xe6\x00\xc4\xff\x07' * 1000
+        Report(title=u'Short', body=body, data=data, notes=[u'abc']).save()
+
+        raw = Report.objects._collection.find_one()
+        self.assertEqual(raw['title'], u'Short')
+        self.assertEqual(raw['body'].subtype, COMPRESSED_SUBTYPE)
+        self.assertTrue(len(raw['body']) < len(body))
+        self.assertEqual(raw['data'].subtype, COMPRESSED_SUBTYPE)
+        self.assertTrue(str(raw['data']).startswith('bz2\0'))
+        self.assertEqual(str(raw['notes'][0]), 'reverse\0cba')
+
+        report = Report.objects.first()
+        self.assertEqual(report._data['body'].__class__.__name__,
+                         '_CompressedValue')
+        self.assertEqual(report.body, body)
+        self.assertEqual(report._data['body'], body)
+        self.assertEqual(report.data, data)
+        self.assertEqual(report.title, u'Short')
+        self.assertEqual(report.notes, [u'abc'])
+
+        # Values written by updates are compressed too
+        Report.objects.update(set__body=body + u'!', set__data=data + '!',
+                              push__notes=u'def')
+        raw = Report.objects._collection.find_one()
+        self.assertEqual(raw['body'].subtype, COMPRESSED_SUBTYPE)
+        self.assertEqual(raw['data'].subtype, COMPRESSED_SUBTYPE)
+        self.assertEqual(str(raw['notes'][1]), 'reverse\0fed')
+        report = Report.objects.modify(new=True, pull__notes=u'def')
+        self.assertEqual(report.body, body + u'!')
+        self.assertEqual(report.data, data + '!')
+        self.assertEqual(report.notes, [u'abc'])
+        Report.objects.update(set__body=body, set__data=data)
+
+        # Values read without building documents are decompressed too
+        results = Report.objects.aggregate(group_by='notes', max='body')
+        self.assertEqual(results, [{'notes': u'abc', 'count': 1,
+                                    'body__max': body}])
+        path = tempfile.mkdtemp()
+        try:
+            csv_path = os.path.join(path, 'reports.csv')
+            Report.export(csv_path, format='csv', fields=['body', 'notes'])
+            row = open(csv_path).read().splitlines()[1]
+            self.assertTrue(row.startswith('"{""values"": [1, 1,'))
+            self.assertTrue(row.endswith(',"[""abc""]"'))
+        finally:
+            shutil.rmtree(path)
+
+        # Values stay readable when compression is turned off
+        class Report(Document):
+            body = StringField()
+
+        self.assertEqual(Report.objects.first().body, body)
+
+        Report.drop_collection()
+
     def test_binary_validation(self):
         """Ensure that invalid values cannot be assigned to binary fields.
         """
@@ -659,6 +745,27 @@ class FieldTest(unittest.TestCase):
 
         Shirt.drop_collection()
 
+    def test_file_required(self):
+        """Ensure that a required file field without a file is invalid,
+        even after it has been read.
+        """
+        class RequiredFile(Document):
+            file = FileField(required=True)
+
+        RequiredFile.drop_collection()
+
+        doc = RequiredFile()
+        self.assertEqual(doc.file.grid_id, None)
+        self.assertRaises(ValidationError, doc.save)
+
+        doc.file.put('Hello, World!')
+        doc.save()
+        self.assertEqual(RequiredFile.objects.get().file.read(),
+                         'Hello, World!')
+
+        doc.file.delete()
+        RequiredFile.drop_collection()
+
     def test_file_fields(self):
         """Ensure that file fields can be written to and their data retrieved
         """
@@ -731,6 +838,230 @@ class FieldTest(unittest.TestCase):
             file = FileField()
         d = DemoFile.objects.create()
 
+    def test_file_streaming(self):
+        """Ensure that files may be read in chunks and ranges.
+        """
+        class StreamFile(Document):
+            file = FileField()
+
+        StreamFile.drop_collection()
+
+        text = ''.join(chr(i % 256) for i in range(1000))
+        streamfile = StreamFile()
+        streamfile.file.put(text, chunkSize=256)
+        streamfile.save()
+
+        result = StreamFile.objects.first()
+        chunks = list(result.file.iter_chunks())
+        self.assertEqual([len(c) for c in chunks], [256, 256, 256, 232])
+        self.assertEqual(''.join(chunks), text)
+        self.assertEqual(''.join(result.file.iter_chunks(100, 50, 420)),
+                         text[50:420])
+
+        self.assertEqual(result.file.read_range(10, 20), text[10:20])
+        self.assertEqual(result.file.read_range(990), text[990:])
+        result.file.seek(500)
+        self.assertEqual(result.file.read(5), text[500:505])
+        self.assertEqual(result.file.tell(), 505)
+        self.assertEqual(result.file.read(), text)
+
+        buffer = bytearray(300)
+        result.file.seek(800)
+        self.assertEqual(result.file.readinto(buffer), 200)
+        self.assertEqual(str(buffer[:200]), text[800:])
+        self.assertEqual(result.file.readinto(memoryview(buffer)), 0)
+
+        # The file is only fetched once
+        self.assertTrue(result.file.get() is result.file.get())
+
+        result.file.delete()
+        StreamFile.drop_collection()
+
+    def test_file_collection_name(self):
+        """Ensure that files may be stored in a separate GridFS collection,
+        and that GridFS instances are shared.
+        """
+        from mongoengine.fields import _get_gridfs
+
+        class Photo(Document):
+            image = FileField(collection_name='photos')
+
+        Photo.drop_collection()
+
+        photo = Photo()
+        photo.image.put('Hello, World!')
+        photo.save()
+
+        db = _get_db()
+        self.assertEqual(db.photos.files.count(), 1)
+        self.assertEqual(Photo.objects.first().image.read(), 'Hello, World!')
+        self.assertTrue(_get_gridfs('photos') is _get_gridfs('photos'))
+        self.assertTrue(Photo.objects.first().image.fs is _get_gridfs('photos'))
+
+        photo.image.delete()
+        self.assertEqual(db.photos.files.count(), 0)
+        Photo.drop_collection()
+
+    def test_file_parallel_transfer(self):
+        """Ensure that files may be uploaded and downloaded in parallel.
+        """
+        import os
+        import tempfile
+        from mongoengine.fields import GridFSError
+
+        class StreamFile(Document):
+            file = FileField()
+
+        StreamFile.drop_collection()
+
+        text = ''.join(chr(i % 251) for i in range(10050))
+        streamfile = StreamFile()
+        streamfile.file.parallel_put(text, workers=3, chunk_size=100,
+                                     chunks_per_task=4,
+                                     content_type='text/plain')
+        streamfile.save()
+
+        result = StreamFile.objects.first()
+        self.assertEqual(result.file.read(), text)
+        self.assertEqual(result.file.length, len(text))
+        self.assertEqual(result.file.chunk_size, 100)
+        self.assertEqual(result.file.content_type, 'text/plain')
+        self.assertRaises(GridFSError, result.file.parallel_put, text)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertEqual(result.file.parallel_download(path, workers=3,
+                                                           chunks_per_task=7),
+                             len(text))
+            self.assertEqual(open(path, 'rb').read(), text)
+
+            # Missing chunks are detected
+            db = _get_db()
+            db.fs.chunks.remove({'files_id': result.file.grid_id, 'n': 50})
+            self.assertRaises(GridFSError, result.file.parallel_download,
+                              path)
+
+            empty = StreamFile()
+            empty.file.parallel_put('')
+            self.assertEqual(empty.file.parallel_download(path), 0)
+            self.assertEqual(open(path, 'rb').read(), '')
+            empty.file.delete()
+        finally:
+            os.remove(path)
+
+        result.file.delete()
+        StreamFile.drop_collection()
+
+    def test_file_dedup(self):
+        """Ensure that files with the same content are stored once and
+        reference counted.
+        """
+        import StringIO
+        from mongoengine.fields import GridFSError
+
+        class Attachment(Document):
+            file = FileField(dedup=True)
+
+        Attachment.drop_collection()
+        db = _get_db()
+        db.fs.files.remove()
+        db.fs.chunks.remove()
+
+        first = Attachment()
+        first.file.put('Hello, World!')
+        first.save()
+        second = Attachment()
+        second.file.put(StringIO.StringIO('Hello, World!'))
+        second.save()
+        third = Attachment()
+        third.file = 'Goodbye'
+        third.save()
+
+        self.assertEqual(first.file.grid_id, second.file.grid_id)
+        self.assertNotEqual(first.file.grid_id, third.file.grid_id)
+        self.assertEqual(db.fs.files.count(), 2)
+        file_doc = db.fs.files.find_one({'_id': first.file.grid_id})
+        self.assertEqual(file_doc['refcount'], 2)
+        self.assertTrue('sha256_1' in db.fs.files.index_information())
+
+        # Attributes must match those of the file that would be shared
+        fourth = Attachment()
+        self.assertRaises(GridFSError, fourth.file.put, 'Hello, World!',
+                          content_type='text/plain')
+        fourth.file.parallel_put('Hello, World!', workers=2)
+        self.assertEqual(fourth.file.grid_id, first.file.grid_id)
+        fourth.file.delete()
+
+        # Data is only removed with the last reference
+        first.file.delete()
+        first.save()
+        self.assertEqual(db.fs.files.count(), 2)
+        result = Attachment.objects(id=second.id).first()
+        self.assertEqual(result.file.read(), 'Hello, World!')
+        result.file.delete()
+        self.assertEqual(db.fs.files.count(), 1)
+        chunks = db.fs.chunks.find({'files_id': second.file.grid_id})
+        self.assertEqual(chunks.count(), 0)
+
+        # Content that was deleted is stored afresh
+        first.file.put('Hello, World!')
+        self.assertEqual(first.file.read(), 'Hello, World!')
+
+        first.file.delete()
+        third.file.delete()
+        self.assertEqual(db.fs.files.count(), 0)
+        Attachment.drop_collection()
+
+    def test_file_compression(self):
+        """Ensure that files' chunks may be compressed, and that compressed
+        files support ranged reads and parallel transfers.
+        """
+        import os
+        import tempfile
+
+        class LogFile(Document):
+            log = FileField(compress=True, compress_threshold=10)
+
+        LogFile.drop_collection()
+        db = _get_db()
+
+        text = ''.join('line %d\n' % i for i in range(2000))
+        logfile = LogFile()
+        logfile.log.parallel_put(text, workers=2, chunk_size=1000)
+        logfile.save()
+        small = LogFile()
+        small.log.put('tiny')
+        small.save()
+
+        file_doc = db.fs.files.find_one({'_id': logfile.log.grid_id})
+        self.assertEqual(file_doc['compression'], 'zlib')
+        self.assertEqual(file_doc['length'], len(text))
+        chunks = db.fs.chunks.find({'files_id': logfile.log.grid_id})
+        self.assertTrue(sum(len(c['data']) for c in chunks) < len(text))
+        file_doc = db.fs.files.find_one({'_id': small.log.grid_id})
+        self.assertFalse('compression' in file_doc)
+
+        result = LogFile.objects(id=logfile.id).first()
+        self.assertEqual(result.log.read(), text)
+        self.assertEqual(result.log.length, len(text))
+        self.assertEqual(result.log.read_range(2990, 3010), text[2990:3010])
+        self.assertEqual(''.join(result.log.iter_chunks(700)), text)
+        self.assertEqual(LogFile.objects(id=small.id).first().log.read(),
+                         'tiny')
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            result.log.parallel_download(path, workers=2, chunks_per_task=3)
+            self.assertEqual(open(path, 'rb').read(), text)
+        finally:
+            os.remove(path)
+
+        result.log.delete()
+        small.log.delete()
+        LogFile.drop_collection()
+
     def test_file_uniqueness(self):
         """Ensure that each instance of a FileField is unique
         """
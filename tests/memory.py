@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+
+
+import unittest
+import pymongo
+import re
+from datetime import datetime
+
+from mongoengine import *
+from mongoengine.connection import _get_db
+from mongoengine.memory import MemoryDatabase, MemoryCollection
+
+
+class MemoryBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        connect(db='mongoenginetest', backend='memory')
+        self.db = _get_db()
+
+        class Comment(EmbeddedDocument):
+            author = StringField()
+            votes = IntField()
+
+        class BlogPost(Document):
+            title = StringField()
+            slug = StringField(unique=True)
+            hits = IntField()
+            tags = ListField(StringField())
+            comments = ListField(EmbeddedDocumentField(Comment))
+            published = DateTimeField()
+
+            meta = {
+                'indexes': ['tags'],
+                'allow_inheritance': False,
+            }
+
+        BlogPost.drop_collection()
+        self.Comment = Comment
+        self.BlogPost = BlogPost
+
+    def tearDown(self):
+        self.BlogPost.drop_collection()
+
+    def _create_posts(self):
+        Comment = self.Comment
+        self.BlogPost(title='First', slug='first', hits=10,
+                      tags=['music', 'film'],
+                      comments=[Comment(author='ann', votes=2),
+                                Comment(author='bob', votes=5)],
+                      published=datetime(2010, 1, 1)).save()
+        self.BlogPost(title='Second', slug='second', hits=20,
+                      tags=['film'],
+                      comments=[Comment(author='bob', votes=1)],
+                      published=datetime(2010, 2, 1)).save()
+        self.BlogPost(title='third', slug='third', hits=30, tags=[],
+                      published=datetime(2010, 3, 1)).save()
+
+    def test_connect(self):
+        """Ensure that connecting with the memory backend gives an in-memory
+        database, which keeps its data between connections.
+        """
+        self.assertTrue(isinstance(self.db, MemoryDatabase))
+        self.assertTrue(isinstance(self.BlogPost.objects._collection,
+                                   MemoryCollection))
+
+        self.BlogPost(title='Test', slug='test').save()
+        connect(db='mongoenginetest', backend='memory')
+        self.assertEqual(self.BlogPost.objects.count(), 1)
+        self.assertEqual(self.BlogPost.objects.first().title, 'Test')
+
+        self.assertRaises(ConnectionError, connect, 'mongoenginetest',
+                          backend='unknown')
+
+    def test_query(self):
+        """Ensure that queries are evaluated as MongoDB evaluates them.
+        """
+        self._create_posts()
+        titles = lambda queryset: sorted(post.title for post in queryset)
+        BlogPost = self.BlogPost
+
+        self.assertEqual(titles(BlogPost.objects(hits__gt=10)),
+                         ['Second', 'third'])
+        self.assertEqual(titles(BlogPost.objects(hits__lte=20, hits__gte=20)),
+                         ['Second'])
+        self.assertEqual(titles(BlogPost.objects(hits__in=[10, 30])),
+                         ['First', 'third'])
+        self.assertEqual(titles(BlogPost.objects(hits__nin=[10, 30])),
+                         ['Second'])
+        self.assertEqual(titles(BlogPost.objects(hits__ne=10)),
+                         ['Second', 'third'])
+        self.assertEqual(titles(BlogPost.objects(hits__mod=(20, 10))),
+                         ['First', 'third'])
+        self.assertEqual(titles(BlogPost.objects(
+                             published__lt=datetime(2010, 2, 1))),
+                         ['First'])
+
+        # Regular expressions
+        self.assertEqual(titles(BlogPost.objects(title__startswith='S')),
+                         ['Second'])
+        self.assertEqual(titles(BlogPost.objects(title__icontains='IR')),
+                         ['First', 'third'])
+        self.assertEqual(titles(BlogPost.objects(title=re.compile('^t'))),
+                         ['third'])
+
+        # Or queries
+        query = Q(hits=10) | Q(title='third')
+        self.assertEqual(titles(BlogPost.objects(query)), ['First', 'third'])
+
+        # Array semantics
+        self.assertEqual(titles(BlogPost.objects(tags='film')),
+                         ['First', 'Second'])
+        self.assertEqual(titles(BlogPost.objects(tags__all=['film',
+                                                            'music'])),
+                         ['First'])
+        self.assertEqual(titles(BlogPost.objects(tags__size=0)), ['third'])
+        self.assertEqual(titles(BlogPost.objects(tags__in=['music', 'x'])),
+                         ['First'])
+
+        # Dotted paths through lists of embedded documents
+        self.assertEqual(titles(BlogPost.objects(comments__author='bob')),
+                         ['First', 'Second'])
+        self.assertEqual(titles(BlogPost.objects(comments__votes__gt=4)),
+                         ['First'])
+        self.assertEqual(titles(BlogPost.objects(
+                             comments__author__exists=False)),
+                         ['third'])
+
+        # Comparisons only match values of the same type
+        collection = BlogPost.objects._collection
+        self.assertEqual(collection.find({'title': {'$gt': 5}}).count(), 0)
+
+        # Javascript isn't supported
+        cursor = collection.find({'$where': 'this.hits > 10'})
+        self.assertRaises(pymongo.errors.OperationFailure, cursor.count)
+
+    def test_ordering(self):
+        """Ensure that sorting, skipping, limiting, counting and distinct
+        values work.
+        """
+        self._create_posts()
+        BlogPost = self.BlogPost
+
+        posts = BlogPost.objects.order_by('-hits')
+        self.assertEqual([post.hits for post in posts], [30, 20, 10])
+        posts = BlogPost.objects.order_by('-hits')
+        self.assertEqual([post.hits for post in posts[1:]], [20, 10])
+        posts = BlogPost.objects.order_by('-hits')
+        self.assertEqual(posts[0].hits, 30)
+        posts = BlogPost.objects.order_by('-hits').skip(1).limit(1)
+        self.assertEqual([post.hits for post in posts], [20])
+        self.assertEqual(BlogPost.objects.skip(1).count(), 2)
+
+        # Arrays sort by their smallest item, and empty arrays first
+        posts = BlogPost.objects.order_by('tags', 'title')
+        self.assertEqual([post.title for post in posts],
+                         ['third', 'First', 'Second'])
+
+        self.assertEqual(sorted(BlogPost.objects.distinct('tags')),
+                         ['film', 'music'])
+        self.assertEqual(sorted(BlogPost.objects.distinct('comments.author')),
+                         ['ann', 'bob'])
+        self.assertEqual(BlogPost.objects(hits__gt=10).distinct('hits'),
+                         [20, 30])
+        self.assertEqual(BlogPost.objects.item_frequencies('tags'),
+                         {'film': 2, 'music': 1})
+
+        # Only load some fields
+        post = BlogPost.objects.only('title').get(slug='first')
+        self.assertEqual(post.title, 'First')
+        self.assertEqual(post.hits, None)
+
+    def test_update(self):
+        """Ensure that the update operators are applied.
+        """
+        self._create_posts()
+        BlogPost = self.BlogPost
+
+        BlogPost.objects(slug='first').update_one(inc__hits=5,
+                                                  push__tags='art')
+        post = BlogPost.objects.get(slug='first')
+        self.assertEqual(post.hits, 15)
+        self.assertEqual(post.tags, ['music', 'film', 'art'])
+
+        count = BlogPost.objects(tags='film').update(pull__tags='film',
+                                                      set__title='Filmless')
+        self.assertEqual(count, 2)
+        self.assertEqual(BlogPost.objects(tags='film').count(), 0)
+        self.assertEqual(BlogPost.objects(title='Filmless').count(), 2)
+
+        BlogPost.objects(slug='third').update(add_to_set__tags='art')
+        BlogPost.objects(slug='third').update(add_to_set__tags='art')
+        BlogPost.objects(slug='third').update(push_all__tags=['a', 'b'])
+        BlogPost.objects(slug='third').update(pop__tags=1)
+        BlogPost.objects(slug='third').update(dec__hits=10)
+        post = BlogPost.objects.get(slug='third')
+        self.assertEqual(post.tags, ['art', 'a'])
+        self.assertEqual(post.hits, 20)
+
+        BlogPost.objects(slug='third').update(unset__hits=1)
+        self.assertEqual(BlogPost.objects(hits__exists=True).count(), 2)
+
+        # The positional operator updates the matched item of an array
+        BlogPost.objects._collection.update({'comments.author': 'bob'},
+                                            {'$inc': {'comments.$.votes': 1}},
+                                            multi=True)
+        post = BlogPost.objects.get(slug='first')
+        self.assertEqual([c.votes for c in post.comments], [2, 6])
+
+        # Upserts insert the query's values
+        BlogPost.objects(slug='fourth').update(set__hits=1, upsert=True)
+        self.assertEqual(BlogPost.objects.get(slug='fourth').hits, 1)
+
+        post = BlogPost.objects(hits__gte=1).order_by('hits').modify(
+            new=True, inc__hits=1)
+        self.assertEqual((post.slug, post.hits), ('fourth', 2))
+
+        BlogPost.objects(slug='fourth').delete()
+        self.assertEqual(BlogPost.objects.count(), 3)
+
+    def test_indexes(self):
+        """Ensure that unique indexes are enforced and that equality
+        queries on indexed fields are looked up rather than scanned for.
+        """
+        self._create_posts()
+        BlogPost = self.BlogPost
+
+        post = BlogPost(title='Copy', slug='first')
+        self.assertRaises(OperationError, post.save)
+
+        information = BlogPost.objects._collection.index_information()
+        self.assertTrue('tags_1' in information)
+        self.assertTrue(information['slug_1']['unique'])
+
+        plan = BlogPost.objects(tags='music').explain()
+        self.assertEqual(plan['cursor'], 'BtreeCursor tags_1')
+        self.assertEqual((plan['n'], plan['nscanned']), (1, 1))
+
+        plan = BlogPost.objects(tags__in=['music', 'film']).explain()
+        self.assertEqual((plan['n'], plan['nscanned']), (2, 2))
+
+        post = BlogPost.objects.get(slug='second')
+        plan = BlogPost.objects(id=post.id).explain()
+        self.assertEqual(plan['cursor'], 'BtreeCursor _id_')
+        self.assertEqual(plan['nscanned'], 1)
+
+        plan = BlogPost.objects(hits=10).explain()
+        self.assertEqual(plan['cursor'], 'BasicCursor')
+        self.assertEqual(plan['nscanned'], 3)
+
+        # Index entries follow updates and deletes
+        BlogPost.objects(slug='second').update(set__tags=['music'])
+        self.assertEqual(BlogPost.objects(tags='music').count(), 2)
+        BlogPost.objects(slug='first').delete()
+        self.assertEqual(BlogPost.objects(tags='music').count(), 1)
+        self.assertEqual(BlogPost.objects(tags='film').count(), 0)
+
+    def test_find_and_modify(self):
+        """Ensure that findAndModify updates, removes and upserts documents,
+        returning the old or new document.
+        """
+        self._create_posts()
+        collection = self.BlogPost.objects._collection
+        command = lambda **kwargs: self.db.command(pymongo.son.SON(
+            [('findandmodify', collection.name)] + kwargs.items()))
+
+        result = command(query={'tags': 'film'}, sort={'hits': -1},
+                         update={'$inc': {'hits': 1}})
+        self.assertEqual((result['value']['slug'], result['value']['hits']),
+                         ('second', 20))
+        self.assertEqual(collection.find_one({'slug': 'second'})['hits'], 21)
+
+        result = command(query={'slug': 'first'}, new=True,
+                         update={'$set': {'title': 'New'}},
+                         fields={'title': 1})
+        self.assertEqual(sorted(result['value'].keys()), ['_id', 'title'])
+        self.assertEqual(result['value']['title'], 'New')
+
+        # Nothing is returned when nothing matches, unless upserting
+        result = command(query={'slug': 'fourth'},
+                         update={'$set': {'hits': 1}})
+        self.assertEqual(result['value'], None)
+        self.assertEqual(collection.find({'slug': 'fourth'}).count(), 0)
+        result = command(query={'slug': 'fourth'}, upsert=True, new=True,
+                         update={'$set': {'hits': 1}})
+        self.assertEqual((result['value']['slug'], result['value']['hits']),
+                         ('fourth', 1))
+        self.assertTrue(result['value']['_id'])
+
+        result = command(query={'slug': 'fourth'}, remove=True)
+        self.assertEqual(result['value']['slug'], 'fourth')
+        self.assertEqual(collection.find({'slug': 'fourth'}).count(), 0)
+
+        # Replacement upserts keep the query's _id
+        post_id = pymongo.objectid.ObjectId()
+        collection.update({'_id': post_id}, {'slug': 'fifth'}, upsert=True)
+        self.assertEqual(collection.find_one(post_id)['slug'], 'fifth')
+
+        # Upserts with operators take equalities, not other conditions, from
+        # the query
+        collection.update({'slug': 'sixth', 'hits': {'$gt': 5}},
+                          {'$inc': {'hits': 2}}, upsert=True)
+        post = collection.find_one({'slug': 'sixth'})
+        self.assertEqual(post['hits'], 2)
+
+        # $setOnInsert only writes the fields of documents being inserted
+        for hits in (1, 2):
+            collection.update({'slug': 'seventh'},
+                              {'$setOnInsert': {'hits': hits}}, upsert=True)
+        self.assertEqual(collection.find_one({'slug': 'seventh'})['hits'], 1)
+
+    def test_slice(self):
+        """Ensure that $slice projections return part of an array.
+        """
+        self._create_posts()
+        collection = self.BlogPost.objects._collection
+        collection.update({'slug': 'third'},
+                          {'$set': {'tags': ['a', 'b', 'c', 'd']}})
+        tags = lambda fields: collection.find_one({'slug': 'third'},
+                                                  fields=fields)['tags']
+
+        self.assertEqual(tags({'tags': {'$slice': 2}}), ['a', 'b'])
+        self.assertEqual(tags({'tags': {'$slice': -1}}), ['d'])
+        self.assertEqual(tags({'tags': {'$slice': [1, 2]}}), ['b', 'c'])
+        self.assertEqual(tags({'tags': {'$slice': [-3, 2]}}), ['b', 'c'])
+        self.assertEqual(tags({'tags': {'$slice': [3, 5]}}), ['d'])
+
+        # Other fields are returned alongside a slice, unless some are
+        # selected
+        post = collection.find_one({'slug': 'third'},
+                                   fields={'tags': {'$slice': 1}})
+        self.assertEqual(post['title'], 'third')
+        post = collection.find_one({'slug': 'third'},
+                                   fields={'tags': {'$slice': 1}, 'hits': 1})
+        self.assertEqual(sorted(post.keys()), ['_id', 'hits', 'tags'])
+        self.assertEqual(post['tags'], ['a'])
+
+        # Through a queryset
+        post = self.BlogPost.objects(slug='first').fields(
+            slice__comments=1).get()
+        self.assertEqual([c.author for c in post.comments], ['ann'])
+
+    def test_positional_update(self):
+        """Ensure that the positional operator updates the first array item
+        matched by the query, and only with a matching query.
+        """
+        self._create_posts()
+        collection = self.BlogPost.objects._collection
+
+        collection.update({'slug': 'first', 'comments.author': 'bob'},
+                          {'$set': {'comments.$.votes': 10}})
+        collection.update({'slug': 'first', 'tags': 'film'},
+                          {'$set': {'tags.$': 'cinema'}})
+        post = self.BlogPost.objects.get(slug='first')
+        self.assertEqual([(c.author, c.votes) for c in post.comments],
+                         [('ann', 2), ('bob', 10)])
+        self.assertEqual(post.tags, ['music', 'cinema'])
+
+        # The item may be matched by an operator
+        collection.update({'comments.votes': {'$gt': 4}},
+                          {'$set': {'comments.$.author': 'cat'}}, multi=True)
+        post = collection.find_one({'slug': 'first'})
+        self.assertEqual([c['author'] for c in post['comments']],
+                         ['ann', 'cat'])
+        post = collection.find_one({'slug': 'second'})
+        self.assertEqual([c['author'] for c in post['comments']], ['bob'])
+
+        self.assertRaises(pymongo.errors.OperationFailure, collection.update,
+                          {'slug': 'first'},
+                          {'$set': {'comments.$.votes': 0}})
+
+    def test_unique(self):
+        """Ensure that unique keys are enforced on insert, update, upsert and
+        index creation.
+        """
+        self._create_posts()
+        collection = self.BlogPost.objects._collection
+        post = collection.find_one({'slug': 'first'})
+        failure = pymongo.errors.OperationFailure
+
+        self.assertRaises(failure, collection.insert, {'_id': post['_id']})
+        self.assertRaises(failure, collection.insert, {'slug': 'second'})
+        self.assertRaises(failure, collection.update, {'slug': 'first'},
+                          {'$set': {'slug': 'second'}})
+        self.assertRaises(failure, collection.update, {'slug': 'fourth'},
+                          {'$set': {'slug': 'second'}}, upsert=True)
+        self.assertEqual(collection.count(), 3)
+
+        # A document may keep its own key
+        collection.update({'slug': 'first'}, {'$set': {'slug': 'first'}})
+        self.assertEqual(collection.find({'slug': 'first'}).count(), 1)
+
+        # Through documents and querysets
+        BlogPost = self.BlogPost
+        self.assertRaises(OperationError, BlogPost(slug='second').save)
+        self.assertRaises(OperationError,
+                          BlogPost.objects(slug='first').update,
+                          set__slug='second')
+        self.assertRaises(OperationError, BlogPost.objects.insert,
+                          [BlogPost(slug='first')])
+
+        # Existing duplicates prevent a unique index, unless dropped
+        collection.insert({'title': 'Copy', 'slug': 'copy', 'hits': 10})
+        self.assertRaises(failure, collection.create_index, 'hits',
+                          unique=True)
+        collection.create_index('hits', unique=True, drop_dups=True)
+        self.assertEqual(collection.find({'hits': 10}).count(), 1)
+
+        # Documents without the field have a null key, unless the index is
+        # sparse
+        collection.insert({'slug': 'none'})
+        self.assertRaises(failure, collection.insert, {'slug': 'other'})
+        collection.drop_index('hits_1')
+        collection.create_index('code', unique=True, sparse=True)
+        collection.insert({'slug': 'a'})
+        collection.insert({'slug': 'b'})
+        collection.insert({'slug': 'c', 'code': 1})
+        self.assertRaises(failure, collection.insert,
+                          {'slug': 'd', 'code': 1})
+
+    def test_count_distinct(self):
+        """Ensure that counts honour skips and limits, and that distinct
+        values are found through arrays and dotted paths.
+        """
+        self._create_posts()
+        collection = self.BlogPost.objects._collection
+
+        cursor = collection.find({'hits': {'$gte': 10}}).skip(1).limit(1)
+        self.assertEqual(cursor.count(), 3)
+        self.assertEqual(cursor.count(with_limit_and_skip=True), 1)
+        self.assertEqual(collection.find().skip(5).count(True), 0)
+
+        result = self.db.command(pymongo.son.SON([
+            ('count', collection.name), ('query', {'tags': 'film'}),
+            ('skip', 1)]))
+        self.assertEqual(result['n'], 1)
+        self.assertEqual(self.BlogPost.objects(tags='film').count(), 2)
+        self.assertEqual(self.BlogPost.objects.limit(2).count(), 2)
+
+        result = self.db.command(pymongo.son.SON([
+            ('distinct', collection.name), ('key', 'comments.votes'),
+            ('query', {'hits': {'$lt': 30}})]))
+        self.assertEqual(sorted(result['values']), [1, 2, 5])
+
+        # Documents and arrays are distinct by value
+        collection.insert({'slug': 'x', 'tags': ['film'],
+                           'meta': {'a': 1}})
+        collection.insert({'slug': 'y', 'meta': {'a': 1}})
+        self.assertEqual(collection.find().distinct('meta'), [{'a': 1}])
+        self.assertEqual(sorted(collection.find().distinct('tags')),
+                         ['film', 'music'])
+        self.assertEqual(collection.find({'slug': 'none'}).distinct('tags'),
+                         [])
+
+    def test_geo(self):
+        """Ensure that $near queries sort by distance and that $within
+        queries find points inside circles and boxes.
+        """
+        class Place(Document):
+            name = StringField()
+            location = GeoPointField()
+
+        Place.drop_collection()
+        for name, location in [('origin', [0, 0]), ('east', [3, 0]),
+                               ('north', [0, 5]), ('far', [40, 40])]:
+            Place(name=name, location=location).save()
+        names = lambda queryset: [place.name for place in queryset]
+
+        self.assertEqual(names(Place.objects(location__near=[2, 0])),
+                         ['east', 'origin', 'north', 'far'])
+        self.assertEqual(names(Place.objects(location__near=[2, 0])[:2]),
+                         ['east', 'origin'])
+        collection = Place.objects._collection
+        cursor = collection.find({'location': {'$near': [0, 0],
+                                               '$maxDistance': 4}})
+        self.assertEqual([place['name'] for place in cursor],
+                         ['origin', 'east'])
+
+        # Spherical distances are in radians, between longitudes/latitudes
+        self.assertEqual(names(Place.objects(location__near_sphere=[0, 4])),
+                         ['north', 'origin', 'east', 'far'])
+        queryset = Place.objects(
+            location__within_spherical_distance=[[0, 0], 0.1])
+        self.assertEqual(sorted(names(queryset)), ['east', 'north', 'origin'])
+
+        queryset = Place.objects(location__within_distance=[[0, 0], 3])
+        self.assertEqual(sorted(names(queryset)), ['east', 'origin'])
+        queryset = Place.objects(location__within_box=[[-1, -1], [1, 6]])
+        self.assertEqual(sorted(names(queryset)), ['north', 'origin'])
+
+        cursor = collection.find({'location': {'$within': {'$polygon': []}}})
+        self.assertRaises(pymongo.errors.OperationFailure, list, cursor)
+        Place.drop_collection()
+
+    def test_explain(self):
+        """Ensure that query plans report the index used and the documents
+        scanned and matched.
+        """
+        self._create_posts()
+        collection = self.BlogPost.objects._collection
+
+        plan = collection.find().explain()
+        self.assertEqual(plan['cursor'], 'BasicCursor')
+        self.assertEqual((plan['n'], plan['nscanned'],
+                          plan['nscannedObjects']), (3, 3, 3))
+        self.assertEqual(plan['millis'], 0)
+
+        plan = collection.find({'slug': {'$in': ['first', 'none']}}).explain()
+        self.assertEqual(plan['cursor'], 'BtreeCursor slug_1')
+        self.assertEqual((plan['n'], plan['nscanned']), (1, 1))
+
+        # Ranges and sorts report the index MongoDB would use, but scan
+        plan = collection.find({'slug': {'$gt': 'f'}}).explain()
+        self.assertEqual(plan['cursor'], 'BtreeCursor slug_1')
+        self.assertEqual((plan['n'], plan['nscanned']), (3, 3))
+
+        # Hints and scan limits are honoured
+        plan = collection.find({'hits': 20}).hint([('tags', 1)]).explain()
+        self.assertEqual(plan['cursor'], 'BtreeCursor tags_1')
+        cursor = collection.find({'hits': 20}).hint([('title', 1)])
+        self.assertRaises(pymongo.errors.OperationFailure, cursor.explain)
+        plan = collection.find({'hits': 30}).max_scan(2).explain()
+        self.assertEqual((plan['n'], plan['nscanned']), (0, 2))
+
+        # Formatted through a queryset
+        plan = self.BlogPost.objects(tags='film').explain(format=True)
+        self.assertTrue("'BtreeCursor tags_1'" in plan)
+
+    def test_gridfs(self):
+        """Ensure that files can't be stored, as GridFS needs a server.
+        """
+        class Attachment(Document):
+            file = FileField()
+
+        attachment = Attachment()
+        self.assertRaises(pymongo.errors.OperationFailure,
+                          attachment.file.put, 'Hello, World!')
+        self.assertRaises(pymongo.errors.OperationFailure,
+                          attachment.file.new_file)
+        Attachment.drop_collection()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@ import unittest
 import pymongo
 from datetime import datetime, timedelta
 
+import mongoengine.queryset
 from mongoengine.queryset import (QuerySet, MultipleObjectsReturned,
                                   DoesNotExist)
 from mongoengine import *
@@ -235,9 +236,89 @@ class QuerySetTest(unittest.TestCase):
         kwargs = dict(age=50, defaults={'name': 'User C'})
         person, created = self.Person.objects.get_or_create(**kwargs)
         self.assertEqual(created, True)
-        
+        person_id = person.id
+
         person = self.Person.objects.get(age=50)
         self.assertEqual(person.name, "User C")
+        self.assertEqual(person.id, person_id)
+
+        # A second call must find the created document, not insert another
+        kwargs = dict(age=50, defaults={'name': 'User D'})
+        person, created = self.Person.objects.get_or_create(**kwargs)
+        self.assertEqual(created, False)
+        self.assertEqual(person.name, "User C")
+        self.assertEqual(len(self.Person.objects(age=50)), 1)
+
+    def test_get_or_create_race(self):
+        """Ensure that a document created by someone else between the lookup
+        and the insert of ``get_or_create`` is returned, not overwritten, even
+        without a unique index.
+        """
+        class Account(Document):
+            email = StringField()
+            plan = StringField()
+
+        Account.drop_collection()
+        Account(email='ross@example.com', plan='pro').save()
+
+        # The first lookup misses, as if the document was created after it
+        queryset = Account.objects
+        get = queryset.get
+        misses = []
+        def racing_get(*args, **kwargs):
+            if not misses:
+                misses.append(True)
+                raise Account.DoesNotExist
+            return get(*args, **kwargs)
+        queryset.get = racing_get
+
+        account, created = queryset.get_or_create(email='ross@example.com',
+                                                  defaults={'plan': 'free'})
+        self.assertEqual(created, False)
+        self.assertEqual(account.plan, 'pro')
+        self.assertEqual(Account.objects.get().plan, 'pro')
+        self.assertEqual(Account.objects.count(), 1)
+
+        Account.drop_collection()
+
+    def test_get_or_create_without_set_on_insert(self):
+        """Ensure that ``get_or_create`` inserts the document on servers
+        without ``$setOnInsert``, warning if no unique index covers the query.
+        """
+        import warnings
+
+        class Account(Document):
+            email = StringField(unique=True)
+            plan = StringField()
+
+        Account.drop_collection()
+
+        def old_find_and_modify(*args, **kwargs):
+            raise OperationError(u'Find and modify failed (Invalid modifier '
+                                 u'specified $setOnInsert)')
+
+        for query, warned in (({'email': 'ross@example.com'}, False),
+                              ({'plan': 'free', 'defaults': {
+                                  'email': 'ann@example.com'}}, True)):
+            queryset = Account.objects
+            queryset._find_and_modify = old_find_and_modify
+            warnings.simplefilter('error', RuntimeWarning)
+            try:
+                if warned:
+                    self.assertRaises(RuntimeWarning,
+                                      queryset.get_or_create, **query)
+                else:
+                    account, created = queryset.get_or_create(**query)
+                    self.assertEqual(created, True)
+            finally:
+                warnings.resetwarnings()
+
+        self.assertEqual(Account.objects.get().email, 'ross@example.com')
+        account, created = Account.objects.get_or_create(
+            email='ross@example.com')
+        self.assertEqual(created, False)
+
+        Account.drop_collection()
 
     def test_repeated_iteration(self):
         """Ensure that QuerySet rewinds itself one iteration finishes.
@@ -251,6 +332,343 @@ class QuerySetTest(unittest.TestCase):
 
         self.assertEqual(people1, people2)
 
+    def test_result_cache(self):
+        """Ensure that cached QuerySets serve repeated iterations from memory.
+        """
+        self.Person(name='Person 1').save()
+        self.Person(name='Person 2').save()
+
+        queryset = self.Person.objects.cache()
+        people1 = [person for person in queryset]
+
+        # Documents saved after the results were cached aren't seen
+        self.Person(name='Person 3').save()
+        people2 = [person for person in queryset]
+        self.assertEqual(people1, people2)
+        self.assertEqual(len(queryset), 2)
+        self.assertEqual(queryset[1], people1[1])
+        self.assertEqual(queryset.first(), people1[0])
+        self.assertEqual(repr(queryset), repr(people1))
+
+        # Only the results shown are fetched for the repr of a queryset
+        # whose cache isn't yet filled
+        repr_output_size = mongoengine.queryset.REPR_OUTPUT_SIZE
+        mongoengine.queryset.REPR_OUTPUT_SIZE = 1
+        try:
+            queryset = self.Person.objects.cache()
+            self.assertTrue('truncated' in repr(queryset))
+            self.assertEqual(len(queryset._result_cache), 2)
+        finally:
+            mongoengine.queryset.REPR_OUTPUT_SIZE = repr_output_size
+
+        # Modifying the queryset discards the cache
+        self.assertEqual(len(list(queryset.filter(name__ne='Person 1'))), 2)
+
+        # Results larger than the maximum size are not cached
+        queryset = self.Person.objects.cache(max_size=2)
+        self.assertEqual(len(list(queryset)), 3)
+        self.Person(name='Person 4').save()
+        self.assertEqual(len(list(queryset)), 4)
+
+        # Caching may be disabled again
+        queryset = self.Person.objects.cache().cache(False)
+        list(queryset)
+        self.Person(name='Person 5').save()
+        self.assertEqual(len(list(queryset)), 5)
+
+    def test_shared_result_cache(self):
+        """Ensure that results are shared between querysets until the
+        collection is written to.
+        """
+        self.Person(name='Person 1', age=20).save()
+        self.Person(name='Person 2', age=30).save()
+
+        people = list(self.Person.objects.cache_results())
+        self.assertEqual(len(people), 2)
+
+        # Writes that bypass MongoEngine aren't noticed...
+        self.Person.objects._collection.insert({'name': 'Person 3',
+                                                '_cls': 'Person',
+                                                '_types': ['Person']})
+        people = list(self.Person.objects.cache_results())
+        self.assertEqual(len(people), 2)
+        person = self.Person.objects(age=20).cache_results().get()
+        self.assertEqual(person.name, 'Person 1')
+
+        # ...but writes through MongoEngine invalidate the cached results
+        person.age = 21
+        person.save()
+        people = list(self.Person.objects.cache_results())
+        self.assertEqual(len(people), 3)
+        queryset = self.Person.objects(age=20).cache_results()
+        self.assertRaises(DoesNotExist, queryset.get)
+
+        self.Person.objects(name='Person 3').cache_results().first()
+        self.Person.objects(name='Person 3').update(set__age=40)
+        person = self.Person.objects(name='Person 3').cache_results().first()
+        self.assertEqual(person.age, 40)
+
+        # Results may be cached for every query on a document
+        class Setting(Document):
+            name = StringField()
+            meta = {'cache_results': 60}
+
+        Setting.drop_collection()
+        Setting(name='theme').save()
+        self.assertEqual(Setting.objects.first().name, 'theme')
+        Setting.objects._collection.update({}, {'$set': {'name': 'x'}})
+        self.assertEqual(Setting.objects.first().name, 'theme')
+        self.assertEqual(Setting.objects.cache_results(False).first().name,
+                         'x')
+        Setting.drop_collection()
+
+    def test_shared_result_cache_streaming(self):
+        """Ensure that results are streamed through the shared result cache,
+        which doesn't keep more than the result cache's maximum size.
+        """
+        for i in range(3):
+            self.Person(name='Person %s' % i, age=i).save()
+
+        loaded = []
+        queryset = self.Person.objects.order_by('age').cache_results()
+        from_son = queryset._from_son
+        def counting_from_son(son):
+            loaded.append(son)
+            return from_son(son)
+        queryset._from_son = counting_from_son
+        self.assertEqual(iter(queryset).next().name, 'Person 0')
+        self.assertEqual(len(loaded), 1)
+
+        # Too many results to cache
+        people = self.Person.objects.cache(max_size=2).cache_results()
+        self.assertEqual(len(list(people)), 3)
+        self.Person.objects._collection.insert({'name': 'Person 3',
+                                                '_cls': 'Person',
+                                                '_types': ['Person']})
+        people = self.Person.objects.cache(max_size=2).cache_results()
+        self.assertEqual(len(list(people)), 4)
+
+    def test_shared_result_cache_versions(self):
+        """Ensure that collection versions are kept in the result cache
+        backend, so writes by other processes sharing it invalidate results.
+        """
+        from mongoengine import cache
+
+        previous = cache.get_result_cache()
+        backend = cache.LocalCache()
+        cache.set_result_cache(backend)
+        try:
+            self.Person(name='Person 1').save()
+            people = list(self.Person.objects.cache_results())
+            self.assertEqual(len(people), 1)
+
+            # Another process inserts a document and bumps the version
+            collection = self.Person.objects._collection
+            collection.insert({'name': 'Person 2', '_cls': 'Person',
+                               '_types': ['Person']})
+            backend.incr(cache._version_key(collection.full_name))
+            people = list(self.Person.objects.cache_results())
+            self.assertEqual(len(people), 2)
+
+            # A version lost from the backend doesn't restart from scratch
+            version = cache.get_collection_version(collection.full_name)
+            backend.clear()
+            self.assertNotEqual(
+                cache.get_collection_version(collection.full_name), version)
+        finally:
+            cache.set_result_cache(previous)
+
+    def test_index_advisor(self):
+        """Ensure that query shapes are recorded, and that indexes are
+        suggested for them.
+        """
+        from mongoengine import advisor
+
+        class Customer(Document):
+            name = StringField()
+            age = IntField()
+            city = StringField(db_field='c')
+            email = StringField(unique=True)
+            meta = {'indexes': ['name', 'city']}
+
+        Customer.drop_collection()
+        for i in range(20):
+            Customer(name='Customer %d' % i, age=i, city='London',
+                     email='%d@example.com' % i).save()
+
+        advisor.clear_query_shapes()
+        advisor.start_recording()
+        for i in range(3):
+            Customer.objects(name='Customer %d' % i).first()
+        list(Customer.objects(age__gt=10).order_by('-age'))
+        list(Customer.objects(age__gt=15).order_by('-age'))
+        advisor.stop_recording()
+        Customer.objects(city='Paris').first()
+
+        shapes = advisor.get_query_shapes()
+        self.assertEqual([shape.count for shape in shapes], [3, 2])
+        self.assertEqual(shapes[0].fields, (('_types', 'equality'),
+                                            ('name', 'equality')))
+        self.assertEqual(shapes[1].fields, (('_types', 'equality'),
+                                            ('age', 'range')))
+        self.assertEqual(shapes[1].ordering, (('age', -1),))
+        self.assertEqual(shapes[1].query['age'], {'$gt': 15})
+
+        advice = advisor.advise()
+        self.assertEqual(advice.suggestions, {Customer: ['-age']})
+        self.assertEqual(sorted(advice.unused[Customer]), ['city', 'email'])
+        self.assertTrue('Suggested indexes:' in str(advice))
+
+        advisor.clear_query_shapes()
+        self.assertEqual(advisor.get_query_shapes(), [])
+        Customer.drop_collection()
+
+    def test_strict_indexes(self):
+        """Ensure that queries that don't use an index may be refused.
+        """
+        import warnings
+        from mongoengine import advisor
+
+        class Customer(Document):
+            name = StringField()
+            age = IntField()
+            meta = {'indexes': ['name'], 'allow_inheritance': False}
+
+        class Setting(Document):
+            key = StringField()
+            meta = {'allow_inheritance': False, 'strict_indexes': 'warn'}
+
+        Customer.drop_collection()
+        Setting.drop_collection()
+        Customer(name='Test', age=30).save()
+        Setting(key='theme').save()
+
+        advisor.set_strict_indexes('raise')
+        try:
+            self.assertEqual(Customer.objects(name='Test').first().age, 30)
+            self.assertRaises(UnindexedQueryError,
+                              Customer.objects(age=30).first)
+            # The verdict is cached for the query's shape
+            self.assertRaises(UnindexedQueryError,
+                              Customer.objects(age=20).count)
+            self.assertTrue(Customer.objects(age=30).explain())
+
+            warnings.simplefilter('error', RuntimeWarning)
+            try:
+                self.assertRaises(RuntimeWarning,
+                                  Setting.objects(key='theme').first)
+            finally:
+                warnings.resetwarnings()
+
+            advisor.set_strict_indexes('raise',
+                                       allow=[Customer._meta['collection']])
+            self.assertEqual(Customer.objects(age=30).first().name, 'Test')
+
+            self.assertRaises(ValueError, advisor.set_strict_indexes, 'log')
+        finally:
+            advisor.set_strict_indexes(None)
+
+        self.assertEqual(Customer.objects(age=30).first().name, 'Test')
+
+        Customer.drop_collection()
+        Setting.drop_collection()
+
+    def test_hint_and_limits(self):
+        """Ensure that index hints and scan limits are applied to queries,
+        counts and explanations.
+        """
+        class Customer(Document):
+            name = StringField()
+            age = IntField()
+            city = StringField()
+            meta = {'indexes': ['name', ('age', '-name')],
+                    'allow_inheritance': False}
+
+        Customer.drop_collection()
+        for i in range(10):
+            Customer(name='Customer %d' % i, age=20 + i).save()
+
+        customers = Customer.objects(age__gte=25).hint(('age', '-name'))
+        self.assertEqual(customers._hint, [('age', 1), ('name', -1)])
+        self.assertEqual(customers.count(), 5)
+        self.assertEqual(len(list(customers)), 5)
+        self.assertTrue(customers.explain())
+
+        # Hints are honoured by counts with limits and skips
+        self.assertEqual(customers.skip(1).limit(2).count(), 2)
+        self.assertEqual(Customer.objects.hint(None).count(), 10)
+        customers = Customer.objects(age__gte=25).hint(('age', '-name'))
+        self.assertEqual(customers[2:4].count(), 2)
+        self.assertEqual(customers[3:].count(), 2)
+
+        # An index that doesn't exist is an error
+        self.assertRaises(OperationError,
+                          Customer.objects.hint('-age').count)
+
+        customers = Customer.objects.max_scan(3)
+        self.assertTrue(len(list(customers)) <= 3)
+        self.assertTrue(Customer.objects.max_scan(3).count() <= 3)
+
+        # Options are removed from an evaluated queryset with None
+        self.assertEqual(len(list(customers.max_scan(None))), 10)
+        customers = Customer.objects.hint('-age')
+        self.assertRaises(OperationError, customers.count)
+        self.assertEqual(customers.hint(None).count(), 10)
+
+        # Limited scans aren't served results cached without the limit
+        self.assertEqual(len(list(Customer.objects.cache_results())), 10)
+        customers = Customer.objects.cache_results().max_scan(3)
+        self.assertTrue(len(list(customers)) <= 3)
+
+        if mongoengine.queryset._CURSOR_MAX_TIME_MS:
+            customers = Customer.objects(age__lt=25).max_time_ms(1000)
+            self.assertEqual(customers.count(), 5)
+            self.assertEqual(len(list(customers)), 5)
+        else:
+            self.assertRaises(OperationError,
+                              Customer.objects.max_time_ms, 1000)
+
+        # Queries with a hint are never refused in strict index mode
+        from mongoengine import advisor
+        advisor.set_strict_indexes('raise')
+        try:
+            self.assertRaises(UnindexedQueryError,
+                              Customer.objects(city='Leeds').first)
+            customers = Customer.objects(city='Leeds').hint('name')
+            self.assertEqual(customers.first(), None)
+        finally:
+            advisor.set_strict_indexes(None)
+
+        Customer.drop_collection()
+
+    def test_local_cache(self):
+        """Ensure that the in-process cache evicts least recently used and
+        expired entries.
+        """
+        from mongoengine.cache import LocalCache
+
+        cache = LocalCache(max_entries=2, timeout=None)
+        cache.set('a', [1])
+        cache.set('b', [2])
+        self.assertEqual(cache.get('a'), [1])
+        cache.set('c', [3])
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), [1])
+        self.assertEqual(cache.get('c'), [3])
+        self.assertEqual(len(cache), 2)
+
+        # Cached values are copied
+        cache.get('a').append(2)
+        self.assertEqual(cache.get('a'), [1])
+
+        cache.set('d', [4], timeout=-1)
+        self.assertEqual(cache.get('d'), None)
+
+        cache.delete('a')
+        self.assertEqual(cache.get('a'), None)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
     def test_regex_query_shortcuts(self):
         """Ensure that contains, startswith, endswith, etc work.
         """
@@ -452,6 +870,68 @@ class QuerySetTest(unittest.TestCase):
         self.assertEqual(obj.salary, employee.salary)
         self.assertEqual(obj.name, None)
 
+    def test_exclude(self):
+        """Ensure that QuerySet.exclude leaves out the given fields.
+        """
+        person = self.Person(name='test', age=25)
+        person.save()
+
+        obj = self.Person.objects.exclude('name').get()
+        self.assertEqual(obj.name, None)
+        self.assertEqual(obj.age, person.age)
+
+        obj = self.Person.objects.fields(age=0).get()
+        self.assertEqual(obj.name, person.name)
+        self.assertEqual(obj.age, None)
+
+        self.assertRaises(InvalidQueryError, self.Person.objects.fields,
+                          name=1, age=0)
+
+    def test_only_subfields(self):
+        """Ensure that fields of embedded documents may be selected, and that
+        lists may be sliced.
+        """
+        class User(EmbeddedDocument):
+            name = StringField()
+            email = StringField()
+
+        class Comment(EmbeddedDocument):
+            text = StringField()
+
+        class BlogPost(Document):
+            title = StringField()
+            author = EmbeddedDocumentField(User)
+            comments = ListField(EmbeddedDocumentField(Comment))
+
+        BlogPost.drop_collection()
+
+        BlogPost(title='Test', author=User(name='Test User', email='a@b.com'),
+                 comments=[Comment(text=str(i)) for i in range(5)]).save()
+
+        post = BlogPost.objects.only('author.name').get()
+        self.assertEqual(post.title, None)
+        self.assertEqual(post.author.name, 'Test User')
+        self.assertEqual(post.author.email, None)
+
+        post = BlogPost.objects.exclude('author.email', 'comments').get()
+        self.assertEqual(post.title, 'Test')
+        self.assertEqual(post.author.name, 'Test User')
+        self.assertEqual(post.author.email, None)
+        self.assertEqual(post.comments, [])
+
+        post = BlogPost.objects.fields(slice__comments=2).get()
+        self.assertEqual(post.title, 'Test')
+        self.assertEqual([c.text for c in post.comments], ['0', '1'])
+
+        post = BlogPost.objects.fields(slice__comments=[1, 2]).get()
+        self.assertEqual([c.text for c in post.comments], ['1', '2'])
+
+        post = BlogPost.objects.fields(slice__comments=-1).only('title').get()
+        self.assertEqual([c.text for c in post.comments], ['4'])
+        self.assertEqual(post.author, None)
+
+        BlogPost.drop_collection()
+
     def test_find_embedded(self):
         """Ensure that an embedded document is properly returned from a query.
         """
@@ -623,6 +1103,78 @@ class QuerySetTest(unittest.TestCase):
 
         BlogPost.drop_collection()
 
+    def test_stored_js(self):
+        """Ensure that Javascript functions may be stored on the server and
+        called by name.
+        """
+        class BlogPost(Document):
+            title = StringField(db_field='t')
+            hits = IntField(db_field='h')
+
+        BlogPost.drop_collection()
+        BlogPost(title='Post #1', hits=1).save()
+        BlogPost(title='Post #2', hits=2).save()
+
+        code = """
+            function(field) {
+                var total = 0;
+                db[collection].find(query).forEach(function(doc) {
+                    total += doc[field] * options.factor + doc[~hits];
+                });
+                return total;
+            }
+        """
+        db = BlogPost.objects._collection.database
+        functions = db['system.js']
+
+        queryset = BlogPost.objects.stored_js()
+        self.assertEqual(queryset.exec_js(code, 'hits', factor=10), 33)
+        caller = queryset._get_js_function(queryset._sub_js_fields(code))
+        name = unicode(caller).split()[3].split('.')[0]
+        self.assertEqual(functions.find({'_id': name}).count(), 1)
+        self.assertTrue('forEach' not in caller)
+
+        code_obj = BlogPost.objects._get_js_function(code)
+        self.assertTrue('forEach' in code_obj)
+
+        # Field substitution is memoised
+        self.assertTrue(queryset._sub_js_fields(code) is
+                        queryset._sub_js_fields(code))
+
+        # ...for a limited number of functions
+        size = mongoengine.queryset.SUB_JS_FIELDS_CACHE_SIZE
+        for i in range(size + 10):
+            queryset._sub_js_fields(u'function() { return %d; }' % i)
+        cache = mongoengine.queryset._sub_js_fields_cache
+        self.assertEqual(len(cache._entries), size)
+
+        map_f = "function() { emit(this[~title], this[~hits]); }"
+        reduce_f = """
+            function(key, values) {
+                var total = 0;
+                for (var i = 0; i < values.length; i++) {
+                    total += values[i];
+                }
+                return total;
+            }
+        """
+        results = BlogPost.objects.stored_js().map_reduce(map_f, reduce_f,
+                                                          output='inline')
+        counts = dict((r.key, r.value) for r in results)
+        self.assertEqual(counts, {'Post #1': 1, 'Post #2': 2})
+
+        # Functions lost by the server (e.g. by dropping the database) are
+        # stored again
+        functions.remove({'_id': {'$regex': '^mongoengine_'}})
+        self.assertEqual(queryset.exec_js(code, 'hits', factor=10), 33)
+        results = BlogPost.objects.stored_js().map_reduce(map_f, reduce_f,
+                                                          output='inline')
+        self.assertEqual(len(list(results)), 2)
+
+        functions.remove({'_id': {'$regex': '^mongoengine_'}})
+        mongoengine.queryset._stored_js_functions.clear()
+        BlogPost.drop_collection()
+
     def test_exec_js_field_sub(self):
         """Ensure that field substitutions occur properly in exec_js functions.
         """
@@ -751,6 +1303,46 @@ class QuerySetTest(unittest.TestCase):
         self.assertTrue('code' not in post.tags)
         self.assertEqual(len(post.tags), 1)
 
+    def test_modify(self):
+        """Ensure that QuerySet.modify updates and returns a single document.
+        """
+        self.Person(name='Person 1', age=20).save()
+        self.Person(name='Person 2', age=30).save()
+
+        # The ordering decides which document is modified
+        person = self.Person.objects.order_by('-age').modify(inc__age=1)
+        self.assertEqual(person.name, 'Person 2')
+        self.assertEqual(person.age, 30)
+
+        person = self.Person.objects(name='Person 1').modify(new=True,
+                                                             set__age=25)
+        self.assertEqual(person.age, 25)
+        self.assertEqual(self.Person.objects.get(name='Person 1').age, 25)
+
+        # Only selected fields are loaded
+        person = self.Person.objects(name='Person 2').only('name').modify(
+            new=True, inc__age=1)
+        self.assertEqual(person.name, 'Person 2')
+        self.assertEqual(person.age, None)
+        self.assertEqual(self.Person.objects.get(name='Person 2').age, 32)
+
+        person = self.Person.objects(name='Person 3').modify(set__age=40)
+        self.assertEqual(person, None)
+
+        person = self.Person.objects(name='Person 3').modify(upsert=True,
+                                                             new=True,
+                                                             set__age=40)
+        self.assertEqual(person.name, 'Person 3')
+        self.assertEqual(person.age, 40)
+
+        person = self.Person.objects(name='Person 3').modify(remove=True)
+        self.assertEqual(person.age, 40)
+        self.assertEqual(len(self.Person.objects(name='Person 3')), 0)
+
+        self.assertRaises(OperationError, self.Person.objects.modify)
+
+        self.Person.drop_collection()
+
     def test_order_by(self):
         """Ensure that QuerySets may be ordered.
         """
@@ -770,6 +1362,51 @@ class QuerySetTest(unittest.TestCase):
         ages = [p.age for p in self.Person.objects.order_by('-name')]
         self.assertEqual(ages, [30, 40, 20])
 
+    def test_keyset_pagination(self):
+        """Ensure that QuerySet.after pages through results without overlaps,
+        using either documents or continuation tokens.
+        """
+        ages = [20, 30, 30, 30, 40, 50, 50]
+        for i, age in enumerate(ages):
+            self.Person(name='Person %d' % i, age=age).save()
+
+        expected = [p.id for p in self.Person.objects.order_by('-age', '-id')]
+
+        # Seek using the last document of each page
+        seen = []
+        page = list(self.Person.objects.order_by('-age').after(limit=3))
+        while page:
+            self.assertTrue(len(page) <= 3)
+            seen += [p.id for p in page]
+            queryset = self.Person.objects.order_by('-age')
+            page = list(queryset.after(page[-1], limit=3))
+        self.assertEqual(seen, expected)
+
+        # Seek using opaque continuation tokens
+        seen = []
+        token = None
+        while True:
+            queryset = self.Person.objects.order_by('-age')
+            page = list(queryset.after(token, limit=2))
+            if not page:
+                break
+            seen += [p.id for p in page]
+            token = queryset.continuation_token(page[-1])
+            self.assertTrue(isinstance(token, str))
+        self.assertEqual(seen, expected)
+
+        # The query is still taken into account
+        queryset = self.Person.objects(age__lt=50).order_by('-age')
+        first = queryset.after(limit=1).first()
+        queryset = self.Person.objects(age__lt=50).order_by('-age')
+        names = [p.name for p in queryset.after(first)]
+        self.assertEqual(len(names), 4)
+
+        # Tokens are tied to the ordering they were created with
+        queryset = self.Person.objects.order_by('+age')
+        self.assertRaises(InvalidQueryError, queryset.after, token)
+        self.assertRaises(InvalidQueryError, queryset.after, 'not-a-token')
+
     def test_map_reduce(self):
         """Ensure map/reduce is both mapping and reducing.
         """
@@ -814,6 +1451,101 @@ class QuerySetTest(unittest.TestCase):
 
         BlogPost.drop_collection()
         
+    def test_map_reduce_output(self):
+        """Ensure that map/reduce results may be returned inline or written
+        to a collection, and combined with previous results.
+        """
+        class BlogPost(Document):
+            title = StringField()
+            tags = ListField(StringField())
+            views = IntField()
+
+        BlogPost.drop_collection()
+        db = BlogPost.objects._collection.database
+        db.drop_collection('tag_counts')
+
+        BlogPost(title='Post #1', tags=['music', 'film'], views=1).save()
+        BlogPost(title='Post #2', tags=['music'], views=2).save()
+
+        map_f = """
+            function() {
+                this[~tags].forEach(function(tag) {
+                    emit(tag, 1);
+                });
+            }
+        """
+        reduce_f = """
+            function(key, values) {
+                var total = 0;
+                for(var i=0; i<values.length; i++) {
+                    total += values[i];
+                }
+                return total;
+            }
+        """
+
+        results = BlogPost.objects.map_reduce(map_f, reduce_f,
+                                              output='inline')
+        counts = dict((r.key, r.value) for r in results)
+        self.assertEqual(counts, {'music': 2, 'film': 1})
+
+        # Inline results are sorted too
+        for ordering, keys in (('-value', ['music', 'film']),
+                               ('+value', ['film', 'music'])):
+            results = BlogPost.objects.order_by(ordering).map_reduce(
+                map_f, reduce_f, output='inline')
+            self.assertEqual([r.key for r in results], keys)
+
+        results = BlogPost.objects.map_reduce(map_f, reduce_f,
+                                              output='tag_counts')
+        counts = dict((r.key, r.value) for r in results)
+        self.assertEqual(counts, {'music': 2, 'film': 1})
+        self.assertEqual(db.tag_counts.count(), 2)
+
+        # Only process new documents, reducing them into the existing results
+        BlogPost(title='Post #3', tags=['film', 'art'], views=3).save()
+        results = BlogPost.objects(views__gt=2).map_reduce(
+            map_f, reduce_f, output={'reduce': 'tag_counts'})
+        counts = dict((r.key, r.value) for r in results)
+        self.assertEqual(counts, {'music': 2, 'film': 2, 'art': 1})
+
+        results = BlogPost.objects(views__gt=2).map_reduce(
+            map_f, reduce_f, output={'merge': 'tag_counts'})
+        counts = dict((r.key, r.value) for r in results)
+        self.assertEqual(counts, {'music': 2, 'film': 1, 'art': 1})
+
+        self.assertRaises(InvalidQueryError, list, BlogPost.objects.map_reduce(
+            map_f, reduce_f, output={'append': 'tag_counts'}))
+
+        db.drop_collection('tag_counts')
+        BlogPost.drop_collection()
+
+    def test_map_reduce_object_batches(self):
+        """Ensure that the documents referenced by map/reduce results are
+        loaded in batches.
+        """
+        class BlogPost(Document):
+            title = StringField()
+
+        BlogPost.drop_collection()
+        posts = [BlogPost(title='Post #%d' % i) for i in range(5)]
+        BlogPost.objects.insert(posts)
+
+        map_f = "function() { emit(this._id, 1); }"
+        reduce_f = "function(key, values) { return values.length; }"
+        results = list(BlogPost.objects.map_reduce(map_f, reduce_f,
+                                                   output='inline'))
+        self.assertEqual(len(results), 5)
+
+        results[0].object
+        for result in results:
+            self.assertTrue(hasattr(result, '_key_object'))
+        posts = dict((post.id, post.title) for post in posts)
+        for result in results:
+            self.assertEqual(result.object.title, posts[result.key])
+
+        BlogPost.drop_collection()
+
     def test_map_reduce_with_custom_object_ids(self):
         """Ensure that QuerySet.map_reduce works properly with custom
         primary keys.
@@ -1032,6 +1764,14 @@ class QuerySetTest(unittest.TestCase):
         self.Person(name='ageless person').save()
         self.assertEqual(int(self.Person.objects.average('age')), avg)
 
+        # Null and non-numeric values aren't counted
+        collection = self.Person.objects._collection
+        collection.insert({'_cls': 'Person', '_types': ['Person'],
+                           'name': 'null age', 'age': None})
+        collection.insert({'_cls': 'Person', '_types': ['Person'],
+                           'name': 'text age', 'age': 'old'})
+        self.assertAlmostEqual(self.Person.objects.average('age'), avg)
+
     def test_sum(self):
         """Ensure that field can be summed over correctly.
         """
@@ -1044,6 +1784,138 @@ class QuerySetTest(unittest.TestCase):
         self.Person(name='ageless person').save()
         self.assertEqual(int(self.Person.objects.sum('age')), sum(ages))
 
+    def test_aggregation_embedded_fields(self):
+        """Ensure that sum, average and item_frequencies work on embedded
+        fields and skip documents without a value.
+        """
+        class Stats(EmbeddedDocument):
+            views = IntField(db_field='v')
+            tags = ListField(StringField())
+
+        class Page(Document):
+            stats = EmbeddedDocumentField(Stats, db_field='s')
+
+        Page.drop_collection()
+        Page(stats=Stats(views=10, tags=['a', 'b'])).save()
+        Page(stats=Stats(views=5, tags=['a'])).save()
+        Page().save()
+
+        self.assertEqual(Page.objects.sum('stats.views'), 15)
+        self.assertEqual(Page.objects.average('stats.views'), 7.5)
+        self.assertEqual(Page.objects.item_frequencies('stats.tags'),
+                         {'a': 2, 'b': 1})
+
+        Page.drop_collection()
+
+    def test_aggregate(self):
+        """Ensure that documents may be grouped and aggregated.
+        """
+        class Ticket(Document):
+            status = StringField()
+            owner = StringField(db_field='o')
+            hours = FloatField()
+            tags = ListField(StringField())
+
+        Ticket.drop_collection()
+        Ticket(status='new', owner='bob', hours=1.0, tags=['ui']).save()
+        Ticket(status='new', owner='bob', hours=3.0, tags=['ui', 'db']).save()
+        Ticket(status='new', owner='ann', tags=['db']).save()
+        Ticket(status='done', owner='ann', hours=2.0).save()
+
+        results = Ticket.objects.aggregate(group_by=['status', 'owner'],
+                                           sum='hours', avg='hours',
+                                           min='hours', max='hours')
+        self.assertEqual(results, [
+            {'status': 'done', 'owner': 'ann', 'count': 1,
+             'hours__sum': 2.0, 'hours__avg': 2.0, 'hours__min': 2.0,
+             'hours__max': 2.0},
+            {'status': 'new', 'owner': 'ann', 'count': 1,
+             'hours__sum': None, 'hours__avg': None, 'hours__min': None,
+             'hours__max': None},
+            {'status': 'new', 'owner': 'bob', 'count': 2,
+             'hours__sum': 4.0, 'hours__avg': 2.0, 'hours__min': 1.0,
+             'hours__max': 3.0},
+        ])
+
+        # Lists are expanded and the query is taken into account
+        results = Ticket.objects(status='new').aggregate(group_by='tags',
+                                                         count=False,
+                                                         sum='hours')
+        self.assertEqual(results, [{'tags': 'db', 'hours__sum': 3.0},
+                                   {'tags': 'ui', 'hours__sum': 4.0}])
+
+        # Without grouping, all documents form a single group
+        results = Ticket.objects.aggregate(max=['hours', 'owner'])
+        self.assertEqual(results, [{'count': 4, 'hours__max': 3.0,
+                                    'owner__max': 'bob'}])
+        results = Ticket.objects(status='closed').aggregate(sum='hours')
+        self.assertEqual(results, [{'count': 0, 'hours__sum': None}])
+
+        # The ordering, skip and limit select the documents aggregated
+        results = Ticket.objects.order_by('hours')[1:3].aggregate(
+            sum='hours')
+        self.assertEqual(results, [{'count': 2, 'hours__sum': 3.0}])
+        results = Ticket.objects.limit(0).aggregate(sum='hours')
+        self.assertEqual(results, [{'count': 0, 'hours__sum': None}])
+
+        self.assertRaises(InvalidQueryError, Ticket.objects.aggregate,
+                          total='hours')
+
+        Ticket.drop_collection()
+
+    def test_to_arrays(self):
+        """Ensure that field values may be fetched as NumPy arrays.
+        """
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        class Reading(Document):
+            sensor = StringField(max_length=10)
+            value = FloatField()
+            count = IntField()
+            valid = BooleanField()
+            taken = DateTimeField()
+            note = StringField(db_field='n')
+            meta = {'ordering': ['count']}
+
+        Reading.drop_collection()
+        taken = datetime(2010, 1, 1, 12, 30)
+        Reading(sensor='a', value=1.5, count=2, valid=True, taken=taken,
+                note='ok').save()
+        Reading(sensor='b', count=1, valid=False).save()
+
+        arrays = Reading.objects.to_arrays('sensor', 'value', 'count', 'valid',
+                                           'taken', 'note')
+        self.assertEqual(arrays['sensor'].dtype, numpy.dtype('U10'))
+        self.assertEqual(list(arrays['sensor']), [u'b', u'a'])
+        self.assertEqual(arrays['value'].dtype, numpy.dtype('float64'))
+        self.assertTrue(numpy.isnan(arrays['value'][0]))
+        self.assertEqual(arrays['value'][1], 1.5)
+        self.assertEqual(arrays['count'].dtype, numpy.dtype('int64'))
+        self.assertEqual(list(arrays['count']), [1, 2])
+        self.assertEqual(list(arrays['valid']), [False, True])
+        self.assertEqual(arrays['taken'][1], numpy.datetime64(taken, 'us'))
+        self.assertEqual(arrays['note'].dtype, numpy.dtype('object'))
+        self.assertEqual(list(arrays['note']), [None, u'ok'])
+
+        # The query, ordering and limits are taken into account
+        arrays = Reading.objects(valid=True).to_arrays('count')
+        self.assertEqual(list(arrays['count']), [2])
+        arrays = Reading.objects.order_by('-count').limit(1).to_arrays('count')
+        self.assertEqual(list(arrays['count']), [2])
+        arrays = Reading.objects.limit(0).to_arrays('count')
+        self.assertEqual(list(arrays['count']), [])
+
+        result = Reading.objects.to_arrays('sensor', 'count', structured=True)
+        self.assertEqual(result.dtype.names, ('sensor', 'count'))
+        self.assertEqual(list(result['count']), [1, 2])
+
+        self.assertRaises(InvalidQueryError, Reading.objects.to_arrays)
+
+        Reading.drop_collection()
+
     def test_distinct(self):
         """Ensure that the QuerySet.distinct method works.
         """
@@ -1244,6 +2116,24 @@ class QuerySetTest(unittest.TestCase):
         self.assertEqual(len(Test.objects(testdict__f__startswith='Val')), 1)
         Test.drop_collection()
 
+    def test_insert(self):
+        """Ensure that documents may be inserted in bulk.
+        """
+        people = [self.Person(name='User %d' % i, age=i) for i in range(3)]
+        result = self.Person.objects.insert(people)
+        self.assertEqual(result, people)
+        for person in people:
+            self.assertTrue(person.id is not None)
+        self.assertEqual(self.Person.objects.count(), 3)
+        self.assertEqual(self.Person.objects.get(age=1).id, people[1].id)
+
+        self.assertEqual(self.Person.objects.insert([]), [])
+
+        class Blog(Document):
+            name = StringField(required=True)
+
+        self.assertRaises(ValidationError, Blog.objects.insert, [Blog()])
+
     def test_bulk(self):
         """Ensure bulk querying by object id returns a proper dict.
         """